@@ -6,10 +6,23 @@ from .memorystorage import MemoryStorage
 from .localstorage import LocalStorage
 from .store import FileStore
 from .exceptions import FileStoreError
-from .structs import FileField, FileData, Config, UploadFile
-from .storage_engines import StorageEngine, LocalEngine, MemoryEngine
+from .admission import AdmissionController, AdmissionMiddleware
+from .forms import SpoolStats
+from .callbacks import RequestCache, request_cache
+from .bundle import ZipBundle, S3Object, zip_response
+from .index import FileIndex
+from .asgi import UploadApp
+from .cancellation import RequestWatch
+from .scheduler import UploadScheduler
+from .ingest import BulkIngest, IngestItem
+from .plan import StorePlan, FieldPlan, passthrough
+from .structs import FileField, FileData, Config, UploadFile, BatchResult
+from .storage_engines import StorageEngine, LocalEngine, MemoryEngine, ReplicatedEngine, TieredEngine, \
+    Migrator, RetryPolicy, CircuitBreaker, PackedEngine, SegmentStore, AdaptiveLimiter, VolumeEngine, VolumeSet, \
+    Volume, ChunkEngine, ChunkStore, Chunker
 
 try:
     from .s3 import S3Engine, S3Storage
+    from .storage_engines.s3_process import S3ProcessPool
 except ImportError as err:
     pass
\ No newline at end of file
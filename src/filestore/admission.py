@@ -0,0 +1,197 @@
+"""
+Process level admission control for uploads. Requests are admitted or rejected from their Content-Length before the
+body is read, based on the bytes and number of uploads already in flight. The body is counted as it is received, so
+requests without a Content-Length, e.g. chunked uploads, are held to the same budget.
+"""
+from logging import getLogger
+from typing import Optional
+
+from fastapi import Request, HTTPException
+from starlette.types import ASGIApp, Message, Scope, Receive, Send
+from starlette.responses import JSONResponse
+
+logger = getLogger(__name__)
+
+SCOPE_KEY = 'filestore.admission'
+RECEIVED_KEY = 'filestore.admission.received'
+
+
+class AdmissionController:
+    """Track the bytes and uploads in flight in the process and shed load once the budgets are exceeded.
+    Share one instance between all the stores of a worker by passing it as the admission config key, or wrap the app
+    with AdmissionMiddleware to reject requests before any dependency reads the body.
+
+    Attributes:
+        max_bytes (int | None): The maximum number of request bytes held by admitted requests.
+        max_uploads (int | None): The maximum number of requests uploading at the same time.
+        retry_after (int): The value of the Retry-After header of rejected requests in seconds.
+        inflight_bytes (int): The bytes held by admitted requests.
+        active (int): The number of admitted requests.
+        rejected (int): The number of rejected requests.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None, max_uploads: Optional[int] = None, retry_after: int = 1):
+        self.max_bytes = max_bytes
+        self.max_uploads = max_uploads
+        self.retry_after = retry_after
+        self.inflight_bytes = 0
+        self.active = 0
+        self.rejected = 0
+
+    def check(self, size: int) -> Optional[HTTPException]:
+        """Check if a request of the given size can be admitted.
+
+        Args:
+            size (int): The Content-Length of the request.
+
+        Returns:
+            HTTPException | None: The rejection, None if the request can be admitted.
+        """
+        headers = {'Retry-After': str(self.retry_after)}
+        if self.max_bytes is not None and size > self.max_bytes:
+            return HTTPException(status_code=413, detail='Request body exceeds the upload budget')
+        if self.max_uploads is not None and self.active >= self.max_uploads:
+            return HTTPException(status_code=429, detail='Too many uploads in progress', headers=headers)
+        if self.max_bytes is not None and self.inflight_bytes + size > self.max_bytes:
+            return HTTPException(status_code=503, detail='Upload capacity exceeded', headers=headers)
+        return None
+
+    def acquire(self, scope: Scope, size: int) -> bool:
+        """Admit a request or raise an HTTPException. A request is only counted once, so a request admitted by the
+        middleware passes through the stores.
+
+        Args:
+            scope (Scope): The ASGI scope of the request.
+            size (int): The Content-Length of the request.
+
+        Returns:
+            bool: True if the request was admitted by this call, False if it was already admitted.
+        """
+        if SCOPE_KEY in scope:
+            return False
+        if (rejection := self.check(size)) is not None:
+            self.rejected += 1
+            logger.warning(f'Rejected upload of {size} bytes with {rejection.status_code}: {rejection.detail}')
+            raise rejection
+        self.inflight_bytes += size
+        self.active += 1
+        scope[SCOPE_KEY] = size
+        return True
+
+    def release(self, scope: Scope):
+        """Release the budget held by a request. Safe to call more than once.
+
+        Args:
+            scope (Scope): The ASGI scope of the request.
+        """
+        if SCOPE_KEY in scope:
+            self.inflight_bytes -= scope.pop(SCOPE_KEY)
+            self.active -= 1
+
+    def charge(self, scope: Scope, size: int):
+        """Charge the bytes of an admitted request received so far. Bytes over the size it was admitted with, e.g. the
+        body of a chunked upload, are added to the bytes in flight or the request is rejected if they don't fit.
+
+        Args:
+            scope (Scope): The ASGI scope of the request.
+            size (int): The bytes of the body received so far.
+        """
+        if SCOPE_KEY not in scope or size <= scope[SCOPE_KEY]:
+            return
+        extra = size - scope[SCOPE_KEY]
+        rejection = None
+        if self.max_bytes is not None and size > self.max_bytes:
+            rejection = HTTPException(status_code=413, detail='Request body exceeds the upload budget')
+        elif self.max_bytes is not None and self.inflight_bytes + extra > self.max_bytes:
+            rejection = HTTPException(status_code=503, detail='Upload capacity exceeded',
+                                      headers={'Retry-After': str(self.retry_after)})
+        if rejection is not None:
+            self.rejected += 1
+            logger.warning(f'Rejected upload after {size} bytes with {rejection.status_code}: {rejection.detail}')
+            raise rejection
+        self.inflight_bytes += extra
+        scope[SCOPE_KEY] = size
+
+    def meter(self, scope: Scope, receive: Receive) -> Receive:
+        """Wrap the receive channel of a request to charge the body as it is received.
+
+        Args:
+            scope (Scope): The ASGI scope of the request.
+            receive (Receive): The receive channel.
+
+        Returns:
+            Receive: The metered receive channel.
+        """
+        async def metered() -> Message:
+            message = await receive()
+            if message['type'] == 'http.request' and (body := message.get('body', b'')):
+                scope[RECEIVED_KEY] = scope.get(RECEIVED_KEY, 0) + len(body)
+                self.charge(scope, scope[RECEIVED_KEY])
+            return message
+        return metered
+
+    def admit(self, req: Request) -> bool:
+        """Admit a request from its Content-Length header. Requests without one are admitted as uploads of no bytes
+        and charged for their body as it is read.
+
+        Args:
+            req (Request): The request object.
+
+        Returns:
+            bool: True if the request was admitted by this call and must be released by the caller.
+        """
+        admitted = self.acquire(req.scope, content_length(req.scope))
+        if admitted:
+            req._receive = self.meter(req.scope, req._receive)
+        return admitted
+
+    def stats(self) -> dict:
+        """The current state of the controller for monitoring."""
+        return {'inflight_bytes': self.inflight_bytes, 'active': self.active, 'rejected': self.rejected,
+                'max_bytes': self.max_bytes, 'max_uploads': self.max_uploads}
+
+
+def content_length(scope: Scope) -> int:
+    """Get the Content-Length of a request from the ASGI scope.
+
+    Args:
+        scope (Scope): The ASGI scope.
+
+    Returns:
+        int: The Content-Length or zero if it is missing or invalid.
+    """
+    for key, value in scope.get('headers', []):
+        if key == b'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                return 0
+    return 0
+
+
+class AdmissionMiddleware:
+    """ASGI middleware that applies an AdmissionController to requests with a body before the app reads it.
+
+    Args:
+        app (ASGIApp): The ASGI application.
+        controller (AdmissionController): The admission controller.
+        methods (tuple[str]): The request methods to control.
+    """
+
+    def __init__(self, app: ASGIApp, controller: AdmissionController, methods=('POST', 'PUT', 'PATCH')):
+        self.app = app
+        self.controller = controller
+        self.methods = methods
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or scope['method'] not in self.methods:
+            return await self.app(scope, receive, send)
+        try:
+            admitted = self.controller.acquire(scope, content_length(scope))
+        except HTTPException as err:
+            response = JSONResponse({'detail': err.detail}, status_code=err.status_code, headers=err.headers)
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, self.controller.meter(scope, receive) if admitted else receive, send)
+        finally:
+            self.controller.release(scope) if admitted else ...
@@ -0,0 +1,203 @@
+"""
+Extraction of uploaded zip and tar archives into one file per archive entry.
+"""
+import asyncio
+import tarfile
+import zipfile
+import posixpath
+import mimetypes
+from logging import getLogger
+from pathlib import PureWindowsPath
+from typing import Awaitable, BinaryIO, Callable, Iterator, List, Optional, Tuple
+
+from starlette.datastructures import Headers
+
+from .exceptions import FileStoreError
+from .forms import SpoolFile, spool_settings
+from .structs import FileField, FileData, UploadFile, Config
+from .util import to_thread
+
+logger = getLogger(__name__)
+
+MAX_ENTRIES = 10000
+MAX_SIZE = 1024 ** 3
+CONCURRENCY = 4
+CHUNK_SIZE = 1024 * 1024
+
+
+class NotAnArchive(FileStoreError):
+    """Raised when an uploaded file of a field with the extract config is neither a zip nor a tar archive."""
+
+
+def entry_name(name: str) -> Optional[str]:
+    """Normalize the name of an archive entry. Absolute names, drive letters and names with .. components are rejected
+    before any path is built from them.
+
+    Args:
+        name (str): The name of the entry in the archive.
+
+    Returns:
+        str | None: The normalized relative name, None if the entry must be skipped.
+    """
+    path = PureWindowsPath(name)
+    if path.anchor or '..' in path.parts:
+        return None
+    name = posixpath.normpath('/'.join(path.parts))
+    return None if name == '.' else name
+
+
+class Extractor:
+    """Extract the regular file entries of an archive into spooled files while enforcing limits on the number of
+    entries and the total expanded size. The sizes are counted while copying, the sizes declared by the archive are
+    only used to reject a zip archive early.
+
+    Attributes:
+        max_entries (int): The maximum number of file entries.
+        max_size (int): The maximum total expanded size in bytes.
+        spool (tuple[int, str | Path | None]): The spool size threshold and directory for the entries.
+    """
+
+    def __init__(self, config: Config):
+        self.max_entries = config.get('extract_max_entries', MAX_ENTRIES)
+        self.max_size = config.get('extract_max_size', MAX_SIZE)
+        self.spool = spool_settings(config)
+        self.entries = 0
+        self.size = 0
+
+    def copy(self, name: str, source: BinaryIO) -> Tuple[str, SpoolFile, int]:
+        self.entries += 1
+        if self.entries > self.max_entries:
+            raise FileStoreError(f'Archive has more than {self.max_entries} entries')
+        max_size, directory = self.spool
+        spool, size = SpoolFile(max_size=max_size, dir=directory), 0
+        try:
+            while chunk := source.read(CHUNK_SIZE):
+                size += len(chunk)
+                self.size += len(chunk)
+                if self.size > self.max_size:
+                    raise FileStoreError(f'Archive expands to more than {self.max_size} bytes')
+                spool.write(chunk)
+            spool.seek(0)
+        except BaseException:
+            spool.close()
+            raise
+        return name, spool, size
+
+    def zip_entries(self, file: BinaryIO) -> Iterator[Tuple[str, SpoolFile, int]]:
+        with zipfile.ZipFile(file) as archive:
+            members = [info for info in archive.infolist() if not info.is_dir()]
+            if len(members) > self.max_entries:
+                raise FileStoreError(f'Archive has more than {self.max_entries} entries')
+            if sum(info.file_size for info in members) > self.max_size:
+                raise FileStoreError(f'Archive expands to more than {self.max_size} bytes')
+            for info in members:
+                if (name := entry_name(info.filename)) is None:
+                    continue
+                with archive.open(info) as source:
+                    yield self.copy(name, source)
+
+    def tar_entries(self, file: BinaryIO) -> Iterator[Tuple[str, SpoolFile, int]]:
+        # stream mode reads the members in order without seeking or copying the archive.
+        try:
+            archive = tarfile.open(fileobj=file, mode='r|*')
+        except tarfile.ReadError as err:
+            raise NotAnArchive(f'Not a zip or tar archive: {err}')
+        with archive:
+            for member in archive:
+                if not member.isfile() or (name := entry_name(member.name)) is None:
+                    continue
+                yield self.copy(name, archive.extractfile(member))
+
+    def iter_entries(self, file: BinaryIO) -> Iterator[Tuple[str, SpoolFile, int]]:
+        """Extract the entries of an archive one at a time, the next entry is only read when it is asked for. Runs in
+        worker threads, one step at a time.
+
+        Args:
+            file (BinaryIO): The archive file object.
+
+        Raises:
+            NotAnArchive: If the file is neither a zip nor a tar archive.
+
+        Yields:
+            tuple[str, SpoolFile, int]: The name, data and size of a file entry.
+        """
+        try:
+            file.seek(0)
+            if zipfile.is_zipfile(file):
+                file.seek(0)
+                yield from self.zip_entries(file)
+            else:
+                file.seek(0)
+                yield from self.tar_entries(file)
+        except (zipfile.BadZipFile, tarfile.TarError) as err:
+            raise FileStoreError(f'Unable to extract archive: {err}')
+
+
+def is_archive(file_field: FileField) -> bool:
+    """If the file of a file field is an archive to extract."""
+    return bool(file_field.get('config', {}).get('extract'))
+
+
+def entry_field(file_field: FileField, name: str, spool: SpoolFile, size: int) -> FileField:
+    """The FileField of an archive entry, with the field name and config of the archive."""
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    entry = UploadFile(file=spool, size=size, filename=name, headers=Headers({'content-type': content_type}))
+    fields = {**file_field, 'file': entry}
+    fields.pop('destination', None)
+    return fields
+
+
+async def extract(file_field: FileField, upload: Callable[[FileField], Awaitable[FileData]]) -> List[FileData]:
+    """Extract an uploaded archive and upload its file entries as they are read. Up to extract_concurrency entries
+    are spooled and uploaded concurrently, the next entry is only read when one of them is done. The entries keep the
+    field name and config of the archive and their names relative to the archive root are used as filenames.
+
+    Args:
+        file_field (FileField): The file field of the archive.
+        upload (Callable[[FileField], Awaitable[FileData]]): Upload the FileField of an entry.
+
+    Raises:
+        NotAnArchive: If the file is neither a zip nor a tar archive.
+
+    Returns:
+        list[FileData]: The results of the entries in the order of the archive.
+    """
+    file, config = file_field['file'], file_field.get('config', {})
+    entries = Extractor(config).iter_entries(file.file)
+    slots = asyncio.Semaphore(max(1, config.get('extract_concurrency', CONCURRENCY)))
+    tasks, spools, step = [], [], None
+
+    async def upload_entry(name: str, spool: SpoolFile, size: int) -> FileData:
+        try:
+            return await upload(entry_field(file_field, name, spool, size))
+        finally:
+            spool.close()
+            slots.release()
+
+    try:
+        while True:
+            await slots.acquire()
+            # shielded so a cancelled request waits for the entry being read before the archive is closed.
+            step = asyncio.ensure_future(to_thread(next, entries, None))
+            entry = await asyncio.shield(step)
+            step = None
+            if entry is None:
+                break
+            spools.append(entry[1])
+            tasks.append(asyncio.ensure_future(upload_entry(*entry)))
+        results = await asyncio.gather(*tasks)
+    finally:
+        if step is not None:
+            await asyncio.wait([step])
+            if not step.cancelled() and step.exception() is None and step.result() is not None:
+                step.result()[1].close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # an upload cancelled before it started never closes its spool.
+        for spool in spools:
+            spool.close()
+        await to_thread(entries.close)
+        await file.close()
+    logger.info(f'Extracted {len(results)} entries from {file.filename}')
+    return results
@@ -0,0 +1,183 @@
+"""
+A plain ASGI entry point for upload endpoints. Uploads are parsed from the ASGI receive channel and stored with the
+storage engines without FastAPI's dependency injection or the pydantic form model.
+"""
+import json
+import time
+import asyncio
+from functools import partial
+from logging import getLogger
+from typing import Dict, List, Optional, Type, Union
+
+from starlette.background import BackgroundTasks
+from starlette.datastructures import FormData
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.types import ASGIApp, Scope, Receive, Send
+
+from .structs import FileField, FileData, Store, Config
+from .storage_engines import StorageEngine, LocalEngine, ReplicatedEngine
+from .exceptions import FileStoreError
+from .forms import parse_form, SpoolStats
+from .plan import StorePlan
+from .cancellation import RequestWatch
+from .main import collect_files, store_files, file_filter, filename
+
+logger = getLogger(__name__)
+
+JSON_HEADERS = [(b'content-type', b'application/json')]
+Storage = Union[Type[StorageEngine], List[Type[StorageEngine]]]
+
+
+class UploadApp:
+    """An ASGI app that stores the files of multipart POST requests and responds with the serialized Store.
+    It takes the same fields and config as the FastStore classes and drives the storage engines directly from the
+    ASGI receive channel, so it can be served by any ASGI server, mounted in a Starlette or FastAPI app or added as a
+    middleware in front of one. As a middleware it handles POST requests to its path and passes everything else on.
+
+    Example:
+        ingest = UploadApp(name='book', count=10, storage=LocalEngine, config={'destination': 'uploads'})
+        app.mount('/ingest', ingest)
+        app.add_middleware(UploadApp, path='/fast/books', name='book', storage=LocalEngine)
+
+    Args:
+        app (ASGIApp): The app to pass other requests to when used as a middleware.
+        path (str): The path of the upload endpoint. Defaults to every path.
+        name (str): The name of the file field for a single field upload.
+        count (int): The maximum number of files of the single field.
+        required (bool): If the single field is required.
+        storage (Type[StorageEngine] | list[Type[StorageEngine]]): The storage engine of the fields without a
+            storage key, a list of engines replicates the files. Defaults to LocalEngine.
+        fields (list[FileField]): The fields to expect from the form.
+        config (Config): The config of the store.
+    """
+
+    def __init__(self, app: Optional[ASGIApp] = None, *, path: Optional[str] = None, name: str = '', count: int = 1,
+                 required: bool = False, storage: Storage = LocalEngine, fields: List[FileField] = None,
+                 config: Config = None):
+        self.app = app
+        self.path = path
+        self.storage = storage
+        field = {'name': name, 'max_count': count, 'required': required} if name else {}
+        self.fields = fields or []
+        self.fields.append(field) if field else ...
+        self.config = {'filter': file_filter, 'max_files': 1000, 'max_fields': 1000, 'filename': filename,
+                       'background': False, **(config or {})}
+        self.spool_stats = SpoolStats()
+        self.plan = StorePlan.compile(self.fields, self.config)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] == 'http' and scope['method'] == 'POST' and (self.path is None or scope['path'] == self.path):
+            return await self.handle(scope, receive, send)
+        if self.app is not None:
+            return await self.app(scope, receive, send)
+        if scope['type'] == 'lifespan':
+            while (await receive())['type'] != 'lifespan.shutdown':
+                await send({'type': 'lifespan.startup.complete'})
+            return await send({'type': 'lifespan.shutdown.complete'})
+        if scope['type'] == 'http':
+            allowed = self.path is None or scope['path'] == self.path
+            await self.respond(send, 405 if allowed else 404,
+                               json.dumps({'detail': 'Method Not Allowed' if allowed else 'Not Found'}).encode())
+
+    @staticmethod
+    async def respond(send: Send, status: int, body: bytes, headers: Dict[str, str] = None):
+        """Send a json response."""
+        headers = [*JSON_HEADERS, (b'content-length', str(len(body)).encode()),
+                   *((key.lower().encode(), value.encode()) for key, value in (headers or {}).items())]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def store(self, req: Request, bgt: BackgroundTasks, start: float = None) -> Store:
+        """Parse the form of a request and store its files.
+
+        Args:
+            req (Request): The request.
+            bgt (BackgroundTasks): The tasks to run after the response.
+            start (float): The time.monotonic of the start of the request, for the deadline config.
+
+        Returns:
+            Store: The result of the storage operations.
+        """
+        plan = self.plan
+        form = await parse_form(req, max_files=plan.max_files, max_fields=plan.max_fields, spool=plan.spool,
+                                stats=self.spool_stats)
+        if missing := plan.missing(form):
+            raise HTTPException(status_code=422, detail=f'Missing required fields: {", ".join(missing)}')
+        file_fields = await collect_files(req, form, plan)
+        if not file_fields:
+            return Store(message='No files were uploaded')
+
+        async with RequestWatch(req, deadline=self.config.get('deadline'), start=start, form=form,
+                                disconnect=self.config.get('cancel_on_disconnect', True)):
+            results = await store_files(req, form, file_fields, partial(self.upload_many, req, form, bgt))
+
+        files: Dict[str, List[FileData]] = {}
+        failed: Dict[str, List[FileData]] = {}
+        for result in results:
+            (files if result.status else failed).setdefault(result.field_name, []).append(result)
+        if index := self.config.get('index'):
+            bgt.add_task(index.add, results)
+        success = len(results) - sum(len(group) for group in failed.values())
+        return Store(file=results[0] if len(results) == 1 and results[0].status else None, files=files,
+                     failed=failed, message=f'{success} files uploaded successfully' if success else '',
+                     error=f'{len(results) - success} file(s) not uploaded' if success < len(results) else '')
+
+    async def upload_many(self, req: Request, form: FormData, bgt: BackgroundTasks,
+                          file_fields: List[FileField]) -> List[FileData]:
+        """Upload file fields with the engines of their storages, one engine per storage for all the files.
+
+        Args:
+            req (Request): The request.
+            form (FormData): The form of the request.
+            bgt (BackgroundTasks): The tasks to run after the response.
+            file_fields (list[FileField]): The file fields to upload.
+
+        Returns:
+            list[FileData]: The results in the order of the file fields.
+        """
+        # engines don't keep state between awaits, so the files of a request share one engine per storage.
+        groups: Dict[int, List[int]] = {}
+        storages = {}
+        for index, file_field in enumerate(file_fields):
+            storage = file_field.get('storage') or self.storage
+            storages[id(storage)] = storage
+            groups.setdefault(id(storage), []).append(index)
+        results: List[FileData] = [None] * len(file_fields)
+        batches = await asyncio.gather(*[self.engine(storages[key], req, form, bgt).upload_many(
+            file_fields=[file_fields[index] for index in indexes]) for key, indexes in groups.items()])
+        for indexes, batch in zip(groups.values(), batches):
+            for index, result in zip(indexes, batch):
+                results[index] = result
+        return results
+
+    @staticmethod
+    def engine(storage: Storage, req: Request, form: FormData, bgt: BackgroundTasks) -> StorageEngine:
+        if isinstance(storage, (list, tuple)):
+            return ReplicatedEngine(request=req, form=form, background_tasks=bgt, engines=storage)
+        return storage(request=req, form=form, background_tasks=bgt)
+
+    async def handle(self, scope: Scope, receive: Receive, send: Send):
+        """Store the uploads of a request, send the Store and run the background tasks."""
+        start = time.monotonic()
+        req = Request(scope, receive)
+        bgt = BackgroundTasks()
+        admission = self.config.get('admission')
+        admitted = False
+        try:
+            try:
+                admitted = admission.admit(req) if admission else False
+                store = await self.store(req, bgt, start)
+            except HTTPException as err:
+                return await self.respond(send, err.status_code, json.dumps({'detail': err.detail}).encode(),
+                                          err.headers)
+            except FileStoreError as err:
+                logger.error(f'Error uploading files: {err} in {self.__class__.__name__}')
+                store = Store(error=str(err), status=False)
+            await self.respond(send, 200, store.model_dump_json().encode())
+            await bgt()
+        finally:
+            # the budget is held until the background uploads are done.
+            admission.release(scope) if admitted else ...
+            form = getattr(req, '_form', None)
+            await form.close() if form is not None else ...
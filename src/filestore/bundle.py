@@ -0,0 +1,196 @@
+"""
+Streaming zip bundles of stored files for download.
+"""
+import io
+import os
+import time
+import asyncio
+import zipfile
+from logging import getLogger
+from pathlib import Path
+from typing import AsyncIterator, Iterable, List, NamedTuple, Tuple, Union
+from urllib.parse import urlparse, unquote
+
+from starlette.responses import StreamingResponse
+
+from .exceptions import FileStoreError
+from .structs import FileData
+from .util import to_thread
+
+logger = getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class S3Object(NamedTuple):
+    """An object in an S3 bucket."""
+    bucket: str
+    key: str
+
+
+Source = Union[str, Path, S3Object, FileData]
+Entry = Union[Source, Tuple[str, Source]]
+
+
+def s3_object(url: str) -> S3Object:
+    """Get the bucket and key of an object from the virtual hosted style url returned by the S3Engine.
+
+    Args:
+        url (str): The url of the object.
+
+    Returns:
+        S3Object: The bucket and key of the object.
+    """
+    parsed = urlparse(url)
+    return S3Object(bucket=parsed.netloc.split('.s3.', 1)[0], key=unquote(parsed.path.lstrip('/')))
+
+
+class _Sink(io.RawIOBase):
+    """A write only stream that collects what the zip writer writes until it is drained. It can tell but not seek,
+    which makes the zip writer use data descriptors instead of seeking back to the local headers."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks: List[bytes] = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def drain(self) -> bytes:
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+class ZipBundle:
+    """Build a zip64 archive of stored files and stream it as it is written. Local files and S3 objects are fetched by
+    up to prefetch entries ahead of the writer, each holding at most two chunks, so memory use doesn't depend on the
+    size of the bundle.
+
+    Args:
+        entries (Iterable[Source | tuple[str, Source]]): The files to bundle. A source is a local path, an S3Object or
+            the FileData of a stored file. Give an (arcname, source) pair to choose the name in the archive.
+        prefetch (int): The number of entries fetched concurrently ahead of the writer.
+        chunk_size (int): The size of the chunks read from the sources.
+        compression (int): The zipfile compression method. Defaults to ZIP_STORED.
+        client: A boto3 S3 client for S3 sources. Created from the environment if not given.
+    """
+
+    def __init__(self, entries: Iterable[Entry], prefetch: int = 4, chunk_size: int = CHUNK_SIZE,
+                 compression: int = zipfile.ZIP_STORED, client=None):
+        self.entries = entries
+        self.prefetch = prefetch
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('s3', region_name=os.environ.get('AWS_DEFAULT_REGION'))
+        return self._client
+
+    @staticmethod
+    def entry(entry: Entry) -> Tuple[str, Union[Path, S3Object]]:
+        """Get the arcname and the local path or S3 object of an entry."""
+        arcname, source = entry if isinstance(entry, tuple) and not isinstance(entry, S3Object) else ('', entry)
+        if isinstance(source, FileData):
+            arcname = arcname or source.filename
+            source = Path(source.path) if source.path else s3_object(source.url)
+        elif not isinstance(source, S3Object):
+            source = Path(source)
+        arcname = arcname or (source.name if isinstance(source, Path) else source.key.rsplit('/', 1)[-1])
+        return arcname, source
+
+    async def _read(self, source: Union[Path, S3Object], queue: asyncio.Queue):
+        if isinstance(source, Path):
+            fh = await to_thread(open, source, 'rb')
+        else:
+            fh = (await to_thread(self.client.get_object, Bucket=source.bucket, Key=source.key))['Body']
+        try:
+            while chunk := await to_thread(fh.read, self.chunk_size):
+                await queue.put(chunk)
+        finally:
+            fh.close()
+
+    async def _fetch(self, source: Union[Path, S3Object], queue: asyncio.Queue, slots: asyncio.Semaphore):
+        try:
+            await self._read(source, queue)
+            await queue.put(None)
+        except Exception as err:
+            logger.error(f'Error fetching {source}: {err} in {self.__class__.__name__}')
+            await queue.put(FileStoreError(f'Unable to fetch {source}: {err}'))
+        finally:
+            slots.release()
+
+    async def _schedule(self, order: asyncio.Queue, tasks: List[asyncio.Task]):
+        slots = asyncio.Semaphore(self.prefetch)
+        for entry in self.entries:
+            arcname, source = self.entry(entry)
+            await slots.acquire()
+            queue = asyncio.Queue(maxsize=2)
+            tasks.append(asyncio.get_running_loop().create_task(self._fetch(source, queue, slots)))
+            await order.put((arcname, queue))
+        await order.put(None)
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """Stream the zip archive.
+
+        Yields:
+            bytes: The next part of the archive.
+        """
+        sink, order, tasks = _Sink(), asyncio.Queue(), []
+        scheduler = asyncio.get_running_loop().create_task(self._schedule(order, tasks))
+        try:
+            with zipfile.ZipFile(sink, 'w', compression=self.compression, allowZip64=True) as archive:
+                while (item := await order.get()) is not None:
+                    arcname, queue = item
+                    info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+                    info.compress_type = self.compression
+                    info.external_attr = 0o644 << 16
+                    with archive.open(info, 'w', force_zip64=True) as dest:
+                        while (chunk := await queue.get()) is not None:
+                            if isinstance(chunk, Exception):
+                                raise chunk
+                            dest.write(chunk)
+                            if sink.chunks:
+                                yield sink.drain()
+                    yield sink.drain()
+            yield sink.drain()
+        finally:
+            scheduler.cancel()
+            for task in tasks:
+                task.cancel()
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self.stream()
+
+
+def zip_response(entries: Iterable[Entry], filename: str = 'bundle.zip', prefetch: int = 4,
+                 chunk_size: int = CHUNK_SIZE, compression: int = zipfile.ZIP_STORED,
+                 client=None) -> StreamingResponse:
+    """A streaming response of a zip archive of stored files. See ZipBundle for the arguments.
+
+    Args:
+        entries (Iterable[Source | tuple[str, Source]]): The files to bundle.
+        filename (str): The filename of the download.
+        prefetch (int): The number of entries fetched concurrently ahead of the writer.
+        chunk_size (int): The size of the chunks read from the sources.
+        compression (int): The zipfile compression method.
+        client: A boto3 S3 client for S3 sources.
+
+    Returns:
+        StreamingResponse: The response.
+    """
+    bundle = ZipBundle(entries, prefetch=prefetch, chunk_size=chunk_size, compression=compression, client=client)
+    return StreamingResponse(bundle.stream(), media_type='application/zip',
+                             headers={'Content-Disposition': f'attachment; filename="{filename}"'})
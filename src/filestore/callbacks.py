@@ -0,0 +1,97 @@
+"""
+Helpers for calling the filter, filename and destination config functions. The functions can be plain functions or
+coroutine functions, independent coroutines are run concurrently and lookups can be memoized for a request.
+"""
+import asyncio
+from inspect import isawaitable
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple, Union
+
+from fastapi import Request
+
+CACHE_KEY = 'filestore.cache'
+
+
+async def resolve(value: Union[Any, Awaitable]) -> Any:
+    """Await the value if it is awaitable.
+
+    Args:
+        value (Any | Awaitable): The return value of a sync or async callback.
+
+    Returns:
+        Any: The result.
+    """
+    return await value if isawaitable(value) else value
+
+
+async def call(func: Callable, *args) -> Any:
+    """Call a sync or async function.
+
+    Args:
+        func (Callable): The function.
+        *args: The arguments of the function.
+
+    Returns:
+        Any: The result of the function.
+    """
+    return await resolve(func(*args))
+
+
+async def gather_calls(calls: List[Tuple[Callable, tuple]]) -> list:
+    """Call a list of functions. Sync functions are called in place and the coroutines of async functions are awaited
+    concurrently, so plain callbacks don't pay for a task each.
+
+    Args:
+        calls (list[tuple[Callable, tuple]]): Pairs of function and arguments.
+
+    Returns:
+        list: The results in the order of the calls.
+    """
+    results = [func(*args) for func, args in calls]
+    pending = [index for index, result in enumerate(results) if isawaitable(result)]
+    if pending:
+        for index, result in zip(pending, await asyncio.gather(*[results[index] for index in pending])):
+            results[index] = result
+    return results
+
+
+class RequestCache:
+    """Memoize lookups for the duration of a request. Concurrent lookups of the same key share a single call.
+
+    Example:
+        async def destination(req, form, field, file):
+            folder = await request_cache(req).get(('folder', form['title']), lambda: find_folder(form['title']))
+            return f'{folder}/{file.filename}'
+    """
+
+    def __init__(self):
+        self._results: Dict[Hashable, asyncio.Future] = {}
+
+    async def get(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        """Get the memoized result of a key or compute it with a sync or async function.
+
+        Args:
+            key (Hashable): The key of the lookup.
+            func (Callable[[], Any]): A function without arguments that computes the result.
+
+        Returns:
+            Any: The result of the lookup.
+        """
+        future = self._results.get(key)
+        if future is None:
+            future = self._results[key] = asyncio.ensure_future(call(func))
+        return await asyncio.shield(future)
+
+
+def request_cache(req: Request) -> RequestCache:
+    """Get the lookup cache of a request.
+
+    Args:
+        req (Request): The request object.
+
+    Returns:
+        RequestCache: The cache of the request.
+    """
+    cache = req.scope.get(CACHE_KEY)
+    if cache is None:
+        cache = req.scope[CACHE_KEY] = RequestCache()
+    return cache
@@ -0,0 +1,88 @@
+"""
+Cancellation of the storage work of abandoned requests. The uploads of a request are cancelled when the client
+disconnects or the deadline of the request passes, so the remaining writes stop using disk, network and threads.
+"""
+import time
+import asyncio
+from logging import getLogger
+from typing import Optional
+
+from starlette.datastructures import FormData
+from starlette.requests import Request
+
+from .exceptions import FileStoreError
+
+logger = getLogger(__name__)
+
+
+class RequestWatch:
+    """Cancel the current task when the client disconnects or the deadline passes. Use it as an async context manager
+    around the storage work of a request, after the form is parsed. A cancelled block raises a FileStoreError with the
+    reason, the uploads in flight get a CancelledError at their next await, so engines stop between chunks and remove
+    their partial files, and the spooled files of the form are closed.
+
+    Example:
+        async with RequestWatch(req, deadline=30, start=start, form=form):
+            await store.multi_upload(file_fields=file_fields)
+
+    Attributes:
+        request (Request): The request to watch.
+        deadline (float | None): The seconds from start to the deadline, None has no deadline.
+        start (float): The time.monotonic of the start of the request.
+        disconnect (bool): Cancel when the client disconnects.
+        form (FormData | None): The form to close when cancelled.
+        reason (str): Why the block was cancelled, empty if it wasn't.
+    """
+
+    def __init__(self, request: Request, *, deadline: Optional[float] = None, start: Optional[float] = None,
+                 disconnect: bool = True, form: Optional[FormData] = None):
+        self.request = request
+        self.deadline = deadline
+        self.start = time.monotonic() if start is None else start
+        self.disconnect = disconnect
+        self.form = form
+        self.reason = ''
+        self._task: Optional[asyncio.Task] = None
+        self._watchers = []
+
+    async def _disconnected(self):
+        # the body is consumed before the uploads start, so the next message is the disconnect.
+        try:
+            while (await self.request.receive())['type'] != 'http.disconnect':
+                pass
+        except Exception as err:
+            logger.debug(f'Stopped watching for disconnects: {err}')
+            return
+        self.cancel('Client disconnected')
+
+    async def _expired(self, delay: float):
+        await asyncio.sleep(delay)
+        self.cancel(f'Request deadline of {self.deadline}s exceeded')
+
+    def cancel(self, reason: str):
+        """Cancel the watched block."""
+        if not self.reason and self._task is not None:
+            self.reason = reason
+            self._task.cancel()
+
+    async def __aenter__(self) -> 'RequestWatch':
+        self._task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        if self.disconnect and self.request.scope.get('type') == 'http':
+            self._watchers.append(loop.create_task(self._disconnected()))
+        if self.deadline is not None:
+            self._watchers.append(loop.create_task(self._expired(self.deadline - (time.monotonic() - self.start))))
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        for watcher in self._watchers:
+            watcher.cancel()
+        self._task, self._watchers = None, []
+        if not self.reason or exc_type is not asyncio.CancelledError:
+            return False
+        task = asyncio.current_task()
+        task.uncancel() if hasattr(task, 'uncancel') else ...
+        logger.warning(f'{self.reason}, cancelled the uploads of {self.request.url.path}')
+        if self.form is not None:
+            await self.form.close()
+        raise FileStoreError(self.reason)
@@ -0,0 +1,137 @@
+"""
+Multipart form parsing with configurable spooling of uploaded files.
+"""
+from collections import defaultdict
+from logging import getLogger
+from tempfile import SpooledTemporaryFile, NamedTemporaryFile
+from typing import Callable, Dict, Optional, Tuple, Union
+from pathlib import Path
+
+from fastapi import Request, HTTPException
+from starlette.datastructures import FormData
+from starlette.formparsers import MultiPartParser as StarletteMultiPartParser, MultiPartException
+
+from .structs import Config
+
+logger = getLogger(__name__)
+
+SPOOL_MAX_SIZE = 1024 * 1024
+
+# (spool_max_size, spool_dir)
+SpoolSettings = Tuple[int, Optional[Union[str, Path]]]
+
+
+class SpoolStats:
+    """Counts of spooled files and the files that rolled over from memory to disk, in total and by field name.
+    Use them to tune the spool_max_size config key against real traffic.
+
+    Attributes:
+        files (dict[str, int]): The number of spooled files by field name.
+        rollovers (dict[str, int]): The number of files that rolled over to disk by field name.
+        rolled_bytes (dict[str, int]): The size of the files when they rolled over by field name.
+    """
+
+    def __init__(self):
+        self.files: Dict[str, int] = defaultdict(int)
+        self.rollovers: Dict[str, int] = defaultdict(int)
+        self.rolled_bytes: Dict[str, int] = defaultdict(int)
+
+    def stats(self) -> dict:
+        """The totals and the counts by field name."""
+        return {'files': sum(self.files.values()), 'rollovers': sum(self.rollovers.values()),
+                'rolled_bytes': sum(self.rolled_bytes.values()), 'fields': {
+                    name: {'files': count, 'rollovers': self.rollovers[name], 'rolled_bytes': self.rolled_bytes[name]}
+                    for name, count in self.files.items()}}
+
+
+class SpoolFile(SpooledTemporaryFile):
+    """A SpooledTemporaryFile that records when it rolls over to disk. It rolls over to a named temporary file, so
+    files on disk have a path other processes can open, e.g. the workers of an S3ProcessPool. The file is removed
+    when it is closed."""
+
+    def __init__(self, max_size: int = 0, dir: Optional[Union[str, Path]] = None, field_name: str = '',
+                 stats: SpoolStats = None):
+        super().__init__(max_size=max_size, dir=dir)
+        self.field_name = field_name
+        self.stats = stats
+
+    def rollover(self):
+        if self._rolled:
+            return
+        size = self.tell()
+        file = self._file
+        newfile = self._file = NamedTemporaryFile(**self._TemporaryFileArgs)
+        del self._TemporaryFileArgs
+        newfile.write(file.getvalue())
+        newfile.seek(size, 0)
+        self._rolled = True
+        if self.stats is not None:
+            self.stats.rollovers[self.field_name] += 1
+            self.stats.rolled_bytes[self.field_name] += size
+
+
+class MultiPartParser(StarletteMultiPartParser):
+    """Starlette's multipart parser with the spool size and directory of each file chosen by its field name."""
+
+    def __init__(self, *args, spool: Callable[[str], SpoolSettings] = None, stats: SpoolStats = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spool = spool or (lambda name: (SPOOL_MAX_SIZE, None))
+        self.stats = stats
+
+    def on_headers_finished(self):
+        super().on_headers_finished()
+        part = self._current_part
+        if part.file is None:
+            return
+        name = part.field_name
+        max_size, directory = self.spool(name)
+        tempfile = SpoolFile(max_size=max_size, dir=directory, field_name=name, stats=self.stats)
+        if self.stats is not None:
+            self.stats.files[name] += 1
+        to_close = getattr(self, '_files_to_close_on_error', None)
+        if to_close and to_close[-1] is part.file.file:
+            to_close[-1] = tempfile
+        part.file.file.close()
+        part.file = type(part.file)(file=tempfile, size=0, filename=part.file.filename, headers=part.file.headers)
+
+
+def spool_settings(config: Config) -> SpoolSettings:
+    """Get the spool settings of a config dict.
+
+    Args:
+        config (Config): A store or field config dict.
+
+    Returns:
+        tuple[int, str | Path | None]: The spool size threshold and directory.
+    """
+    return config.get('spool_max_size', SPOOL_MAX_SIZE), config.get('spool_dir')
+
+
+async def parse_form(req: Request, *, max_files: int, max_fields: int, spool: Callable[[str], SpoolSettings] = None,
+                     stats: SpoolStats = None) -> FormData:
+    """Parse the form of a request spooling uploaded files as configured. If the body was already parsed e.g. by a
+    form parameter of the path function, the parsed form is returned as is.
+
+    Args:
+        req (Request): The request object.
+        max_files (int): The maximum number of files.
+        max_fields (int): The maximum number of fields.
+        spool (Callable[[str], tuple[int, str | Path | None]]): Returns the spool settings for a field name.
+        stats (SpoolStats): The spool stats to update.
+
+    Returns:
+        FormData: The parsed form.
+    """
+    if getattr(req, '_form', None) is not None:
+        return req._form
+    # older starlette versions create the spool files inside parse() and can't be configured per field.
+    if not (req.headers.get('content-type', '').startswith('multipart/form-data')
+            and hasattr(StarletteMultiPartParser, 'on_headers_finished')):
+        return await req.form(max_files=max_files, max_fields=max_fields)
+    try:
+        parser = MultiPartParser(req.headers, req.stream(), max_files=max_files, max_fields=max_fields, spool=spool,
+                                 stats=stats)
+        req._form = await parser.parse()
+    except MultiPartException as exc:
+        raise HTTPException(status_code=400, detail=exc.message)
+    return req._form
@@ -0,0 +1,172 @@
+"""
+An embedded SQLite index of stored files.
+"""
+import time
+import sqlite3
+import threading
+from logging import getLogger
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+from .structs import FileData
+from .util import to_thread
+
+logger = getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL DEFAULT '',
+    url TEXT NOT NULL DEFAULT '',
+    filename TEXT NOT NULL DEFAULT '',
+    size INTEGER NOT NULL DEFAULT 0,
+    content_type TEXT NOT NULL DEFAULT '',
+    field_name TEXT NOT NULL DEFAULT '',
+    checksum TEXT NOT NULL DEFAULT '',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+DROP INDEX IF EXISTS files_location;
+CREATE UNIQUE INDEX IF NOT EXISTS files_stored_at ON files (path, url) WHERE path != '' OR url != '';
+CREATE INDEX IF NOT EXISTS files_field_name ON files (field_name, created_at);
+CREATE INDEX IF NOT EXISTS files_checksum ON files (checksum) WHERE checksum != '';
+CREATE INDEX IF NOT EXISTS files_created_at ON files (created_at);
+"""
+
+UPSERT = """
+INSERT INTO files (path, url, filename, size, content_type, field_name, checksum, created_at, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (path, url) WHERE path != '' OR url != '' DO UPDATE SET filename = excluded.filename, size = excluded.size,
+    content_type = excluded.content_type, field_name = excluded.field_name, checksum = excluded.checksum,
+    updated_at = excluded.updated_at
+"""
+
+COLUMNS = ('id', 'path', 'url', 'filename', 'size', 'content_type', 'field_name', 'checksum', 'created_at',
+           'updated_at')
+
+
+class FileIndex:
+    """An index of stored files in an SQLite database in WAL mode, so queries don't block the batched writes.
+    Pass an instance as the index config key of a store to record the files of every request after the response is
+    sent. Files are keyed by path and url, storing a file again updates its entry. Files without a path or url, such as
+    those kept in memory, get an entry each time they are stored. The database is opened on first use, so an index can
+    be created at import time.
+
+    Args:
+        database (str | Path): The path of the database file.
+    """
+
+    def __init__(self, database: Union[str, Path]):
+        self.database = str(database)
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open the database and create the schema if it is not open yet. Call with the lock held."""
+        if self._connection is None:
+            connection = sqlite3.connect(self.database, check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def add_many(self, files: Iterable[FileData]) -> int:
+        """Record a batch of files in a single transaction. Failed uploads are skipped.
+
+        Args:
+            files (Iterable[FileData]): The results of storage operations.
+
+        Returns:
+            int: The number of files recorded.
+        """
+        now = time.time()
+        rows = [(file.path, file.url, file.filename, file.size or 0, file.content_type or '', file.field_name,
+                 file.checksum, now, now) for file in files if file.status]
+        if not rows:
+            return 0
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN')
+            try:
+                connection.executemany(UPSERT, rows)
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        return len(rows)
+
+    async def add(self, files: Iterable[FileData]) -> int:
+        """Record a batch of files without blocking the event loop.
+
+        Args:
+            files (Iterable[FileData]): The results of storage operations.
+
+        Returns:
+            int: The number of files recorded.
+        """
+        try:
+            return await to_thread(self.add_many, list(files))
+        except sqlite3.Error as err:
+            logger.error(f'Error indexing files: {err} in {self.__class__.__name__}')
+            return 0
+
+    def query(self, *, field_name: str = None, checksum: str = None, path: str = None, url: str = None,
+              content_type: str = None, since: float = None, until: float = None, limit: int = 100,
+              offset: int = 0) -> List[FileData]:
+        """Find indexed files, newest first. All the given filters must match.
+
+        Args:
+            field_name (str): The name of the form field.
+            checksum (str): The checksum of the file.
+            path (str): The local path of the file.
+            url (str): The url of the file.
+            content_type (str): The content type of the file.
+            since (float): Only files stored at or after this timestamp.
+            until (float): Only files stored before this timestamp.
+            limit (int): The maximum number of files.
+            offset (int): The number of files to skip.
+
+        Returns:
+            list[FileData]: The files with their id and timestamps in the metadata.
+        """
+        filters = {'field_name = ?': field_name, 'checksum = ?': checksum, 'path = ?': path, 'url = ?': url,
+                   'content_type = ?': content_type, 'created_at >= ?': since, 'created_at < ?': until}
+        filters = {clause: value for clause, value in filters.items() if value is not None}
+        where = f"WHERE {' AND '.join(filters)}" if filters else ''
+        sql = f"SELECT {', '.join(COLUMNS)} FROM files {where} ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?"
+        with self._lock:
+            rows = self._connect().execute(sql, (*filters.values(), limit, offset)).fetchall()
+        files = []
+        for row in rows:
+            record = dict(zip(COLUMNS, row))
+            metadata = {key: record.pop(key) for key in ('id', 'created_at', 'updated_at')}
+            files.append(FileData(**record, metadata=metadata, message='Indexed file'))
+        return files
+
+    async def find(self, **filters) -> List[FileData]:
+        """Find indexed files without blocking the event loop. See query for the filters.
+
+        Returns:
+            list[FileData]: The matching files.
+        """
+        return await to_thread(lambda: self.query(**filters))
+
+    async def exists(self, checksum: str) -> Optional[FileData]:
+        """Find a stored file with the given checksum.
+
+        Args:
+            checksum (str): The checksum of the file.
+
+        Returns:
+            FileData | None: The newest file with the checksum or None.
+        """
+        files = await self.find(checksum=checksum, limit=1)
+        return files[0] if files else None
+
+    def close(self):
+        """Close the database connection. The index opens it again when it is next used."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
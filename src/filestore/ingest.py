@@ -0,0 +1,413 @@
+"""
+Bulk ingestion of files outside of a request. A directory tree or a manifest of files is uploaded through a storage
+engine with bounded concurrency, and every stored file is checkpointed so an interrupted run resumes where it stopped.
+
+Example:
+    python -m filestore.ingest /data/archive --engine s3 --bucket archive --destination imports --concurrency 128 \\
+        --checkpoint archive.ckpt
+"""
+import os
+import csv
+import sys
+import json
+import time
+import fnmatch
+import posixpath
+import asyncio
+import sqlite3
+import argparse
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import islice
+from logging import getLogger
+from pathlib import Path, PurePosixPath
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Type, Union
+
+from starlette.datastructures import Headers
+
+from .structs import Config, FileData, FileField, UploadFile
+from .storage_engines import StorageEngine, LocalEngine, ReplicatedEngine
+from .util import to_thread
+
+logger = getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingested (
+    key TEXT PRIMARY KEY,
+    status INTEGER NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    location TEXT NOT NULL DEFAULT '',
+    error TEXT NOT NULL DEFAULT '',
+    updated_at REAL NOT NULL
+);
+"""
+
+
+@dataclass
+class IngestItem:
+    """A file to ingest.
+
+    Attributes:
+        path (Path): The path of the file to read.
+        key (str): The name of the file relative to the source, the filename of the upload and its checkpoint key.
+        size (int | None): The size of the file if known.
+        destination (str | None): The path or object name of the stored file, relative to the destination config.
+    """
+    path: Path
+    key: str
+    size: Optional[int] = None
+    destination: Optional[str] = None
+
+
+def walk(directory: Union[str, Path], pattern: str = '*', follow_symlinks: bool = False) -> Iterator[IngestItem]:
+    """Walk a directory tree with os.scandir, which gets the sizes from the directory entries without a stat call
+    per file on most platforms. Hidden files are skipped.
+
+    Args:
+        directory (str | Path): The root of the tree.
+        pattern (str): A glob pattern the filenames must match.
+        follow_symlinks (bool): Follow symbolic links to files and directories.
+
+    Yields:
+        IngestItem: The files of the tree, keyed by their path relative to the root.
+    """
+    root = Path(directory)
+    stack = [root]
+    while stack:
+        folder = stack.pop()
+        try:
+            entries = list(os.scandir(folder))
+        except OSError as err:
+            logger.error(f'Error reading {folder}: {err}')
+            continue
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+                stack.append(Path(entry.path))
+            elif entry.is_file(follow_symlinks=follow_symlinks) and fnmatch.fnmatch(entry.name, pattern):
+                path = Path(entry.path)
+                yield IngestItem(path=path, key=str(PurePosixPath(*path.relative_to(root).parts)),
+                                 size=entry.stat(follow_symlinks=follow_symlinks).st_size)
+
+
+def read_manifest(manifest: Union[str, Path], base: Union[str, Path, None] = None) -> Iterator[IngestItem]:
+    """Read the files to ingest from a manifest. A .jsonl manifest has an object per line and a .csv manifest a
+    header row, both with a path and optionally a key and destination for each file. Any other manifest has a path per
+    line. Relative paths are relative to base, the folder of the manifest by default.
+
+    Args:
+        manifest (str | Path): The manifest file.
+        base (str | Path | None): The folder relative paths are resolved against.
+
+    Yields:
+        IngestItem: The files of the manifest.
+    """
+    manifest = Path(manifest)
+    base = Path(base) if base is not None else manifest.parent
+
+    def item(path: str, key: str = None, destination: str = None) -> IngestItem:
+        return IngestItem(path=base / path, key=key or path.lstrip('/'), destination=destination or None)
+
+    with open(manifest, newline='') as fh:
+        if manifest.suffix == '.jsonl':
+            for line in fh:
+                if line.strip():
+                    row = json.loads(line)
+                    yield item(row['path'], row.get('key'), row.get('destination'))
+        elif manifest.suffix == '.csv':
+            for row in csv.DictReader(fh):
+                yield item(row['path'], row.get('key'), row.get('destination'))
+        else:
+            for line in fh:
+                if line := line.strip():
+                    yield item(line)
+
+
+class Checkpoint:
+    """The outcome of every ingested file in an SQLite database, so a run can be resumed without uploading the stored
+    files again. Outcomes are written in batches in a worker thread.
+
+    Attributes:
+        path (Path): The path of the database.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+
+    def done(self, keys: List[str], retry_failed: bool = True) -> Set[str]:
+        """The keys of a batch that were already ingested, and that failed unless retry_failed."""
+        found = set()
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start: start + 500]
+                query = f'SELECT key FROM ingested WHERE key IN ({", ".join("?" * len(chunk))})'
+                query += ' AND status = 1' if retry_failed else ''
+                found.update(key for (key,) in self._db.execute(query, chunk))
+        return found
+
+    def record(self, items: List[IngestItem], results: List[FileData]):
+        """Record the outcome of a batch of files in one transaction."""
+        now = time.time()
+        rows = [(item.key, int(result.status), result.size or 0, result.path or result.url, result.error, now)
+                for item, result in zip(items, results)]
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO ingested VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def counts(self) -> dict:
+        """The number of stored and failed files."""
+        with self._lock:
+            rows = dict(self._db.execute('SELECT status, COUNT(*) FROM ingested GROUP BY status').fetchall())
+        return {'stored': rows.get(1, 0), 'failed': rows.get(0, 0)}
+
+    def failed(self) -> List[tuple]:
+        """The keys and errors of the files that failed."""
+        with self._lock:
+            return self._db.execute('SELECT key, error FROM ingested WHERE status = 0 ORDER BY key').fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+@dataclass
+class IngestStats:
+    """The progress of a run.
+
+    Attributes:
+        stored (int): The files stored.
+        failed (int): The files that failed.
+        skipped (int): The files skipped because the checkpoint has them.
+        bytes (int): The bytes stored.
+        started (float): The time.monotonic of the start of the run.
+        elapsed (float): The length of the run once it completed.
+    """
+    stored: int = 0
+    failed: int = 0
+    skipped: int = 0
+    bytes: int = 0
+    started: float = 0.0
+    elapsed: float = 0.0
+
+    def summary(self) -> dict:
+        elapsed = self.elapsed or time.monotonic() - self.started
+        return {'stored': self.stored, 'failed': self.failed, 'skipped': self.skipped, 'bytes': self.bytes,
+                'elapsed': round(elapsed, 3), 'files_per_second': round(self.stored / elapsed, 2) if elapsed else 0.0,
+                'mb_per_second': round(self.bytes / elapsed / 1024 ** 2, 2) if elapsed else 0.0}
+
+
+class BulkIngest:
+    """Upload many files through a storage engine outside of a request. The source is read in batches in a worker
+    thread, files already in the checkpoint are skipped, and a fixed number of workers upload the rest through one
+    engine, so at most concurrency files are open at once however large the source is. The outcomes are checkpointed
+    in batches as they complete.
+
+    Example:
+        ingest = BulkIngest(storage=S3Engine, config={'bucket': 'archive', 'destination': 'imports'},
+                            concurrency=128, checkpoint='archive.ckpt')
+        stats = await ingest.run(walk('/data/archive'))
+
+    Attributes:
+        storage (Type[StorageEngine] | list[Type[StorageEngine]]): The engine, a list of engines replicates the files.
+        config (Config): The config of the files, as the config of a store.
+        concurrency (int): The number of files uploaded at once.
+        checkpoint (Checkpoint | None): The checkpoint of the run.
+        field_name (str): The field name of the FileData of the files.
+        retry_failed (bool): Upload the files that failed in an earlier run again.
+        progress (Callable[[IngestStats], None] | None): Called with the stats every progress_interval seconds.
+        progress_interval (float): The seconds between progress reports.
+        stats (IngestStats): The progress of the current run.
+    """
+
+    def __init__(self, storage: Union[Type[StorageEngine], List[Type[StorageEngine]]] = LocalEngine,
+                 config: Config = None, *, concurrency: int = 64, checkpoint: Union[str, Path, Checkpoint] = None,
+                 field_name: str = 'file', retry_failed: bool = True,
+                 progress: Optional[Callable[[IngestStats], None]] = None, progress_interval: float = 10.0):
+        self.storage = storage
+        self.config = {key: value for key, value in (config or {}).items() if key != 'background'}
+        self.concurrency = concurrency
+        self.checkpoint = checkpoint if isinstance(checkpoint, Checkpoint) or checkpoint is None \
+            else Checkpoint(checkpoint)
+        self.field_name = field_name
+        self.retry_failed = retry_failed
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.stats = IngestStats()
+        self._done: List[tuple] = []
+        self._reported = 0.0
+
+    def engine(self) -> StorageEngine:
+        """Create the engine shared by the workers of a run."""
+        if isinstance(self.storage, (list, tuple)):
+            return ReplicatedEngine(engines=self.storage)
+        return self.storage()
+
+    def file_field(self, item: IngestItem) -> FileField:
+        """Build the FileField of a file, opening the file."""
+        content_type = mimetypes.guess_type(item.key)[0] or 'application/octet-stream'
+        file = UploadFile(file=open(item.path, 'rb'), size=item.size if item.size is not None else
+                          os.path.getsize(item.path), filename=item.key,
+                          headers=Headers({'content-type': content_type}))
+        file_field = {'name': self.field_name, 'file': file, 'config': self.config}
+        if item.destination is not None:
+            # a relative destination is under the destination config, a folder of the bucket or of the local disk.
+            folder = self.config.get('destination')
+            file_field['destination'] = posixpath.join(str(folder), item.destination) \
+                if folder and not callable(folder) else item.destination
+        return file_field
+
+    async def upload(self, engine: StorageEngine, item: IngestItem) -> FileData:
+        """Upload a file, a file that fails is returned as a failed FileData."""
+        file_field = None
+        try:
+            file_field = self.file_field(item)
+            return await engine.upload(file_field=file_field)
+        except Exception as err:
+            logger.error(f'Error ingesting {item.path}: {err} in {self.__class__.__name__}')
+            return FileData(status=False, error=str(err), field_name=self.field_name, filename=item.key,
+                            message=f'Unable to ingest {item.key}')
+        finally:
+            if file_field is not None:
+                file_field['file'].file.close()
+
+    async def _produce(self, items: Iterable[IngestItem], queue: asyncio.Queue):
+        iterator = iter(items)
+        while batch := await to_thread(lambda: list(islice(iterator, BATCH_SIZE))):
+            done = await to_thread(self.checkpoint.done, [item.key for item in batch], self.retry_failed) \
+                if self.checkpoint else set()
+            self.stats.skipped += len(done)
+            for item in batch:
+                if item.key not in done:
+                    await queue.put(item)
+
+    async def _work(self, engine: StorageEngine, queue: asyncio.Queue):
+        while (item := await queue.get()) is not None:
+            result = await self.upload(engine, item)
+            if result.status:
+                self.stats.stored += 1
+                self.stats.bytes += result.size or 0
+            else:
+                self.stats.failed += 1
+            self._done.append((item, result))
+
+    async def _flush(self):
+        done, self._done = self._done, []
+        if done and self.checkpoint:
+            await to_thread(self.checkpoint.record, *map(list, zip(*done)))
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(min(self.progress_interval, 1.0))
+            await self._flush()
+            if self.progress and time.monotonic() - self._reported >= self.progress_interval:
+                self._reported = time.monotonic()
+                self.progress(self.stats)
+
+    async def run(self, items: Iterable[IngestItem]) -> IngestStats:
+        """Ingest the files of a source.
+
+        Args:
+            items (Iterable[IngestItem]): The files to ingest, e.g. from walk or read_manifest. The iterable is read
+                in a worker thread.
+
+        Returns:
+            IngestStats: The outcome of the run.
+        """
+        self.stats = IngestStats(started=time.monotonic())
+        self._reported = self.stats.started
+        engine = self.engine()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.ensure_future(self._work(engine, queue)) for _ in range(self.concurrency)]
+        reporter = asyncio.ensure_future(self._report())
+        try:
+            await self._produce(items, queue)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in [*workers, reporter]:
+                task.cancel()
+            await self._flush()
+        self.stats.elapsed = time.monotonic() - self.stats.started
+        return self.stats
+
+
+def ingest(source: Union[str, Path], storage: Union[Type[StorageEngine], List[Type[StorageEngine]]] = LocalEngine,
+           config: Config = None, *, manifest: bool = False, pattern: str = '*', **kwargs) -> IngestStats:
+    """Ingest a directory tree or a manifest in a new event loop, with a thread pool large enough for the
+    concurrency of the run.
+
+    Args:
+        source (str | Path): A directory or a manifest file.
+        storage (Type[StorageEngine] | list[Type[StorageEngine]]): The storage engine.
+        config (Config): The config of the files.
+        manifest (bool): The source is a manifest.
+        pattern (str): A glob pattern the filenames of a directory must match.
+        **kwargs: The keyword arguments of BulkIngest.
+
+    Returns:
+        IngestStats: The outcome of the run.
+    """
+    items = read_manifest(source) if manifest else walk(source, pattern)
+    bulk = BulkIngest(storage, config, **kwargs)
+
+    async def main():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(bulk.concurrency + 8))
+        return await bulk.run(items)
+
+    try:
+        return asyncio.run(main())
+    finally:
+        bulk.checkpoint.close() if bulk.checkpoint else ...
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Upload a directory tree or a manifest of files to storage.')
+    parser.add_argument('source', help='A directory, or a manifest file with --manifest')
+    parser.add_argument('--manifest', action='store_true', help='The source is a .jsonl, .csv or plain manifest')
+    parser.add_argument('--pattern', default='*', help='A glob pattern the filenames must match')
+    parser.add_argument('--engine', choices=['local', 's3'], default='local', help='The storage engine')
+    parser.add_argument('--destination', default='', help='The folder, or S3 prefix, of the files')
+    parser.add_argument('--bucket', help='The S3 bucket')
+    parser.add_argument('--region', help='The S3 region')
+    parser.add_argument('--durability', choices=['none', 'fsync', 'group'], help='The durability of local files')
+    parser.add_argument('--checksum', help='A hashlib algorithm to compute the checksums of local files with')
+    parser.add_argument('--concurrency', type=int, default=64, help='The number of files uploaded at once')
+    parser.add_argument('--checkpoint', help='The checkpoint database, rerun with it to resume')
+    parser.add_argument('--skip-failed', action='store_true', help="Don't retry files that failed in an earlier run")
+    parser.add_argument('--field', default='file', help='The field name of the files')
+    parser.add_argument('--quiet', action='store_true', help="Don't print progress")
+    args = parser.parse_args(argv)
+
+    if args.engine == 's3':
+        from .storage_engines.s3_engine import S3Engine
+        storage = S3Engine
+    else:
+        storage = LocalEngine
+    config = {key: value for key, value in (('destination', args.destination), ('bucket', args.bucket),
+                                            ('region', args.region), ('durability', args.durability),
+                                            ('checksum', args.checksum)) if value}
+
+    def progress(stats: IngestStats):
+        print(json.dumps(stats.summary()), file=sys.stderr)
+
+    stats = ingest(args.source, storage, config, manifest=args.manifest, pattern=args.pattern,
+                   concurrency=args.concurrency, checkpoint=args.checkpoint, field_name=args.field,
+                   retry_failed=not args.skip_failed, progress=None if args.quiet else progress)
+    print(json.dumps(stats.summary(), indent=2))
+    if stats.failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,12 @@
 """This module contains the main classes and methods for the filestore package."""
 
+import time
 import asyncio
-from typing import Type, TypeVar, List, Dict, Union
+from typing import Type, TypeVar, List, Dict, Union, Callable, AsyncIterator, Awaitable
 from abc import abstractmethod
 from logging import getLogger
 from random import randint
+from functools import partial
 
 from starlette.datastructures import UploadFile as StarletteUploadFile, FormData
 from fastapi import Request, BackgroundTasks
@@ -14,18 +16,25 @@ from pydantic import create_model, Field, BaseModel as FormModel
 from .structs import FileField, FileData, Store, Config, cache, UploadFile
 from .storage_engines import StorageEngine
 from .exceptions import FileStoreError
+from .forms import parse_form, SpoolStats
+from .plan import StorePlan, passthrough
+from .cancellation import RequestWatch
+from .callbacks import call, gather_calls
+from .archive import extract, is_archive, NotAnArchive
 
 logger = getLogger(__name__)
 Self = TypeVar('Self', bound='FastStore')
 
 
-def _file_filter(file):
-    return isinstance(file, StarletteUploadFile) and file.filename
+def _same(file):
+    return file
 
 
+@passthrough
 def file_filter(req: Request, form: FormData, field: str, file: UploadFile) -> bool:
     """
-    The default config filter function for the FastStore class. This filter applies to all fields.
+    The default config filter function for the FastStore class. This filter applies to all fields. It accepts every
+    file, so the store plan never calls it.
 
     Args:
         req (Request): The request object.
@@ -38,9 +47,10 @@ def file_filter(req: Request, form: FormData, field: str, file: UploadFile) -> b
     return True
 
 
+@passthrough
 def filename(req: Request, form: FormData, field: str, file: UploadFile) -> UploadFile:
     """
-    Update the filename of the file object.
+    Update the filename of the file object. The default keeps the filename, so the store plan never calls it.
 
     Args:
         req (Request): The request object.
@@ -53,6 +63,111 @@ def filename(req: Request, form: FormData, field: str, file: UploadFile) -> Uplo
     return file
 
 
+def in_background(file_fields: List[FileField]) -> bool:
+    """If any of the files is stored with the background config, after the response is sent."""
+    return any(file_field['config'].get('background') for file_field in file_fields)
+
+
+async def collect_files(req: Request, form: FormData, plan: StorePlan) -> List[FileField]:
+    """
+    Collect the files of the form for the fields of a plan. The form is walked once, then the filter and filename
+    functions of the files are called with sync functions called in place and async functions awaited concurrently.
+    The batch destination functions are called once for all the files that share them. Archives of fields with the
+    extract config are kept as they are, their entries are read when the files are stored, see store_files.
+
+    Args:
+        req (Request): The request object.
+        form (FormData): The form data object.
+        plan (StorePlan): The compiled fields of the store.
+
+    Returns:
+        list[FileField]: A FileField for each accepted file.
+    """
+    candidates = plan.dispatch(form)
+    if filtered := [index for index, (field, _) in enumerate(candidates) if field.filter is not None]:
+        keep = await gather_calls([(candidates[index][0].filter, (req, form, candidates[index][0].name,
+                                                                   candidates[index][1])) for index in filtered])
+        rejected = {index for index, kept in zip(filtered, keep) if not kept}
+        candidates = [candidate for index, candidate in enumerate(candidates) if index not in rejected]
+    files = await gather_calls([(field.filename, (req, form, field.name, file)) if field.filename else
+                                (_same, (file,)) for field, file in candidates])
+    file_fields: List[Union[FileField, Dict]] = [field.file_field(file) for (field, _), file in zip(candidates, files)]
+    await batch_destinations(req, form, [file_field for file_field in file_fields if not is_archive(file_field)])
+    return file_fields
+
+
+async def batch_destinations(req: Request, form: FormData, file_fields: List[FileField]):
+    """Set the destination of the file fields with a batch_destination config, calling each function once for all
+    the files that share it.
+
+    Args:
+        req (Request): The request object.
+        form (FormData): The form data object.
+        file_fields (list[FileField]): The file fields.
+    """
+    batches: Dict[Callable, List[FileField]] = {}
+    for file_field in file_fields:
+        if batch := file_field['config'].get('batch_destination'):
+            batches.setdefault(batch, []).append(file_field)
+    results = await asyncio.gather(*[call(batch, req, form, group) for batch, group in batches.items()])
+    for group, destinations in zip(batches.values(), results):
+        if len(destinations) != len(group):
+            raise FileStoreError(f'Expected {len(group)} destinations from batch destination, got {len(destinations)}')
+        for file_field, destination in zip(group, destinations):
+            file_field['destination'] = destination
+
+
+async def store_files(req: Request, form: FormData, file_fields: List[FileField],
+                      upload_many: Callable[[List[FileField]], Awaitable[List[FileData]]],
+                      record: Callable[[FileData], None] = None) -> List[FileData]:
+    """
+    Store the files of a request with an upload function. Archives of fields with the extract config are read as a
+    stream and their entries are uploaded as they are read, a few at a time, with the batch destination called for
+    each entry alone, while the other files and archives are stored concurrently. A file that is not an archive gets
+    a failed FileData. If an archive fails the others are cancelled and closed before the error is raised.
+
+    Args:
+        req (Request): The request object.
+        form (FormData): The form data object.
+        file_fields (list[FileField]): The file fields from collect_files.
+        upload_many (Callable[[list[FileField]], Awaitable[list[FileData]]]): Upload file fields and return their
+            results in order.
+        record (Callable[[FileData], None]): Record the failed result of a file that is not an archive, for stores
+            whose upload functions record the results they return.
+
+    Returns:
+        list[FileData]: The results of the files followed by the results of the archive entries.
+    """
+    files = [file_field for file_field in file_fields if not is_archive(file_field)]
+    if len(files) == len(file_fields):
+        return await upload_many(files)
+
+    async def upload_entry(entry: FileField) -> FileData:
+        await batch_destinations(req, form, [entry])
+        return (await upload_many([entry]))[0]
+
+    async def upload_archive(file_field: FileField) -> List[FileData]:
+        try:
+            return await extract(file_field, upload_entry)
+        except NotAnArchive as err:
+            result = FileData(status=False, filename=file_field['file'].filename, field_name=file_field['name'],
+                              error=str(err), message=f'Unable to extract {file_field["file"].filename}')
+            record(result) if record else ...
+            return [result]
+
+    tasks = [asyncio.ensure_future(upload_many(files))] if files else []
+    tasks.extend(asyncio.ensure_future(upload_archive(file_field)) for file_field in file_fields
+                 if is_archive(file_field))
+    try:
+        groups = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return [result for group in groups for result in group]
+
+
 class FastStore:
     """
     The base class for the FastStore package. It is an abstract class and must be inherited from for custom file
@@ -69,6 +184,8 @@ class FastStore:
         engine (StorageEngine): The storage engine instance for the file storage service.
         StorageEngine (Type[StorageEngine]): The storage engine class for the file storage service.
         background_tasks (BackgroundTasks): The background tasks object for running tasks in the background.
+        spool_stats (SpoolStats): Counts of spooled files and rollovers to disk by field name.
+        plan (StorePlan): The fields and config compiled when the store is created.
 
     Methods:
         upload (Callable[[FileField]]): The method to upload a single file.
@@ -89,11 +206,55 @@ class FastStore:
         filter (Callable[[Request, FormData, str, UploadFile], bool]): A function that takes in the request,
             form and file and returns a boolean.
 
+        batch_destination (Callable[[Request, FormData, list[FileField]], list[str | Path]]): A function that takes
+            in the request, form and all the file fields that use it and returns their destinations in order.
+            It takes precedence over destination.
+
+        The filename, destination, filter and batch_destination functions can also be coroutine functions.
+
         background (bool): A boolean to indicate if the file storage operation should be run in the background.
 
         extra_args (dict): Extra arguments to pass to the storage service.
 
         bucket (str): The name of the bucket to upload the file to in the cloud storage service.
+
+        admission (AdmissionController): Shed load before reading the body when the bytes or uploads in flight in
+            the process exceed its budgets.
+
+        extract (bool): Extract uploaded zip and tar archives and store each file entry instead of the archive.
+
+        extract_max_entries (int): The maximum number of file entries in an extracted archive. Defaults to 10000.
+
+        extract_max_size (int): The maximum total expanded size of an extracted archive. Defaults to 1GB.
+        extract_concurrency (int): The number of entries of an extracted archive uploaded at a time. Defaults to 4.
+
+        checksum (str): The name of a hashlib algorithm e.g. sha256 used to compute the checksum of stored files.
+
+        index (FileIndex): Record the stored files in a FileIndex after the response is sent.
+
+        retry (RetryPolicy): Retry, hedge and circuit break the calls of the S3Engine.
+
+        limiter (AdaptiveLimiter): Adapt the number of S3Engine uploads in flight. Opt-in, defaults to the
+            S3Engine.limiter class attribute, which is None unless set.
+
+        spool_max_size (int): Uploaded files larger than this are spooled to disk, smaller ones are kept in memory.
+            Zero keeps every file in memory. Defaults to 1MB.
+
+        spool_dir (str | Path): The directory for files spooled to disk. Defaults to the system temporary directory.
+
+        defer (bool): Collect the files without storing them, the uploads run when the handler iterates over
+            iter_uploads.
+
+        durability (str): How local files are flushed to disk before they are reported as saved. One of none, fsync or
+            group. Defaults to none.
+
+        deadline (float): Seconds from the start of the request after which the uploads still in flight are
+            cancelled and the store fails.
+
+        cancel_on_disconnect (bool): Cancel the uploads in flight when the client disconnects. Defaults to True.
+
+        scheduler (UploadScheduler): Run the uploads in the slots of a scheduler shared by the requests of the
+            process, fair between tenants and smallest file first.
     """
     fields: List[FileField]
     config: Config
@@ -129,6 +290,8 @@ class FastStore:
         self.fields.append(field) if field else ...
         self.config = {'filter': file_filter, 'max_files': 1000, 'max_fields': 1000, 'filename': filename,
                        'background': False, **(config or {})}
+        self.spool_stats = SpoolStats()
+        self.plan = StorePlan.compile(self.fields, self.config)
 
     @property
     @cache
@@ -162,57 +325,189 @@ class FastStore:
         Returns:
             FastStore: An instance of the FastStore class.
         """
+        start = time.monotonic()
         self._store = Store()
         self.request = req
         self.background_tasks = bgt
+        admission = self.config.get('admission')
+        admitted = admission.admit(req) if admission else False
+        # the budget of uploads that outlive the dependency is released when they are done.
+        held = False
         try:
-            max_files, max_fields = self.config['max_files'], self.config['max_fields']
-            form = await req.form(max_files=max_files, max_fields=max_fields)
+            plan = self.plan
+            form = await parse_form(req, max_files=plan.max_files, max_fields=plan.max_fields, spool=plan.spool,
+                                    stats=self.spool_stats)
             self.form = form
             self.engine = self.StorageEngine(request=req, form=form, background_tasks=bgt)
-            file_fields: List[Union[FileField, Dict]] = []
-            for field in self.fields:
-                name = field['name']
-                count = field.get('max_count', None)
-                files = form.getlist(name)[: count]
-                field['config'] = {**self.config, **field.get('config', {})}
-                for file in files:
-                    config = field['config']
-                    _filter = config.get('filter', file_filter)
-                    if not (_file_filter(file) and _filter(req, form, name, file)): continue
-                    file_dict = {**field, 'file': config.get('filename', filename)(req, form, name, file)}
-                    file_fields.append(file_dict)
+            file_fields = await collect_files(req, form, plan)
 
             self.file_count = len(file_fields)
             if not file_fields:
                 self._store = Store(message='No files were uploaded')
                 return self
 
-            elif len(file_fields) == 1:
-                await self.upload(file_field=file_fields[0])
+            elif self.config.get('defer'):
+                # kept in the state of the request, the store is shared by the requests in flight.
+                deferred = getattr(req.state, 'deferred_uploads', {})
+                deferred[id(self)] = file_fields, start, form, bgt
+                req.state.deferred_uploads = deferred
+                if held := admitted:
+                    req.state.admission_held = True
+                    bgt.add_task(self._release_unused, req)
+                return self
+
+            async with self.watch(req, form, start):
+                if len(file_fields) == 1 and not is_archive(file_fields[0]):
+                    await self.upload(file_field=file_fields[0])
+                else:
+                    await store_files(req, form, file_fields, self._upload_many, self._record)
 
-            else:
-                await self.multi_upload(file_fields=file_fields)
+            if index := self.config.get('index'):
+                bgt.add_task(index.add, [file for files in self._store.files.values() for file in files])
+            if held := admitted and in_background(file_fields):
+                bgt.add_task(admission.release, req.scope)
         except FileStoreError as err:
             logger.error(f'Error uploading files: {err} in {self.__class__.__name__}')
             self._store = Store(error=str(err), status=False)
+        finally:
+            admission.release(req.scope) if admitted and not held else ...
         return self
 
+    def _release_unused(self, req: Request):
+        # a deferred request whose handler never iterated over its uploads.
+        if getattr(req.state, 'admission_held', False):
+            req.state.admission_held = False
+            self.config['admission'].release(req.scope)
+
+    def _release_held(self, req: Request, file_fields: List[FileField], bgt: BackgroundTasks):
+        if not getattr(req.state, 'admission_held', False):
+            return
+        req.state.admission_held = False
+        if in_background(file_fields) and bgt is not None:
+            bgt.add_task(self.config['admission'].release, req.scope)
+        else:
+            self.config['admission'].release(req.scope)
+
+    def watch(self, req: Request, form: FormData, start: float) -> RequestWatch:
+        """Watch the storage work of a request for a client disconnect and the deadline config.
+
+        Args:
+            req (Request): The request object.
+            form (FormData): The form of the request, closed if the uploads are cancelled.
+            start (float): The time.monotonic of the start of the request.
+
+        Returns:
+            RequestWatch: The watch to run the uploads in.
+        """
+        return RequestWatch(req, deadline=self.config.get('deadline'), start=start, form=form,
+                            disconnect=self.config.get('cancel_on_disconnect', True))
+
     @abstractmethod
-    async def upload(self, *, file_field: FileField):
-        """Upload a single file to a storage service.
+    async def upload(self, *, file_field: FileField) -> FileData:
+        """Upload a single file to a storage service. Implementations set the store with the result and return it.
 
         Args:
             file_field (FileField): A FileField dictionary instance.
+
+        Returns:
+            FileData: The result of the upload.
         """
-    async def multi_upload(self, *, file_fields: List[FileField]):
+
+    async def iter_uploads(self, request: Request = None) -> AsyncIterator[FileData]:
         """
-        Upload multiple files to a storage service.
+        Yield the result of each file as soon as it is stored. With the defer config the uploads of the request start
+        here and run concurrently, so a handler can act on the first files while larger ones are still uploading.
+        Without it the files were stored before the handler was called and their results are yielded in turn.
+        Breaking out of the loop cancels the uploads still in flight. The uploads are watched like those of a request
+        without defer, at the deadline or when the client disconnects they are cancelled, the loop ends and the store
+        fails with the reason. With the index config each file is recorded before it is yielded, files stored in the
+        background are recorded once their upload is done.
+
+        Args:
+            request (Request): The request of the uploads. Defaults to the request the store was last called with.
+
+        Yields:
+            FileData: The result of an upload, in order of completion.
+        """
+        request = request or self.request
+        # the form and background tasks of the request, the store holds those of the request it was last called with.
+        file_fields, start, form, bgt = getattr(request.state, 'deferred_uploads', {}).pop(id(self),
+                                                                                            ([], 0.0, None, None))
+        if not file_fields:
+            for files in (self._store.files, self._store.failed):
+                for file_data in [file_data for group in files.values() for file_data in group]:
+                    yield file_data
+            return
+        archives = [file_field for file_field in file_fields if is_archive(file_field)]
+        file_fields = [file_field for file_field in file_fields if not is_archive(file_field)]
+        if scheduler := self.config.get('scheduler'):
+            tenant = scheduler.tenant(request)
+            uploads = [scheduler.run(tenant, scheduler.size(file_field), partial(self.upload, file_field=file_field))
+                       for file_field in sorted(file_fields, key=scheduler.size)]
+        else:
+            uploads = [self.upload(file_field=file_field) for file_field in file_fields]
+        # the results of the entries of an archive are yielded when the archive is done.
+        uploads.extend(store_files(request, form, [archive], self._upload_many, self._record)
+                       for archive in archives)
+        tasks = [asyncio.ensure_future(upload) for upload in uploads]
+        watch = self.watch(request, form, start)
+        watcher = asyncio.ensure_future(self._watch_uploads(watch, tasks))
+        index = self.config.get('index')
+        # files stored in the background are recorded after their upload task, which marks them failed if it fails.
+        background = {file_field['name'] for file_field in archives + file_fields
+                      if file_field['config'].get('background')} if bgt is not None else set()
+        try:
+            for task in asyncio.as_completed(tasks):
+                try:
+                    result = await task
+                except asyncio.CancelledError:
+                    if not watch.reason:
+                        raise
+                    self._store.status, self._store.error = False, watch.reason
+                    break
+                for file_data in result if isinstance(result, list) else [result]:
+                    if index and file_data.field_name in background:
+                        bgt.add_task(index.add, [file_data])
+                    elif index:
+                        await index.add([file_data])
+                    yield file_data
+        finally:
+            watcher.cancel()
+            for task in tasks:
+                task.cancel()
+            self._release_held(request, archives + file_fields, bgt)
+
+    def _record(self, file_data: FileData):
+        self.store = file_data
+
+    @staticmethod
+    async def _watch_uploads(watch: RequestWatch, tasks: List[asyncio.Future]):
+        # the watch cancels this task at the deadline or on a disconnect, which cancels the uploads it waits for.
+        try:
+            async with watch:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except FileStoreError:
+            pass
+
+    async def multi_upload(self, *, file_fields: List[FileField]) -> List[FileData]:
+        """
+        Upload multiple files to a storage service. With the scheduler config the uploads run in the slots of the
+        UploadScheduler, smallest first.
 
         Args:
             file_fields (list[FileField]): A list of FileFields to upload.
+
+        Returns:
+            list[FileData]: The results in the order of the file fields.
         """
-        await asyncio.gather(*[self.upload(file_field=file_field) for file_field in file_fields])
+        if scheduler := self.config.get('scheduler'):
+            return await scheduler.gather(self.request, [(scheduler.size(file_field),
+                                                          partial(self.upload, file_field=file_field))
+                                                         for file_field in file_fields])
+        return await asyncio.gather(*[self.upload(file_field=file_field) for file_field in file_fields])
+
+    async def _upload_many(self, file_fields: List[FileField]) -> List[FileData]:
+        return await self.multi_upload(file_fields=file_fields)
 
     @property
     def store(self) -> Store:
@@ -225,7 +520,9 @@ class FastStore:
         success = sum(len(files) for files in self._store.files.values())
         failed = sum(len(files) for files in self._store.failed.values())
         self._store.message = f'{success} files uploaded successfully' if success else ''
-        self._store.error = f'{failed} file(s) not uploaded' if failed else ''
+        # keep the error of a store that failed as a whole e.g. at the deadline.
+        if failed or self._store.status:
+            self._store.error = f'{failed} file(s) not uploaded' if failed else ''
         return self._store
 
     @store.setter
@@ -15,11 +15,12 @@ class MemoryStorage(FastStore):
     StorageEngine = MemoryEngine
 
     # noinspection PyTypeChecker
-    async def upload(self, *, file_field: FileField):
+    async def upload(self, *, file_field: FileField) -> FileData:
         try:
             file_data = await self.engine.upload(file_field=file_field)
-            self.store = file_data
         except FileStoreError as err:
             logger.error(f'Error Saving file to Memory: {err} in {self.__class__.__name__}')
-            self.store = FileData(status=False, error='Something went wrong', field_name=file_field['name'],
-                                  message=f'Unable to upload {file_field["name"]}')
\ No newline at end of file
+            file_data = FileData(status=False, error='Something went wrong', field_name=file_field['name'],
+                                 message=f'Unable to upload {file_field["name"]}')
+        self.store = file_data
+        return file_data
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""
+The field plan of a store. The fields and config of a store are compiled once into an immutable plan with the merged
+config and the callbacks of every field and a lookup table by field name, so the form of a request is dispatched to
+the fields in a single pass without building configs again. Callbacks marked with passthrough accept every file or
+keep it as it is, they are compiled to None and never called.
+"""
+from dataclasses import dataclass, field as dataclass_field
+from types import MappingProxyType
+from typing import Callable, List, Mapping, Optional, Set, Tuple
+
+from starlette.datastructures import FormData, UploadFile as StarletteUploadFile
+
+from .structs import FileField, Config, UploadFile
+from .forms import spool_settings, SpoolSettings
+
+PASSTHROUGH: Set[Callable] = set()
+
+
+def passthrough(func: Callable) -> Callable:
+    """Mark a filter function that accepts every file or a filename function that returns the file unchanged.
+
+    Args:
+        func (Callable): The callback.
+
+    Returns:
+        Callable: The callback.
+    """
+    PASSTHROUGH.add(func)
+    return func
+
+
+def _callback(func: Optional[Callable]) -> Optional[Callable]:
+    return None if func in PASSTHROUGH else func
+
+
+@dataclass(frozen=True)
+class FieldPlan:
+    """The compiled form of a file field.
+
+    Attributes:
+        name (str): The name of the field.
+        max_count (int | None): The maximum number of files accepted for the field.
+        required (bool): If the field is required.
+        template (Mapping): The file field with its merged config, copied into the FileField of each file.
+        config (Mapping): The store config merged with the field config.
+        filter (Callable | None): The filter function, None accepts every file.
+        filename (Callable | None): The filename function, None keeps the filenames.
+        extract (bool): If archives uploaded to the field are extracted.
+        spool (tuple[int, str | Path | None]): The spool settings of the field.
+    """
+    name: str
+    max_count: Optional[int]
+    required: bool
+    template: Mapping
+    config: Mapping
+    filter: Optional[Callable]
+    filename: Optional[Callable]
+    extract: bool
+    spool: SpoolSettings
+
+    def file_field(self, file: UploadFile) -> FileField:
+        """Build the FileField of an uploaded file."""
+        return {**self.template, 'file': file}
+
+
+@dataclass(frozen=True)
+class StorePlan:
+    """The compiled fields of a store.
+
+    Attributes:
+        fields (tuple[FieldPlan]): The plans of the fields in order.
+        lookup (Mapping[str, tuple[FieldPlan]]): The plans by field name. A name declared more than once has a plan
+            for each declaration and its files are collected for every one of them.
+        max_files (int): The maximum number of files in a request.
+        max_fields (int): The maximum number of fields in a request.
+        default_spool (tuple[int, str | Path | None]): The spool settings of fields without a plan.
+    """
+    fields: Tuple[FieldPlan, ...]
+    lookup: Mapping[str, Tuple[FieldPlan, ...]]
+    max_files: int = 1000
+    max_fields: int = 1000
+    default_spool: SpoolSettings = dataclass_field(default=spool_settings({}))
+
+    @classmethod
+    def compile(cls, fields: List[FileField], config: Config) -> 'StorePlan':
+        """Compile the fields and config of a store. Later changes to the fields or config are not seen by the plan.
+
+        Args:
+            fields (list[FileField]): The expected fields.
+            config (Config): The config of the store.
+
+        Returns:
+            StorePlan: The plan.
+        """
+        plans, lookup = [], {}
+        for field in fields:
+            merged = MappingProxyType({**config, **field.get('config', {})})
+            plan = FieldPlan(name=field['name'], max_count=field.get('max_count'),
+                             required=field.get('required', False), config=merged,
+                             template=MappingProxyType({**field, 'config': merged}),
+                             filter=_callback(merged.get('filter')), filename=_callback(merged.get('filename')),
+                             extract=bool(merged.get('extract')), spool=spool_settings(merged))
+            plans.append(plan)
+            lookup[plan.name] = lookup.get(plan.name, ()) + (plan,)
+        return cls(fields=tuple(plans), lookup=MappingProxyType(lookup), max_files=config.get('max_files', 1000),
+                   max_fields=config.get('max_fields', 1000), default_spool=spool_settings(config))
+
+    def spool(self, name: str) -> SpoolSettings:
+        """Get the spool settings of a field."""
+        plans = self.lookup.get(name)
+        return self.default_spool if plans is None else plans[0].spool
+
+    def dispatch(self, form: FormData) -> List[Tuple[FieldPlan, UploadFile]]:
+        """Walk the form once and pair the uploaded files with the plans of their fields, up to the max count of each
+        field. A file of a field declared more than once is paired with every declaration.
+
+        Args:
+            form (FormData): The form data.
+
+        Returns:
+            list[tuple[FieldPlan, UploadFile]]: The files in the order of the form.
+        """
+        files, counts = [], {}
+        for name, value in form.multi_items():
+            if (plans := self.lookup.get(name)) is None or not isinstance(value, StarletteUploadFile) \
+                    or not value.filename:
+                continue
+            for index, plan in enumerate(plans):
+                count = counts.get((name, index), 0)
+                if plan.max_count is None or count < plan.max_count:
+                    counts[name, index] = count + 1
+                    files.append((plan, value))
+        return files
+
+    def missing(self, form: FormData) -> List[str]:
+        """The names of the required fields missing from the form."""
+        return [plan.name for plan in self.fields if plan.required and plan.name not in form]
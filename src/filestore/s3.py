@@ -20,19 +20,20 @@ class S3Storage(FastStore):
     StorageEngine = S3Engine
 
     # noinspection PyTypeChecker
-    async def upload(self, *, file_field: FileField):
+    async def upload(self, *, file_field: FileField) -> FileData:
         """Upload a file to the destination of the S3 bucket.
 
         Args:
             file_field (FileField): The file field to upload.
 
         Returns:
-            None: Nothing is returned.
+            FileData: The result of the upload.
         """
         try:
             file_data = await self.engine.upload(file_field=file_field)
-            self.store = file_data
         except FileStoreError as err:
             logger.error(f'Error uploading file: {err} in {self.__class__.__name__}')
-            self.store = FileData(status=False, error='Something went wrong', field_name=file_field['name'],
-                                  message=f'Unable to upload {file_field["name"]}')
\ No newline at end of file
+            file_data = FileData(status=False, error='Something went wrong', field_name=file_field['name'],
+                                 message=f'Unable to upload {file_field["name"]}')
+        self.store = file_data
+        return file_data
\ No newline at end of file
@@ -0,0 +1,255 @@
+"""
+Fair scheduling of uploads across requests and tenants. The uploads of every request in the process share a number
+of slots, handed out by weighted fair queuing between tenants and smallest file first within a tenant, so a request
+with many large files doesn't hold back the small uploads of other clients.
+"""
+import heapq
+import time
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from logging import getLogger
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from starlette.requests import Request
+
+from .structs import FileField
+
+logger = getLogger(__name__)
+
+DEFAULT_TENANT = 'default'
+
+
+def client_tenant(request: Optional[Request]) -> str:
+    """The default tenant key of a request, the host of the client.
+
+    Args:
+        request (Request | None): The request, None for uploads outside of a request.
+
+    Returns:
+        str: The tenant key.
+    """
+    client = getattr(request, 'client', None)
+    return client.host if client is not None and client.host else DEFAULT_TENANT
+
+
+@dataclass(eq=False)
+class _Job:
+    tenant: '_Tenant'
+    size: int
+    cost: float
+    seq: int
+    enqueued: float
+    future: asyncio.Future
+    taken: bool = False
+
+
+@dataclass(eq=False)
+class _Tenant:
+    name: str
+    weight: float
+    finish: float = 0.0
+    jobs: List[Tuple[int, int, _Job]] = field(default_factory=list)
+    arrivals: Deque[_Job] = field(default_factory=deque)
+    queued: int = 0
+    running: int = 0
+    completed: int = 0
+    bytes: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+
+    def head(self) -> Optional[_Job]:
+        while self.jobs and self.jobs[0][2].taken:
+            heapq.heappop(self.jobs)
+        return self.jobs[0][2] if self.jobs else None
+
+    def oldest(self) -> Optional[_Job]:
+        while self.arrivals and self.arrivals[0].taken:
+            self.arrivals.popleft()
+        return self.arrivals[0] if self.arrivals else None
+
+
+class UploadScheduler:
+    """Run uploads in a fixed number of slots shared by all the requests of the process. Pass a scheduler as the
+    scheduler config key, UploadScheduler.shared() is one per process, and the files of a request are queued together.
+
+    Tenants are served by start time fair queuing. Each upload costs its size in bytes, at least min_cost, divided by
+    the weight of its tenant, and the next slot goes to the tenant with the lowest virtual finish time, so tenants get
+    shares of the throughput in proportion to their weights however many files they send. Within a tenant the smallest
+    file goes first. An upload that has waited max_wait seconds is run before any other, so large files are not starved
+    by a stream of small ones.
+
+    Attributes:
+        concurrency (int): The number of uploads running at the same time.
+        tenant (Callable[[Request | None], str]): The tenant key of a request. Defaults to the client host.
+        weights (dict[str, float]): The weights of tenants, tenants without one have a weight of default_weight.
+        max_wait (float): The seconds after which a queued upload is run first.
+        min_cost (int): The lowest cost of an upload in bytes, the fixed overhead of a small file.
+        max_tenants (int): The tenants whose counts are kept between busy periods.
+        running (int): The uploads running.
+        queued (int): The uploads waiting for a slot.
+    """
+    _shared: Optional['UploadScheduler'] = None
+
+    def __init__(self, concurrency: int = 64, tenant: Callable[[Optional[Request]], str] = client_tenant,
+                 weights: Optional[Dict[str, float]] = None, default_weight: float = 1.0, max_wait: float = 5.0,
+                 min_cost: int = 64 * 1024, window: int = 1024, max_tenants: int = 1024):
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+        self.concurrency = concurrency
+        self.tenant = tenant
+        self.weights = dict(weights or {})
+        self.default_weight = default_weight
+        self.max_wait = max_wait
+        self.min_cost = min_cost
+        self.max_tenants = max_tenants
+        self.running = 0
+        self.queued = 0
+        self.vtime = 0.0
+        self.counts = {'submitted': 0, 'dispatched': 0, 'aged': 0, 'cancelled': 0}
+        self._seq = 0
+        self._tenants: Dict[str, _Tenant] = {}
+        self._waits: Deque[float] = deque(maxlen=window)
+
+    @classmethod
+    def shared(cls) -> 'UploadScheduler':
+        """Get the scheduler of the process, creating it with the default settings if needed."""
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    @staticmethod
+    def size(file_field: FileField) -> int:
+        """The size of the file of a file field, zero if it is unknown."""
+        return getattr(file_field.get('file'), 'size', None) or 0
+
+    def _tenant(self, name: str) -> _Tenant:
+        if (tenant := self._tenants.get(name)) is None:
+            tenant = self._tenants[name] = _Tenant(name, self.weights.get(name, self.default_weight))
+        return tenant
+
+    def _enqueue(self, name: str, size: int) -> _Job:
+        tenant = self._tenant(name)
+        self._seq += 1
+        job = _Job(tenant, size, max(size, self.min_cost) / tenant.weight, self._seq, time.monotonic(),
+                   asyncio.get_running_loop().create_future())
+        heapq.heappush(tenant.jobs, (size, job.seq, job))
+        tenant.arrivals.append(job)
+        tenant.queued += 1
+        self.queued += 1
+        self.counts['submitted'] += 1
+        return job
+
+    def _next(self, now: float) -> Optional[_Job]:
+        oldest, best, best_tag = None, None, 0.0
+        for tenant in self._tenants.values():
+            if (job := tenant.oldest()) is not None and (oldest is None or job.seq < oldest.seq):
+                oldest = job
+            if (job := tenant.head()) is not None:
+                tag = max(self.vtime, tenant.finish) + job.cost
+                if best is None or (tag, job.seq) < (best_tag, best.seq):
+                    best, best_tag = job, tag
+        if oldest is not None and now - oldest.enqueued >= self.max_wait:
+            self.counts['aged'] += 1
+            return oldest
+        return best
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.running < self.concurrency and self.queued and (job := self._next(now)) is not None:
+            if job.future.done():
+                # cancelled while queued, its task removes it from the counts when it resumes.
+                job.taken = True
+                continue
+            tenant = job.tenant
+            start = max(self.vtime, tenant.finish)
+            tenant.finish = start + job.cost
+            self.vtime = start
+            self._take(job)
+            wait = now - job.enqueued
+            self._waits.append(wait)
+            tenant.wait_total += wait
+            tenant.wait_max = max(tenant.wait_max, wait)
+            tenant.running += 1
+            self.running += 1
+            self.counts['dispatched'] += 1
+            job.future.set_result(None)
+        if not self.running and not self.queued:
+            # the finish times of a busy period don't carry over to the next one.
+            self.vtime = 0.0
+            for tenant in self._tenants.values():
+                tenant.finish = 0.0
+            if len(self._tenants) > self.max_tenants:
+                self._tenants.clear()
+
+    def _take(self, job: _Job):
+        job.taken = True
+        job.tenant.queued -= 1
+        self.queued -= 1
+
+    def _release(self, job: _Job):
+        job.tenant.running -= 1
+        job.tenant.completed += 1
+        job.tenant.bytes += job.size
+        self.running -= 1
+        self._dispatch()
+
+    async def _run(self, job: _Job, func: Callable[[], Awaitable]) -> Any:
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            if not job.future.done() or job.future.cancelled():
+                self._take(job)
+                self.counts['cancelled'] += 1
+            elif job.future.done() and not job.future.cancelled():
+                self._release(job)
+            raise
+        try:
+            return await func()
+        finally:
+            self._release(job)
+
+    async def run(self, tenant: str, size: int, func: Callable[[], Awaitable]) -> Any:
+        """Run an upload in a slot of the scheduler.
+
+        Args:
+            tenant (str): The tenant key of the upload.
+            size (int): The size of the file in bytes.
+            func (Callable[[], Awaitable]): A function without arguments returning the upload.
+
+        Returns:
+            Any: The result of the upload.
+        """
+        job = self._enqueue(tenant, size)
+        self._dispatch()
+        return await self._run(job, func)
+
+    async def gather(self, request: Optional[Request], uploads: List[Tuple[int, Callable[[], Awaitable]]],
+                     return_exceptions: bool = False) -> list:
+        """Run the uploads of a request. They are all queued before any of them starts, so the smallest go first.
+
+        Args:
+            request (Request | None): The request of the uploads, for the tenant key.
+            uploads (list[tuple[int, Callable[[], Awaitable]]]): The size and the function of each upload.
+            return_exceptions (bool): Return the errors of failed uploads instead of raising the first.
+
+        Returns:
+            list: The results in the order of the uploads.
+        """
+        name = self.tenant(request)
+        jobs = [self._enqueue(name, size) for size, _ in uploads]
+        self._dispatch()
+        return await asyncio.gather(*[self._run(job, func) for job, (_, func) in zip(jobs, uploads)],
+                                    return_exceptions=return_exceptions)
+
+    def stats(self) -> Dict[str, Any]:
+        """The slots in use, the uploads queued, the queue wait times in seconds and the state of each tenant."""
+        waits = sorted(self._waits)
+        percentile = (lambda p: waits[min(len(waits) - 1, int(p * len(waits)))]) if waits else (lambda p: None)
+        tenants = {name: {'weight': tenant.weight, 'queued': tenant.queued, 'running': tenant.running,
+                          'completed': tenant.completed, 'bytes': tenant.bytes, 'wait_max': tenant.wait_max,
+                          'wait_mean': tenant.wait_total / tenant.completed if tenant.completed else None}
+                   for name, tenant in self._tenants.items()}
+        return {'concurrency': self.concurrency, 'running': self.running, 'queued': self.queued,
+                'wait_p50': percentile(0.5), 'wait_p95': percentile(0.95), 'wait_max': waits[-1] if waits else None,
+                'tenants': tenants, **self.counts}
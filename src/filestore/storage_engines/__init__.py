@@ -1,3 +1,10 @@
 from .storage_engine import StorageEngine
 from .local_engine import LocalEngine
 from .memory_engine import MemoryEngine
+from .replicated_engine import ReplicatedEngine
+from .tiered_engine import TieredEngine, Migrator
+from .retry import RetryPolicy, CircuitBreaker
+from .packed_engine import PackedEngine, SegmentStore
+from .limiter import AdaptiveLimiter
+from .volume_engine import VolumeEngine, VolumeSet, Volume
+from .chunk_engine import ChunkEngine, ChunkStore, Chunker
@@ -0,0 +1,349 @@
+"""
+Deduplicating chunk storage engine. Files are split into chunks at boundaries chosen by their content, with a gear
+rolling hash, and every chunk is stored once by its sha256 digest. A stored file is a manifest of its chunks, so the
+revisions of a large file share the chunks they have in common and only the changed bytes are written.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from pathlib import Path
+from logging import getLogger
+from uuid import uuid4
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+from ..exceptions import FileStoreError
+from ..structs import FileData
+from ..util import to_thread
+from .local_engine import LocalEngine, fsync_dir
+
+logger = getLogger(__name__)
+
+MANIFEST_SUFFIX = '.chunks.json'
+READ_SIZE = 4 * 1024 ** 2
+MASK64 = (1 << 64) - 1
+# the gear table must never change, the boundaries of the chunks already stored depend on it.
+GEAR = [int.from_bytes(hashlib.sha256(bytes([value])).digest()[:8], 'big') for value in range(256)]
+
+
+class Chunker:
+    """Content defined chunking with a gear rolling hash, as in FastCDC. A boundary is cut after a byte where the top
+    bits of the hash of the last 64 bytes are all zero, so an insert or delete only moves the boundaries around it
+    and the chunks before and after are cut the same. Chunks are between min_size and max_size bytes. The boundary
+    test is harder before avg_size and easier after it, which keeps the chunk sizes close to the average.
+
+    Attributes:
+        min_size (int): The smallest chunk, except the last chunk of a file.
+        avg_size (int): The target average chunk size, a power of two.
+        max_size (int): The largest chunk.
+    """
+
+    def __init__(self, min_size: int = 16 * 1024, avg_size: int = 64 * 1024, max_size: int = 256 * 1024):
+        if avg_size & (avg_size - 1) or not 64 <= min_size <= avg_size <= max_size:
+            raise ValueError('Expected 64 <= min_size <= avg_size <= max_size with avg_size a power of two')
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        bits = avg_size.bit_length() - 1
+        self._mask_small = ((1 << (bits + 2)) - 1) << (64 - bits - 2)
+        self._mask_large = ((1 << max(bits - 2, 1)) - 1) << (64 - max(bits - 2, 1))
+
+    def cut(self, data: bytes, start: int, end: int) -> int:
+        """Find the end of the chunk starting at start.
+
+        Args:
+            data (bytes): The data.
+            start (int): The start of the chunk.
+            end (int): The end of the data to look in, at most start + max_size.
+
+        Returns:
+            int: The end of the chunk, end if no boundary was found.
+        """
+        if end - start <= self.min_size:
+            return end
+        gear, mask_small, mask_large = GEAR, self._mask_small, self._mask_large
+        # bytes shift out of the hash after 64 steps, so hashing can start 64 bytes before the first boundary.
+        index, barrier, h = start + self.min_size - 64, start + self.min_size, 0
+        normal = min(start + self.avg_size, end)
+        while index < barrier:
+            h = ((h << 1) + gear[data[index]]) & MASK64
+            index += 1
+        while index < normal:
+            h = ((h << 1) + gear[data[index]]) & MASK64
+            index += 1
+            if not h & mask_small:
+                return index
+        while index < end:
+            h = ((h << 1) + gear[data[index]]) & MASK64
+            index += 1
+            if not h & mask_large:
+                return index
+        return end
+
+    def split(self, data: bytes, final: bool) -> List[Tuple[int, int]]:
+        """Split data into chunks. Without final the data after the last boundary is left for the next call, it is
+        the start of a chunk that may continue in the data that follows.
+
+        Args:
+            data (bytes): The data.
+            final (bool): If the data is the end of the file.
+
+        Returns:
+            list[tuple[int, int]]: The start and end of every chunk.
+        """
+        chunks, start = [], 0
+        while start < len(data) and (final or len(data) - start >= self.max_size):
+            end = self.cut(data, start, min(len(data), start + self.max_size))
+            chunks.append((start, end))
+            start = end
+        return chunks
+
+
+class ChunkStore:
+    """Chunks stored once by their sha256 digest in a directory, with the Chunker that splits the files of the store.
+    A chunk that is already stored is not written again. Deleting a file deletes its manifest only, collect deletes
+    the chunks that no manifest refers to. A store is shared by all the engines writing to its directory.
+
+    Attributes:
+        directory (Path): The directory of the chunks.
+        chunker (Chunker): The chunker of the files.
+        fsync (bool): Flush every new chunk to disk, whatever the durability of the upload.
+        counts (dict[str, int]): The chunks and bytes written and deduplicated.
+    """
+    _stores: Dict[Path, 'ChunkStore'] = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, directory: Union[str, Path], chunker: Chunker = None, fsync: bool = False):
+        self.directory = Path(directory).absolute()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.chunker = chunker or Chunker()
+        self.fsync = fsync
+        self.counts = {'chunks_written': 0, 'bytes_written': 0, 'chunks_deduplicated': 0, 'bytes_deduplicated': 0}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, directory: Union[str, Path]) -> 'ChunkStore':
+        """Get the shared store of a directory, creating it with the default settings if needed."""
+        directory = Path(directory).absolute()
+        with cls._stores_lock:
+            if (store := cls._stores.get(directory)) is None:
+                store = cls._stores[directory] = cls(directory)
+            return store
+
+    def chunk_path(self, digest: str) -> Path:
+        return self.directory / digest[:2] / digest[2:4] / digest
+
+    def put(self, data: bytes, fsync: bool = False) -> Tuple[str, bool]:
+        """Store a chunk unless it is already stored. A stored chunk of the wrong size, e.g. truncated by a crash, is
+        written again instead of being deduplicated against.
+
+        Args:
+            data (bytes): The content of the chunk.
+            fsync (bool): Flush the chunk and its directory to disk before returning, so a durable manifest never
+                refers to a chunk that is lost in a crash.
+
+        Returns:
+            tuple[str, bool]: The digest of the chunk and True if it was written.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        fsync = fsync or self.fsync
+        try:
+            # refresh the age of a deduplicated chunk so collect doesn't delete it before the manifest is written.
+            os.utime(path)
+            written = path.stat().st_size != len(data)
+        except FileNotFoundError:
+            written = True
+        if written:
+            created = not path.parent.exists()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f'.{digest}.{uuid4().hex[:8]}.tmp')
+            try:
+                with open(tmp, 'wb') as fh:
+                    fh.write(data)
+                    if fsync:
+                        fh.flush()
+                        os.fsync(fh.fileno())
+                # a chunk written concurrently by another upload has the same content, either rename wins.
+                os.replace(tmp, path)
+            except BaseException:
+                tmp.unlink(missing_ok=True)
+                raise
+            if fsync:
+                fsync_dir(path.parent)
+                if created:
+                    fsync_dir(path.parent.parent)
+                    fsync_dir(self.directory)
+        with self._lock:
+            kind = 'written' if written else 'deduplicated'
+            self.counts[f'chunks_{kind}'] += 1
+            self.counts[f'bytes_{kind}'] += len(data)
+        return digest, written
+
+    def ingest(self, data: bytes, final: bool, fsync: bool = False) -> Tuple[List[Tuple[str, int, bool]], int]:
+        """Split data into chunks and store the new ones. Runs in a worker thread.
+
+        Args:
+            data (bytes): The data read since the last boundary.
+            final (bool): If the data is the end of the file.
+            fsync (bool): Flush the new chunks to disk.
+
+        Returns:
+            tuple[list[tuple[str, int, bool]], int]: The digest, size and written flag of every chunk, and the number
+                of bytes consumed.
+        """
+        chunks, consumed = [], 0
+        for start, consumed in self.chunker.split(data, final):
+            digest, written = self.put(data[start: consumed], fsync)
+            chunks.append((digest, consumed - start, written))
+        return chunks, consumed
+
+    def read(self, digest: str, verify: bool = False) -> bytes:
+        """Read a chunk.
+
+        Args:
+            digest (str): The digest of the chunk.
+            verify (bool): Check the content against the digest.
+
+        Returns:
+            bytes: The content of the chunk.
+        """
+        data = self.chunk_path(digest).read_bytes()
+        if verify and hashlib.sha256(data).hexdigest() != digest:
+            raise FileStoreError(f'Chunk {digest} is corrupt')
+        return data
+
+    @staticmethod
+    def iter_file(path: Union[str, Path], verify: bool = False) -> Iterator[bytes]:
+        """Reassemble a stored file from its manifest.
+
+        Args:
+            path (str | Path): The path of the manifest returned by the engine.
+            verify (bool): Check every chunk against its digest.
+
+        Yields:
+            bytes: The chunks of the file in order.
+        """
+        manifest = json.loads(Path(path).read_text())
+        store = ChunkStore.shared(manifest['store'])
+        for digest, _ in manifest['chunks']:
+            yield store.read(digest, verify)
+
+    @staticmethod
+    def read_file(path: Union[str, Path], verify: bool = False) -> bytes:
+        """Read a whole stored file from its manifest. See iter_file."""
+        return b''.join(ChunkStore.iter_file(path, verify))
+
+    def collect(self, roots: Iterable[Union[str, Path]], grace: float = 3600) -> int:
+        """Delete the chunks that no manifest under the roots refers to. Chunks written or deduplicated in the last
+        grace seconds are kept, so the chunks of uploads still writing their manifest are not collected. The grace
+        must be longer than the longest upload.
+
+        Args:
+            roots (Iterable[str | Path]): The directories holding every manifest that uses the store.
+            grace (float): The minimum age in seconds of a collected chunk.
+
+        Returns:
+            int: The number of bytes reclaimed.
+        """
+        live = set()
+        for root in roots:
+            for manifest in Path(root).rglob(f'*{MANIFEST_SUFFIX}'):
+                try:
+                    live.update(digest for digest, _ in json.loads(manifest.read_text())['chunks'])
+                except (OSError, ValueError, KeyError) as err:
+                    logger.warning(f'Skipped unreadable manifest {manifest}: {err}')
+        reclaimed, cutoff = 0, time.time() - grace
+        for path in self.directory.glob('*/*/*'):
+            if path.name in live or path.name.endswith('.tmp'):
+                continue
+            stat = path.stat()
+            if stat.st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+                reclaimed += stat.st_size
+        logger.info(f'Collected chunks in {self.directory}, reclaimed {reclaimed} bytes')
+        return reclaimed
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counts)
+
+
+class ChunkEngine(LocalEngine):
+    """Store files as deduplicated chunks. Files are split by the Chunker of the ChunkStore of the chunk_dir config
+    key, or the ChunkStore given as the chunks config key, and only the chunks not already in the store are written.
+    The destination of a file holds its manifest, the path of the FileData is the path of the manifest and the
+    chunk counts are in its metadata. Read a file back with ChunkStore.iter_file or ChunkStore.read_file. The chunk
+    boundaries are found in a worker thread, so large files don't block the event loop. With the durability config
+    the new chunks are flushed to disk before the manifest that refers to them is written.
+
+    Config:
+        chunk_dir (str | Path): The directory of the chunks. Defaults to uploads/.chunks.
+        chunks (ChunkStore): The chunk store of the files, overrides chunk_dir.
+    """
+
+    async def upload(self, file_field=None) -> FileData:
+        """Split a file into chunks, store the new chunks and write the manifest of the file.
+
+        Args:
+            file_field (FileField): A file field object.
+
+        Returns:
+            FileData: The result of the upload.
+        """
+        try:
+            self.file_field = file_field
+            file_field = self.file_field
+            field_name, file, config = file_field['name'], file_field['file'], file_field.get('config', {})
+            store = config.get('chunks') or ChunkStore.shared(config.get('chunk_dir', 'uploads/.chunks'))
+            dest = await self.destination(file_field)
+            if dest is None:
+                dest = self.get_path(file, config.get('destination', None))
+            else:
+                dest = Path(dest)
+                self.makedirs(dest.parent)
+            manifest = dest.with_name(dest.name + MANIFEST_SUFFIX)
+            algorithm, durable = config.get('checksum'), config.get('durability', 'none') != 'none'
+            digest = hashlib.new(algorithm) if algorithm else None
+            chunks, buffer = [], b''
+            try:
+                while True:
+                    block = await file.read(READ_SIZE)
+                    digest.update(block) if digest else ...
+                    buffer += block
+                    stored, consumed = await to_thread(store.ingest, buffer, not block, durable)
+                    chunks.extend(stored)
+                    buffer = buffer[consumed:]
+                    if not block:
+                        break
+            finally:
+                await file.close()
+            size = sum(size for _, size, _ in chunks)
+            written = sum(size for _, size, new in chunks if new)
+            body = json.dumps({'filename': file.filename, 'size': size, 'content_type': file.content_type,
+                               'store': str(store.directory),
+                               'chunks': [[chunk, size] for chunk, size, _ in chunks]}).encode()
+            await to_thread(self._write_manifest, manifest, body, durable)
+            return FileData(size=size, filename=file.filename, content_type=file.content_type, path=str(manifest),
+                            field_name=field_name, checksum=digest.hexdigest() if digest else '',
+                            metadata={'chunks': len(chunks), 'new_chunks': sum(1 for *_, new in chunks if new),
+                                      'stored_bytes': written},
+                            message=f'{file.filename} was saved successfully, {written} new bytes stored')
+        except Exception as err:
+            logger.error(f'Error uploading file: {err} in {self.__class__.__name__}')
+            raise FileStoreError(err)
+
+    @staticmethod
+    def _write_manifest(path: Path, body: bytes, fsync: bool):
+        tmp = path.with_name(f'.{path.name}.{uuid4().hex[:8]}.tmp')
+        try:
+            with open(tmp, 'wb') as fh:
+                fh.write(body)
+                if fsync:
+                    fh.flush()
+                    os.fsync(fh.fileno())
+            os.replace(tmp, path)
+            fsync_dir(path.parent) if fsync else ...
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
@@ -0,0 +1,188 @@
+"""
+Adaptive concurrency limits for calls to remote storage. The number of calls in flight is adjusted at run time from
+the observed latencies and throttling responses.
+"""
+import math
+import time
+import asyncio
+from logging import getLogger
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+try:
+    from botocore.exceptions import ClientError
+except ImportError:
+    ClientError = ()
+
+logger = getLogger(__name__)
+
+THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException',
+                  'ServiceUnavailable', 'RequestThrottled'}
+
+
+def throttled(err: BaseException) -> bool:
+    """Check if a call failed because the endpoint is throttling, SlowDown and 503 or 429 responses.
+
+    Args:
+        err (BaseException): The error of the call.
+
+    Returns:
+        bool: True if the call was throttled.
+    """
+    if isinstance(err, ClientError):
+        status = err.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return err.response.get('Error', {}).get('Code') in THROTTLE_CODES or status in (429, 503)
+    return False
+
+
+class AdaptiveLimiter:
+    """Limit the calls in flight to a limit adjusted from the latencies and throttling of completed calls.
+    A limiter is shared by all the requests of the worker, pass it as the limiter config key or set it as the
+    limiter class attribute of the S3Engine.
+
+    The aimd algorithm adds one call to the limit for every limit calls completed without throttling and a latency
+    under tolerance times the baseline, the lowest recent latency, and multiplies the limit by backoff when a call is
+    throttled or slower. The gradient algorithm moves the limit towards limit * long / short latency, the ratio of the
+    long term average latency to the latest one, plus a queue allowance of the square root of the limit, and also backs
+    off on throttling. The limit only grows while the calls actually use most of it. Latencies are measured per call,
+    so a limiter is best shared by calls of similar sizes.
+
+    Attributes:
+        limit (float): The current limit of calls in flight.
+        min_limit (int): The lowest limit.
+        max_limit (int): The highest limit.
+        algorithm (str): aimd or gradient.
+        backoff (float): The factor applied to the limit on throttling.
+        tolerance (float): The latency increase over the baseline treated as congestion.
+        smoothing (float): The weight of a new limit for the gradient algorithm.
+        inflight (int): The calls in flight.
+    """
+
+    def __init__(self, initial: int = 16, min_limit: int = 1, max_limit: int = 512, algorithm: str = 'aimd',
+                 backoff: float = 0.7, tolerance: float = 2.0, smoothing: float = 0.2, window: float = 60.0):
+        if algorithm not in ('aimd', 'gradient'):
+            raise ValueError(f'Unknown algorithm {algorithm}, expected aimd or gradient')
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.algorithm = algorithm
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.window = window
+        self.inflight = 0
+        self.waiting = 0
+        self.baseline: Optional[float] = None
+        self.long_latency: Optional[float] = None
+        self.last_latency: Optional[float] = None
+        self.counts = {'calls': 0, 'throttled': 0, 'errors': 0, 'increases': 0, 'decreases': 0}
+        self._baseline_at = 0.0
+        self._decreased_at = 0.0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    def _wake(self):
+        while self._waiters and self.inflight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.inflight += 1
+                waiter.set_result(None)
+
+    async def acquire(self):
+        """Wait for a slot under the limit. Waiters are served in order."""
+        if self.inflight < int(self.limit) and not self._waiters:
+            self.inflight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.waiting += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.inflight -= 1
+                self._wake()
+            raise
+        finally:
+            self.waiting -= 1
+
+    def release(self, latency: Optional[float] = None, throttle: bool = False):
+        """Free a slot and adjust the limit from the outcome of the call.
+
+        Args:
+            latency (float | None): The latency of a successful call, None for a call that failed without throttling.
+            throttle (bool): If the call was throttled.
+        """
+        utilized = self.inflight >= self.limit / 2
+        self.inflight -= 1
+        self.update(latency, throttle, utilized)
+        self._wake()
+
+    def update(self, latency: Optional[float], throttle: bool, utilized: bool = True):
+        """Adjust the limit from the outcome of a call."""
+        self.counts['calls'] += 1
+        previous = self.limit
+        if throttle:
+            self.counts['throttled'] += 1
+            self._decrease()
+        elif latency is None:
+            self.counts['errors'] += 1
+        else:
+            self.observe(latency)
+            if self.algorithm == 'aimd':
+                if latency > self.baseline * self.tolerance:
+                    self._decrease()
+                elif utilized:
+                    self.limit += 1 / self.limit
+            else:
+                gradient = max(0.5, min(1.0, self.tolerance * self.long_latency / latency))
+                target = self.limit * gradient + math.sqrt(self.limit)
+                target = target if utilized or target < self.limit else self.limit
+                self.limit = self.limit * (1 - self.smoothing) + target * self.smoothing
+        self.limit = max(float(self.min_limit), min(float(self.max_limit), self.limit))
+        if int(self.limit) != int(previous):
+            self.counts['increases' if self.limit > previous else 'decreases'] += 1
+            logger.debug(f'Concurrency limit changed from {int(previous)} to {int(self.limit)}')
+
+    def _decrease(self):
+        # calls completing together report the same congestion, back off at most once per average latency.
+        now = time.monotonic()
+        if now - self._decreased_at >= (self.long_latency or 0):
+            self.limit = self.limit * self.backoff
+            self._decreased_at = now
+
+    def observe(self, latency: float):
+        """Track the baseline, long term and latest latencies. The baseline is reset every window seconds so it
+        follows changes of the network."""
+        now = time.monotonic()
+        if self.baseline is None or latency < self.baseline or now - self._baseline_at > self.window:
+            self.baseline, self._baseline_at = latency, now
+        self.long_latency = latency if self.long_latency is None else 0.95 * self.long_latency + 0.05 * latency
+        self.last_latency = latency
+
+    async def run(self, func: Callable[[], Awaitable]) -> Any:
+        """Call a function in a slot under the limit.
+
+        Args:
+            func (Callable[[], Awaitable]): A function without arguments returning the call.
+
+        Returns:
+            Any: The result of the call.
+        """
+        await self.acquire()
+        start = time.monotonic()
+        latency, throttle = None, False
+        try:
+            result = await func()
+            latency = time.monotonic() - start
+            return result
+        except Exception as err:
+            throttle = throttled(err)
+            raise
+        finally:
+            self.release(latency, throttle)
+
+    def stats(self) -> Dict[str, Any]:
+        """The current limit, the calls in flight and waiting, the latencies and the call counts."""
+        return {'limit': int(self.limit), 'inflight': self.inflight, 'waiting': self.waiting,
+                'algorithm': self.algorithm, 'baseline_latency': self.baseline, 'long_latency': self.long_latency,
+                'last_latency': self.last_latency, **self.counts}
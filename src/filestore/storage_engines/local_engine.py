@@ -1,21 +1,160 @@
 """
 This module contains the LocalStorage class.
 """
+import os
+import errno
+import shutil
+import asyncio
+import hashlib
 from pathlib import Path
-from typing import Union
+from typing import Callable, Dict, Union, List, Sequence, Tuple, Optional
 from logging import getLogger
+from uuid import uuid4
+from weakref import WeakKeyDictionary
 
 from fastapi import UploadFile
 
 from ..exceptions import FileStoreError
-from ..structs import FileField, FileData
-from .storage_engine import StorageEngine
+from ..structs import FileField, FileData, BatchResult, Config
+from ..util import to_thread
+from .storage_engine import StorageEngine, Pairs
 
 logger = getLogger(__name__)
 
+CHUNK_SIZE = 1024 * 1024
+
+
+def fsync_dir(path: Union[str, Path]):
+    """Flush a directory entry to disk so that a rename into it survives a crash.
+
+    Args:
+        path (str | Path): The directory to flush.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:  # directories can't be opened on some platforms e.g. windows
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class GroupCommit:
+    """Batches the fsync and rename of concurrently written files.
+
+    Uploads that finish writing within the same short window share one worker thread hop, every file in the batch is
+    flushed and renamed into place, and each affected directory is flushed once for the whole batch instead of once
+    per file. One committer exists per event loop.
+
+    Attributes:
+        delay (float): Seconds to wait for other uploads to join a batch before flushing it.
+    """
+    delay: float = 0.002
+    _committers: 'WeakKeyDictionary[asyncio.AbstractEventLoop, GroupCommit]' = WeakKeyDictionary()
+
+    def __init__(self):
+        self._pending: List[Tuple[Path, Path, asyncio.Future]] = []
+        self._flusher: Optional[asyncio.Task] = None
+
+    @classmethod
+    def get(cls) -> 'GroupCommit':
+        """Get the committer of the running event loop.
+
+        Returns:
+            GroupCommit: The committer for the running loop.
+        """
+        loop = asyncio.get_running_loop()
+        committer = cls._committers.get(loop)
+        if committer is None:
+            committer = cls._committers[loop] = cls()
+        return committer
+
+    async def commit(self, tmp: Path, dest: Path):
+        """Durably move a fully written temporary file to its destination as part of the next batch.
+
+        Args:
+            tmp (Path): The temporary file holding the data.
+            dest (Path): The final path of the file.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((tmp, dest, future))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = loop.create_task(self._flush())
+        await future
+
+    async def _flush(self):
+        while self._pending:
+            await asyncio.sleep(self.delay)
+            batch, self._pending = self._pending, []
+            # the files of cancelled uploads are removed by their writers, don't move them into place.
+            batch = [(tmp, dest, future) for tmp, dest, future in batch if not future.done()]
+            try:
+                errors = await to_thread(self.sync, [(tmp, dest) for tmp, dest, _ in batch])
+            except Exception as err:
+                errors = [err] * len(batch)
+            for (*_, future), error in zip(batch, errors):
+                if future.done():
+                    continue
+                future.set_exception(error) if error else future.set_result(None)
+
+    @staticmethod
+    def sync(batch: List[Tuple[Path, Path]]) -> List[Optional[Exception]]:
+        """Flush, rename and flush the parent directories of a batch of files. Runs in a worker thread.
+
+        Args:
+            batch (list[tuple[Path, Path]]): Pairs of temporary file and destination.
+
+        Returns:
+            list[Exception | None]: The error for each file of the batch, None if it was committed.
+        """
+        errors, dirs = [], set()
+        for tmp, dest in batch:
+            try:
+                fd = os.open(tmp, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                os.replace(tmp, dest)
+                dirs.add(dest.parent)
+                errors.append(None)
+            except OSError as err:
+                errors.append(err)
+        for directory in dirs:
+            fsync_dir(directory)
+        return errors
+
 
 class LocalEngine(StorageEngine):
-    """Local storage for FastAPI."""
+    """Local storage for FastAPI.
+
+    Files are written to a temporary file next to the destination and renamed into place once complete, so readers
+    never see a partially written file. The durability config key controls what is flushed to disk before the upload
+    is reported as saved:
+
+        none: The data is left to the operating system to flush. This is the default.
+        fsync: Each file and its directory are flushed individually.
+        group: Concurrent uploads are flushed together in batches. See GroupCommit.
+
+    Stored files are deleted, copied and moved by path in batches split over batch_concurrency worker threads.
+    Copies are hard links where the filesystem allows it, stored files are replaced and never written in place so
+    the copies don't change together, and moves are renames, both fall back to copying the data across filesystems.
+
+    Config:
+        batch_concurrency (int): The worker threads of a batch delete, copy or move. Defaults to 16.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._dirs = set()
+
+    def makedirs(self, directory: Path):
+        """Create a directory once for all the files of the engine."""
+        if directory not in self._dirs:
+            directory.mkdir(parents=True, exist_ok=True)
+            self._dirs.add(directory)
 
     def get_path(self, file: UploadFile, destination: Union[str, Path]) -> Path:
         """Get the path to save the file to.
@@ -23,28 +162,64 @@ class LocalEngine(StorageEngine):
         Returns:
             Path: The path to save the file to.
         """
-        if isinstance(destination, Path):
-            Path(destination).mkdir(parents=True, exist_ok=True) if not destination.exists() else ...
-        else:
-            destination = Path.cwd() / destination
-            Path(destination).mkdir(parents=True, exist_ok=True) if not destination.exists() else ...
-        return destination / file.filename
+        destination = destination if isinstance(destination, Path) else Path.cwd() / destination
+        filename = Path(file.filename)
+        if filename.anchor or '..' in filename.parts:
+            raise FileStoreError(f'Filename {file.filename} is outside of the destination')
+        path = destination / filename
+        # filenames of extracted archive entries include their folders
+        self.makedirs(path.parent)
+        return path
 
     @staticmethod
-    async def _upload(file: UploadFile, dest):
+    async def _upload(file: UploadFile, dest, durability: str = 'none', checksum: str = '') -> str:
         """Private method to upload the file to the destination. This method is called by the upload method.
+        The file is written in chunks to a temporary file which then atomically replaces the destination.
 
         Args:
             file (UploadFile): The file to upload.
             dest (Path): The destination to upload the file to.
+            durability (str): One of none, fsync or group.
+            checksum (str): The name of a hashlib algorithm to compute the checksum of the file with.
 
         Returns:
-            None: Nothing is returned.
+            str: The hex digest of the file if a checksum algorithm is given.
         """
-        file_object = await file.read()
-        with open(f'{dest}', 'wb') as fh:
-            fh.write(file_object)
-        await file.close()
+        dest = Path(dest)
+        tmp = dest.with_name(f'.{dest.name}.{uuid4().hex[:8]}.tmp')
+        digest = hashlib.new(checksum) if checksum else None
+        try:
+            with open(tmp, 'wb') as fh:
+                while chunk := await file.read(CHUNK_SIZE):
+                    fh.write(chunk)
+                    digest.update(chunk) if digest else ...
+                if durability == 'fsync':
+                    fh.flush()
+                    await to_thread(os.fsync, fh.fileno())
+
+            if durability == 'group':
+                await GroupCommit.get().commit(tmp, dest)
+            else:
+                os.replace(tmp, dest)
+                if durability == 'fsync':
+                    await to_thread(fsync_dir, dest.parent)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        finally:
+            await file.close()
+        return digest.hexdigest() if digest else ''
+
+    async def _background_upload(self, file: UploadFile, dest, durability: str, checksum: str, file_data: FileData):
+        """Save the file after the response is sent and record its checksum on the FileData of the upload, so the
+        index, which runs after the uploads, records it too. A failed upload marks the FileData as failed instead, so
+        it is left out of the index."""
+        try:
+            file_data.checksum = await self._upload(file, dest, durability, checksum)
+        except Exception as err:
+            logger.error(f'Error uploading file: {err} in {self.__class__.__name__}')
+            file_data.status, file_data.error = False, str(err)
+            file_data.message = f'Unable to save {file.filename}'
 
     async def upload(self, file_field=None) -> FileData:
         """Upload a file to the destination.
@@ -57,17 +232,101 @@ class LocalEngine(StorageEngine):
         """
         try:
             self.file_field = file_field
-            field_name, file = self.file_field['name'], self.file_field['file']
-            dest = self.config.get('destination', None)
-            dest = dest(self.request, self.form, field_name, file) if callable(dest) else self.get_path(file, dest)
-            if self.config['background']:
-                self.background_tasks.add_task(self._upload, file, dest)
-                message = f'{file.filename} is saving in the background'
+            file_field = self.file_field
+            field_name, file, config = file_field['name'], file_field['file'], file_field.get('config', {})
+            durability = config.get('durability', 'none')
+            if durability not in ('none', 'fsync', 'group'):
+                raise FileStoreError(f'Unknown durability {durability}, expected one of none, fsync or group')
+            dest = await self.destination(file_field)
+            if dest is None:
+                dest = self.get_path(file, config.get('destination', None))
+            else:
+                self.makedirs(Path(dest).parent)
+            file_data = FileData(size=file.size, filename=file.filename, content_type=file.content_type,
+                                 path=str(dest), field_name=field_name)
+            if config.get('background') and self.background_tasks is not None:
+                self.background_tasks.add_task(self._background_upload, file, dest, durability,
+                                               config.get('checksum', ''), file_data)
+                file_data.message = f'{file.filename} is saving in the background'
             else:
-                await self._upload(file, dest)
-                message = f'{file.filename} was saved successfully'
-            return FileData(size=file.size, filename=file.filename, content_type=file.content_type,
-                            path=str(dest), field_name=field_name, message=message)
+                file_data.checksum = await self._upload(file, dest, durability, config.get('checksum', ''))
+                file_data.message = f'{file.filename} was saved successfully'
+            return file_data
         except Exception as err:
             logger.error(f'Error uploading file: {err} in {self.__class__.__name__}')
-            raise FileStoreError(err)
\ No newline at end of file
+            raise FileStoreError(err)
+
+    @staticmethod
+    def _delete(key: str) -> str:
+        Path(key).unlink(missing_ok=True)
+        return key
+
+    @staticmethod
+    def _place(source: Path, dest: Path, link: bool):
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f'.{dest.name}.{uuid4().hex[:8]}.tmp')
+        try:
+            try:
+                os.link(source, tmp) if link else shutil.copy2(source, tmp)
+            except OSError as err:
+                if not link or err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    raise
+                shutil.copy2(source, tmp)
+            os.replace(tmp, dest)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+    def _copy(self, pair: Tuple[str, str]) -> str:
+        source, dest = pair
+        self._place(Path(source), Path(dest), link=True)
+        return dest
+
+    def _move(self, pair: Tuple[str, str]) -> str:
+        source, dest = pair
+        dest_path = Path(dest)
+        try:
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(source, dest_path)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            self._place(Path(source), dest_path, link=False)
+            Path(source).unlink()
+        return dest
+
+    async def _batch(self, operation: str, func: Callable, items: Sequence, config: Config) -> BatchResult:
+        """Run an operation on the items in contiguous chunks, one worker thread per chunk."""
+        items = list(items)
+        concurrency = max(1, (config if config is not None else self.config).get('batch_concurrency', 16))
+        size = -(-len(items) // concurrency) or 1
+
+        def run(chunk: Sequence) -> Tuple[List[str], Dict[str, str]]:
+            done, failed = [], {}
+            for item in chunk:
+                try:
+                    done.append(func(item))
+                except OSError as err:
+                    failed[item[0] if isinstance(item, tuple) else item] = str(err)
+            return done, failed
+
+        succeeded, failed = [], {}
+        for done, errors in await asyncio.gather(*[to_thread(run, items[start: start + size])
+                                                   for start in range(0, len(items), size)]):
+            succeeded.extend(done)
+            failed.update(errors)
+        for key, error in failed.items():
+            logger.error(f'Error in {operation} of {key}: {error} in {self.__class__.__name__}')
+        return BatchResult.summary(operation, succeeded, failed)
+
+    async def delete(self, keys: Sequence[str], *, config: Config = None) -> BatchResult:
+        """Delete files by path, files that don't exist count as deleted. See StorageEngine.delete."""
+        return await self._batch('delete', self._delete, [str(key) for key in keys], config)
+
+    async def copy(self, pairs: Pairs, *, config: Config = None) -> BatchResult:
+        """Copy files by path, as hard links where possible. See StorageEngine.copy."""
+        return await self._batch('copy', self._copy, self.pairs(pairs), config)
+
+    async def move(self, pairs: Pairs, *, config: Config = None) -> BatchResult:
+        """Move files by path with renames. See StorageEngine.move."""
+        return await self._batch('move', self._move, self.pairs(pairs), config)
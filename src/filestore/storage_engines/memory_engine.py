@@ -1,6 +1,7 @@
 """
 Memory storage for FastStore. This storage is used to store files in memory.
 """
+import hashlib
 from logging import getLogger
 
 from fastapi import UploadFile
@@ -18,11 +19,13 @@ class MemoryEngine(StorageEngine):
     async def upload(self, file_field: FileField = None) -> FileData:
         try:
             self.file_field = file_field
-            file = self.file_field['file']
+            file_field = self.file_field
+            file, algorithm = file_field['file'], file_field.get('config', {}).get('checksum')
             obj = await file.read()
             await file.close()
             return FileData(size=file.size, filename=file.filename, content_type=file.content_type,
                             field_name=file_field['name'], file=obj,
+                            checksum=hashlib.new(algorithm, obj).hexdigest() if algorithm else '',
                             message=f'{file.filename} saved successfully')
         except Exception as err:
             logger.error(f'Error Saving file to Memory: {err} in {self.__class__.__name__}')
@@ -0,0 +1,379 @@
+"""
+Packed storage engine. Small files are appended to large segment files with an SQLite offset index instead of being
+stored as a file each, larger files are stored by the LocalEngine.
+"""
+import os
+import mmap
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path, PurePosixPath
+from logging import getLogger
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from ..exceptions import FileStoreError
+from ..structs import FileData, BatchResult, Config
+from ..util import to_thread
+from .storage_engine import Pairs
+from .local_engine import LocalEngine, fsync_dir
+
+logger = getLogger(__name__)
+
+PACK_THRESHOLD = 16 * 1024
+SEGMENT_SIZE = 256 * 1024 ** 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    content_type TEXT NOT NULL DEFAULT '',
+    checksum TEXT NOT NULL DEFAULT '',
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_segment ON objects (segment);
+"""
+
+
+class SegmentStore:
+    """Append only segment files holding small objects, with an SQLite index of the segment, offset and size of
+    every object by key. Objects are appended to the active segment, a new segment is started once it grows past
+    segment_size. Reads are served from read only memory maps of the segments. Replaced and deleted objects leave
+    garbage in their segments, compact copies the live objects of mostly dead segments into the active segment and
+    deletes them. A store is shared by all the engines writing to its directory.
+
+    Attributes:
+        directory (Path): The directory of the segments and the index.
+        segment_size (int): The size after which a new segment is started.
+        compact_ratio (float): Segments with less than this share of live bytes are compacted.
+        fsync (bool): Flush every append to disk before it is indexed.
+        garbage_bytes (int): The size of the objects replaced or deleted since the last compaction.
+    """
+    _stores: Dict[Path, 'SegmentStore'] = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, directory: Union[str, Path], segment_size: int = SEGMENT_SIZE, compact_ratio: float = 0.5,
+                 fsync: bool = False):
+        self.directory = Path(directory).absolute()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.fsync = fsync
+        self.compacting = False
+        self.garbage_bytes = 0
+        self._lock = threading.RLock()
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._db = sqlite3.connect(str(self.directory / 'index.db'), check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        segments = sorted(int(path.stem) for path in self.directory.glob('*.seg'))
+        self.active = segments[-1] if segments else 0
+        self._file = open(self.segment_path(self.active), 'ab')
+
+    @classmethod
+    def shared(cls, directory: Union[str, Path]) -> 'SegmentStore':
+        """Get the shared store of a directory, creating it with the default settings if needed."""
+        directory = Path(directory).absolute()
+        with cls._stores_lock:
+            if (store := cls._stores.get(directory)) is None:
+                store = cls._stores[directory] = cls(directory)
+            return store
+
+    def segment_path(self, segment: int) -> Path:
+        return self.directory / f'{segment:08d}.seg'
+
+    def _append(self, data: bytes) -> Tuple[int, int]:
+        if self._file.tell() + len(data) > self.segment_size and self._file.tell():
+            self._file.close()
+            self.active += 1
+            self._file = open(self.segment_path(self.active), 'ab')
+            fsync_dir(self.directory) if self.fsync else ...
+        offset = self._file.tell()
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno()) if self.fsync else ...
+        return self.active, offset
+
+    def put(self, key: str, data: bytes, content_type: str = '', checksum: str = '') -> Tuple[int, int]:
+        """Append an object and index it, replacing the object with the same key.
+
+        Args:
+            key (str): The key of the object.
+            data (bytes): The content of the object.
+            content_type (str): The content type of the object.
+            checksum (str): The checksum of the object.
+
+        Returns:
+            tuple[int, int]: The segment and offset of the object.
+        """
+        with self._lock:
+            segment, offset = self._append(data)
+            if (old := self._db.execute('SELECT size FROM objects WHERE key = ?', (key,)).fetchone()) is not None:
+                self.garbage_bytes += old[0]
+            self._db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (key, segment, offset, len(data), content_type, checksum, time.time()))
+        return segment, offset
+
+    def locate(self, key: str) -> Optional[Tuple[int, int, int, str]]:
+        """Get the segment, offset, size and content type of an object, None if there is no such object."""
+        with self._lock:
+            return self._db.execute('SELECT segment, offset, size, content_type FROM objects WHERE key = ?',
+                                    (key,)).fetchone()
+
+    def _map(self, segment: int, end: int) -> mmap.mmap:
+        view = self._maps.get(segment)
+        if view is None or len(view) < end:
+            view.close() if view is not None else ...
+            with open(self.segment_path(segment), 'rb') as fh:
+                view = self._maps[segment] = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        return view
+
+    def read(self, key: str) -> Optional[bytes]:
+        """Read an object from the memory map of its segment.
+
+        Args:
+            key (str): The key of the object.
+
+        Returns:
+            bytes | None: The content of the object, None if there is no such object.
+        """
+        with self._lock:
+            if (location := self.locate(key)) is None:
+                return None
+            segment, offset, size, _ = location
+            return self._map(segment, offset + size)[offset: offset + size] if size else b''
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """Read an object without blocking the event loop. See read."""
+        return await to_thread(self.read, key)
+
+    def delete(self, key: str) -> bool:
+        """Remove an object from the index, its bytes are reclaimed by compaction.
+
+        Returns:
+            bool: True if the object existed.
+        """
+        with self._lock:
+            if (old := self._db.execute('SELECT size FROM objects WHERE key = ?', (key,)).fetchone()) is None:
+                return False
+            self._db.execute('DELETE FROM objects WHERE key = ?', (key,))
+            self.garbage_bytes += old[0]
+            return True
+
+    def copy(self, key: str, new_key: str, move: bool = False) -> bool:
+        """Copy an object to a new key, replacing the object with that key. A copy appends the bytes of the object
+        again so the two keys don't share a record, a move indexes the same bytes under the new key.
+
+        Args:
+            key (str): The key of the object.
+            new_key (str): The key of the copy.
+            move (bool): Remove the object from its old key.
+
+        Returns:
+            bool: True if the object existed.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT segment, offset, size, content_type, checksum FROM objects WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is None:
+                return False
+            if key == new_key:
+                return True
+            segment, offset, size, content_type, checksum = row
+            if not move:
+                data = self._map(segment, offset + size)[offset: offset + size] if size else b''
+                self.put(new_key, data, content_type, checksum)
+                return True
+            if (old := self._db.execute('SELECT size FROM objects WHERE key = ?', (new_key,)).fetchone()) is not None:
+                self.garbage_bytes += old[0]
+            self._db.execute('BEGIN')
+            try:
+                self._db.execute('DELETE FROM objects WHERE key = ?', (new_key,))
+                self._db.execute('UPDATE objects SET key = ? WHERE key = ?', (new_key, key))
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            return True
+
+    def needs_compaction(self) -> bool:
+        """Check if enough objects were replaced or deleted since the last compaction to compact."""
+        return not self.compacting and self.garbage_bytes >= self.segment_size * self.compact_ratio
+
+    def usage(self) -> Dict[int, Tuple[int, int]]:
+        """The total and live bytes of every segment."""
+        with self._lock:
+            live = dict(self._db.execute('SELECT segment, SUM(size) FROM objects GROUP BY segment').fetchall())
+            segments = sorted(int(path.stem) for path in self.directory.glob('*.seg'))
+            return {segment: (self.segment_path(segment).stat().st_size, live.get(segment, 0))
+                    for segment in segments}
+
+    def garbage(self) -> List[int]:
+        """The sealed segments with less than compact_ratio of live bytes."""
+        return [segment for segment, (total, live) in self.usage().items()
+                if segment != self.active and total and live / total < self.compact_ratio]
+
+    def compact(self) -> int:
+        """Copy the live objects of the garbage segments into the active segment and delete the garbage segments.
+        Objects are moved one at a time under the lock, so reads and writes carry on during compaction.
+
+        Returns:
+            int: The number of bytes reclaimed.
+        """
+        if self.compacting:
+            return 0
+        self.compacting = True
+        reclaimed = 0
+        try:
+            for segment in self.garbage():
+                with self._lock:
+                    keys = self._db.execute('SELECT key FROM objects WHERE segment = ?', (segment,)).fetchall()
+                for (key,) in keys:
+                    with self._lock:
+                        row = self._db.execute('SELECT offset, size FROM objects WHERE key = ? AND segment = ?',
+                                               (key, segment)).fetchone()
+                        if row is None:
+                            continue
+                        offset, size = row
+                        data = self._map(segment, offset + size)[offset: offset + size] if size else b''
+                        new_segment, new_offset = self._append(data)
+                        self._db.execute('UPDATE objects SET segment = ?, offset = ? WHERE key = ?',
+                                         (new_segment, new_offset, key))
+                with self._lock:
+                    path = self.segment_path(segment)
+                    reclaimed += path.stat().st_size
+                    view = self._maps.pop(segment, None)
+                    view.close() if view is not None else ...
+                    path.unlink()
+            self.garbage_bytes = 0
+            logger.info(f'Compacted segments in {self.directory}, reclaimed {reclaimed} bytes')
+        finally:
+            self.compacting = False
+        return reclaimed
+
+    async def compact_async(self) -> int:
+        """Compact without blocking the event loop. See compact."""
+        return await to_thread(self.compact)
+
+    def close(self):
+        with self._lock:
+            for view in self._maps.values():
+                view.close()
+            self._maps.clear()
+            self._file.close()
+            self._db.close()
+
+
+class PackedEngine(LocalEngine):
+    """Pack small files into segment files. Files up to pack_threshold bytes are appended to the SegmentStore of the
+    pack_dir config key, or to the SegmentStore given as the segments config key, and keyed by their destination.
+    Larger files, and files of unknown size, are saved by the LocalEngine. The url of a packed file is
+    pack://<key>, read it back with SegmentStore.read. Segments with too much garbage are compacted in a background
+    task after the response.
+
+    Config:
+        pack_threshold (int): The maximum size of packed files. Defaults to 16KB.
+        pack_dir (str | Path): The directory of the segments. Defaults to uploads/.segments.
+        segments (SegmentStore): The segment store to pack files into, overrides pack_dir.
+    """
+
+    @staticmethod
+    def key(file_field, dest) -> str:
+        """The key of a packed file, the destination path relative to the working directory when it is inside it."""
+        if dest is None:
+            folder = file_field.get('config', {}).get('destination') or 'uploads'
+            dest = Path(folder) / file_field['file'].filename
+        dest = Path(dest)
+        if dest.is_absolute():
+            try:
+                dest = dest.relative_to(Path.cwd())
+            except ValueError:
+                pass
+        return str(PurePosixPath(*dest.parts))
+
+    async def upload(self, file_field=None) -> FileData:
+        """Pack a small file into a segment or save a larger file with the LocalEngine.
+
+        Args:
+            file_field (FileField): A file field object.
+
+        Returns:
+            FileData: The result of the upload.
+        """
+        self.file_field = file_field
+        file_field = self.file_field
+        config, file = file_field.get('config', {}), file_field['file']
+        if file.size is None or file.size > config.get('pack_threshold', PACK_THRESHOLD):
+            return await super().upload(file_field=file_field)
+        try:
+            segments = config.get('segments') or SegmentStore.shared(config.get('pack_dir', 'uploads/.segments'))
+            key = self.key(file_field, await self.destination(file_field))
+            data = await file.read()
+            await file.close()
+            algorithm = config.get('checksum')
+            checksum = hashlib.new(algorithm, data).hexdigest() if algorithm else ''
+            segment, offset = await to_thread(segments.put, key, data, file.content_type or '', checksum)
+            if segments.needs_compaction() and self.background_tasks is not None:
+                self.background_tasks.add_task(self._compact, segments)
+            return FileData(size=len(data), filename=file.filename, content_type=file.content_type,
+                            url=f'pack://{key}', field_name=file_field['name'], checksum=checksum,
+                            metadata={'segment': segment, 'offset': offset},
+                            message=f'{file.filename} was packed successfully')
+        except Exception as err:
+            logger.error(f'Error uploading file: {err} in {self.__class__.__name__}')
+            raise FileStoreError(err)
+
+    async def delete(self, keys: Sequence[str], *, config: Config = None) -> BatchResult:
+        """Delete packed files by their pack:// url and other files by path. The bytes of packed files are reclaimed
+        by compaction. See StorageEngine.delete."""
+        config = config if config is not None else self.config
+        packed = [str(key) for key in keys if str(key).startswith('pack://')]
+        result = await super().delete([str(key) for key in keys if not str(key).startswith('pack://')],
+                                      config=config)
+        if packed:
+            segments = config.get('segments') or SegmentStore.shared(config.get('pack_dir', 'uploads/.segments'))
+            await to_thread(lambda: [segments.delete(key[len('pack://'):]) for key in packed])
+        return BatchResult.summary('delete', [*packed, *result.succeeded], result.failed)
+
+    async def _copy_packed(self, operation: str, pairs: Pairs, config: Config) -> BatchResult:
+        """Copy or move packed files by their pack:// url and other files by path. See StorageEngine.copy."""
+        config = config if config is not None else self.config
+        pairs = self.pairs(pairs)
+        packed = [(source, dest) for source, dest in pairs if source.startswith('pack://')]
+        others = [(source, dest) for source, dest in pairs if not source.startswith('pack://')]
+        result = await getattr(super(), operation)(others, config=config)
+        if not packed:
+            return result
+        segments = config.get('segments') or SegmentStore.shared(config.get('pack_dir', 'uploads/.segments'))
+        move, succeeded, failed = operation == 'move', [], {}
+        for source, dest in packed:
+            dest = dest if dest.startswith('pack://') else f'pack://{dest}'
+            try:
+                if await to_thread(segments.copy, source[len('pack://'):], dest[len('pack://'):], move):
+                    succeeded.append(dest)
+                else:
+                    failed[source] = f'No packed file {source}'
+            except (OSError, sqlite3.Error) as err:
+                failed[source] = str(err)
+        for key, error in failed.items():
+            logger.error(f'Error in {operation} of {key}: {error} in {self.__class__.__name__}')
+        return BatchResult.summary(operation, [*succeeded, *result.succeeded], {**failed, **result.failed})
+
+    async def copy(self, pairs: Pairs, *, config: Config = None) -> BatchResult:
+        """Copy packed files to new keys by their pack:// url and other files by path. See StorageEngine.copy."""
+        return await self._copy_packed('copy', pairs, config)
+
+    async def move(self, pairs: Pairs, *, config: Config = None) -> BatchResult:
+        """Move packed files to new keys by their pack:// url and other files by path. See StorageEngine.move."""
+        return await self._copy_packed('move', pairs, config)
+
+    @staticmethod
+    async def _compact(segments: SegmentStore):
+        try:
+            if await to_thread(segments.garbage):
+                await segments.compact_async()
+        except Exception as err:
+            logger.error(f'Error compacting segments: {err} in {segments.directory}')
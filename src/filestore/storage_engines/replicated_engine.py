@@ -0,0 +1,230 @@
+"""
+Replicated storage engine. Writes a single upload to several storage engines.
+"""
+import io
+import asyncio
+import hashlib
+import threading
+from collections import deque
+from logging import getLogger
+from typing import BinaryIO, Deque, List, Optional, Type, Union, Tuple, Sequence
+
+from ..exceptions import FileStoreError
+from ..structs import FileField, FileData, Config, UploadFile
+from ..util import to_thread
+from .storage_engine import StorageEngine
+from .local_engine import CHUNK_SIZE
+
+logger = getLogger(__name__)
+
+Replica = Union[Type[StorageEngine], Tuple[Type[StorageEngine], Config]]
+
+
+class Pipe(io.RawIOBase):
+    """A bounded pipe of the blocks of an upload to one replica. The blocks are written by the thread reading the
+    upload and read by the replica from any thread, a full pipe holds the writer back until the replica catches up.
+    A closed pipe drops the blocks written to it, so a replica that stops reading doesn't hold back the others.
+
+    Attributes:
+        depth (int): The number of blocks the pipe holds.
+    """
+
+    def __init__(self, depth: int = 4):
+        super().__init__()
+        self.depth = depth
+        self._blocks: Deque[bytes] = deque()
+        self._buffer = b''
+        self._position = 0
+        self._eof = False
+        self._error: Optional[BaseException] = None
+        self._cond = threading.Condition()
+
+    def readable(self) -> bool:
+        return True
+
+    def put(self, block: bytes):
+        """Write a block, waiting while the pipe is full. Dropped if the pipe is closed."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.closed or len(self._blocks) < self.depth)
+            if not self.closed:
+                self._blocks.append(block)
+                self._cond.notify_all()
+
+    def finish(self, error: BaseException = None):
+        """End the pipe after the last block, readers get the error if the upload could not be read."""
+        with self._cond:
+            self._eof, self._error = True, error
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            super().close()
+            self._blocks.clear()
+            self._cond.notify_all()
+
+    def read(self, size: int = -1) -> bytes:
+        chunks, wanted = [], size if size is not None and size >= 0 else None
+        with self._cond:
+            while wanted is None or wanted > 0:
+                if not self._buffer:
+                    self._cond.wait_for(lambda: self._blocks or self._eof or self.closed)
+                    if not self._blocks:
+                        if self._error is not None:
+                            raise self._error
+                        break
+                    self._buffer = self._blocks.popleft()
+                    self._cond.notify_all()
+                chunk = self._buffer if wanted is None else self._buffer[:wanted]
+                self._buffer = self._buffer[len(chunk):]
+                chunks.append(chunk)
+                wanted = None if wanted is None else wanted - len(chunk)
+        data = b''.join(chunks)
+        self._position += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # replicas can only rewind to where they are, the blocks they have read are gone.
+        if (whence == io.SEEK_SET and offset == self._position) or (whence == io.SEEK_CUR and offset == 0):
+            return self._position
+        raise io.UnsupportedOperation('A replica pipe can not be rewound')
+
+
+class ReplicatedEngine(StorageEngine):
+    """Fan out an upload to multiple storage engines.
+
+    The incoming file is read once in blocks of CHUNK_SIZE and every block is written to a bounded pipe per replica,
+    so the replicas are written concurrently and at most a few blocks of the file are held in memory whatever its size.
+    Replicas read the file as a stream, they are written in the foreground and can't rewind the file to retry.
+    The checksum is computed once as the file is read and recorded on the result of every replica that stored it.
+    Replicas are given as engine classes or as (engine class, config) pairs, the config of a pair is merged over the
+    field config for that replica only, e.g. to give a local and a cloud replica different destinations.
+
+    Config:
+        replicas (list): The replicas to write to, used when no engines are passed to the constructor.
+        quorum (str | int): all, any or the number of replicas that must succeed for the upload to succeed.
+            Defaults to all.
+    """
+
+    def __init__(self, *, engines: Sequence[Replica] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.engines = engines
+
+    @staticmethod
+    def required(quorum: Union[str, int], replicas: int) -> int:
+        """Get the number of replicas that must succeed.
+
+        Args:
+            quorum (str | int): all, any or a number of replicas.
+            replicas (int): The total number of replicas.
+
+        Returns:
+            int: The number of successful writes needed.
+        """
+        if quorum == 'all':
+            return replicas
+        if quorum == 'any':
+            return 1
+        if isinstance(quorum, int) and 0 < quorum <= replicas:
+            return quorum
+        raise FileStoreError(f'Invalid quorum {quorum} for {replicas} replicas')
+
+    async def _replicate(self, replica: Replica, file_field: FileField, pipe: Pipe) -> FileData:
+        engine_cls, config = replica if isinstance(replica, tuple) else (replica, {})
+        file = file_field['file']
+        copy = UploadFile(file=pipe, size=file.size, filename=file.filename, headers=file.headers)
+        # the blocks of the upload only last as long as the upload, so replicas are written in the foreground and
+        # leave the checksum to fan_out, a pipe can't be rewound after hashing it.
+        field = {**file_field, 'file': copy,
+                 'config': {**file_field.get('config', {}), **config, 'background': False, 'checksum': ''}}
+        field.pop('destination', None) if 'destination' in config else ...
+        try:
+            engine = engine_cls(request=self.request, form=self.form, background_tasks=self.background_tasks,
+                                file_field=field)
+            file_data = await engine.upload(file_field=field)
+        except FileStoreError as err:
+            logger.error(f'Error replicating {file.filename} to {engine_cls.__name__}: {err}')
+            file_data = FileData(status=False, error=str(err), field_name=field['name'], filename=file.filename,
+                                 message=f'Unable to upload {file.filename} to {engine_cls.__name__}')
+        finally:
+            pipe.close()
+        file_data.metadata = {**file_data.metadata, 'engine': engine_cls.__name__}
+        return file_data
+
+    @staticmethod
+    def fan_out(source: BinaryIO, pipes: List[Pipe], checksum: str = '') -> str:
+        """Read the upload in blocks and write every block to the pipe of each replica. Runs in a worker thread, so
+        replicas that read the file from the event loop don't hold back the blocks they are waiting for.
+
+        Args:
+            source (BinaryIO): The file of the upload.
+            pipes (list[Pipe]): The pipes of the replicas.
+            checksum (str): The name of a hashlib algorithm to compute the checksum of the file with.
+
+        Returns:
+            str: The hex digest of the blocks read if a checksum algorithm is given.
+        """
+        error, digest = None, hashlib.new(checksum) if checksum else None
+        try:
+            while not all(pipe.closed for pipe in pipes) and (block := source.read(CHUNK_SIZE)):
+                if digest is not None:
+                    digest.update(block)
+                for pipe in pipes:
+                    pipe.put(block)
+        except Exception as err:
+            error = FileStoreError(f'Unable to read the upload: {err}')
+        finally:
+            for pipe in pipes:
+                pipe.finish(error)
+        return digest.hexdigest() if digest is not None else ''
+
+    async def upload(self, *, file_field: FileField = None) -> FileData:
+        """Upload a file to all replicas.
+
+        Args:
+            file_field (FileField): A file field dict.
+
+        Returns:
+            FileData: The result of the first successful replica with the results of all replicas in replicas.
+        """
+        pipes: List[Pipe] = []
+        try:
+            self.file_field = file_field
+            file_field, config = self.file_field, self.config
+            replicas = list(self.engines or config.get('replicas', []))
+            if not replicas:
+                raise FileStoreError('No replicas configured')
+            needed = self.required(config.get('quorum', 'all'), len(replicas))
+            file = file_field['file']
+            pipes = [Pipe() for _ in replicas]
+            reader = asyncio.ensure_future(to_thread(self.fan_out, file.file, pipes, config.get('checksum', '')))
+            try:
+                results: List[FileData] = await asyncio.gather(*[self._replicate(replica, file_field, pipe)
+                                                                 for replica, pipe in zip(replicas, pipes)])
+            finally:
+                for pipe in pipes:
+                    pipe.close()
+                await asyncio.wait([reader])
+                await file.close()
+            stored = [result for result in results if result.status]
+            # a replica that stored the file read all of it, so the digest covers the whole file.
+            if not reader.exception() and (checksum := reader.result()):
+                for result in stored:
+                    result.checksum = checksum
+            if len(stored) >= needed:
+                return stored[0].model_copy(update={'replicas': results, 'metadata': {
+                    **stored[0].metadata, 'replicas': len(stored)}})
+            return FileData(status=False, filename=file.filename, size=file.size, content_type=file.content_type,
+                            field_name=file_field['name'], replicas=results,
+                            error=f'{len(stored)} of {needed} required replicas stored',
+                            message=f'Unable to upload {file.filename}')
+        except Exception as err:
+            logger.error(f'Error uploading file: {err} in {self.__class__.__name__}')
+            raise FileStoreError(err)
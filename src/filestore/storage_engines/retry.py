@@ -0,0 +1,238 @@
+"""
+Retries, deadlines, hedged requests and a circuit breaker for calls to remote storage.
+"""
+import time
+import random
+import asyncio
+from collections import deque
+from logging import getLogger
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+try:
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError, HTTPClientError, ReadTimeoutError, \
+        ConnectionError as BotoConnectionError
+except ImportError:
+    BotoConfig = None
+    ClientError = HTTPClientError = ReadTimeoutError = BotoConnectionError = ()
+
+from ..exceptions import FileStoreError
+
+logger = getLogger(__name__)
+
+RETRYABLE_CODES = {'RequestTimeout', 'RequestTimeoutException', 'Throttling', 'ThrottlingException', 'SlowDown',
+                   'RequestLimitExceeded', 'TooManyRequestsException', 'InternalError', 'ServiceUnavailable',
+                   'PriorRequestNotComplete'}
+
+
+def retryable(err: BaseException) -> bool:
+    """Check if a failed call can be retried. Connection errors, timeouts, throttling and server errors are transient,
+    other client errors such as AccessDenied or NoSuchBucket are not.
+
+    Args:
+        err (BaseException): The error of the call.
+
+    Returns:
+        bool: True if the call should be retried.
+    """
+    if isinstance(err, ClientError):
+        error = err.response.get('Error', {})
+        status = err.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return error.get('Code') in RETRYABLE_CODES or status == 429 or status >= 500
+    # botocore's EndpointConnectionError and ConnectTimeoutError derive from its own ConnectionError, not the builtin.
+    return isinstance(err, (HTTPClientError, BotoConnectionError, ReadTimeoutError, ConnectionError, TimeoutError))
+
+
+class CircuitBreaker:
+    """Fail fast while an endpoint is unhealthy. The circuit opens after a number of consecutive transient failures,
+    after reset_after seconds a single probe is let through and its result closes or reopens the circuit.
+
+    Attributes:
+        failures (int): The number of consecutive failures that open the circuit.
+        reset_after (float): The number of seconds the circuit stays open before a probe is allowed.
+    """
+
+    def __init__(self, failures: int = 5, reset_after: float = 30.0):
+        self.failures = failures
+        self.reset_after = reset_after
+        self._count = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        """closed, open or half-open."""
+        if self._opened_at is None:
+            return 'closed'
+        return 'half-open' if self._probing or time.monotonic() - self._opened_at >= self.reset_after else 'open'
+
+    def allow(self) -> bool:
+        """Check if a call can be made, claiming the probe of a half open circuit.
+
+        Returns:
+            bool: True if the call can be made.
+        """
+        if self._opened_at is None:
+            return True
+        if not self._probing and time.monotonic() - self._opened_at >= self.reset_after:
+            self._probing = True
+            return True
+        return False
+
+    def success(self):
+        self._count = 0
+        self._opened_at = None
+        self._probing = False
+
+    def release(self):
+        """Give up the probe of a half open circuit without a result, e.g. when the call was cancelled, so the next
+        call probes again."""
+        self._probing = False
+
+    def failure(self):
+        self._count += 1
+        if self._probing or self._count >= self.failures:
+            if self._opened_at is None or self._probing:
+                logger.warning(f'Circuit opened after {self._count} consecutive failures')
+            self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class RetryPolicy:
+    """Retry transient failures with capped exponential backoff and full jitter within a deadline. Calls for small
+    objects can be hedged, a second attempt starts if the first one is slower than a quantile of the recent latencies
+    and the first to succeed wins. Pass one shared instance as the retry config key of the stores using the S3Engine,
+    the latencies and the circuit breaker are shared by all the uploads using it.
+
+    Cancelled attempts of the S3Engine stop at the next read of the file in their worker thread, hedged attempts send
+    the bytes of small files and can't be interrupted, the connect and read timeouts of the client bound how long
+    they linger.
+
+    Attributes:
+        attempts (int): The maximum number of attempts of a call.
+        base_delay (float): The backoff before the first retry in seconds, doubled for each retry.
+        max_delay (float): The maximum backoff in seconds.
+        deadline (float | None): The maximum time in seconds for all the attempts of a call.
+        hedge_size (int): Calls for objects up to this size in bytes are hedged. Zero disables hedging.
+        hedge_quantile (float): The latency quantile after which a hedged attempt is started.
+        min_samples (int): The number of latencies recorded before calls are hedged.
+        connect_timeout (float): The connect timeout of the client.
+        read_timeout (float): The read timeout of the client.
+        breaker (CircuitBreaker): The circuit breaker of the endpoint.
+    """
+
+    def __init__(self, attempts: int = 4, base_delay: float = 0.1, max_delay: float = 5.0,
+                 deadline: Optional[float] = 60.0, hedge_size: int = 0, hedge_quantile: float = 0.95,
+                 min_samples: int = 20, window: int = 500, connect_timeout: float = 5.0, read_timeout: float = 30.0,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.attempts = max(attempts, 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.hedge_size = hedge_size
+        self.hedge_quantile = hedge_quantile
+        self.min_samples = min_samples
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = deque(maxlen=window)
+        self.counts = {'calls': 0, 'retries': 0, 'hedges': 0, 'hedge_wins': 0, 'failures': 0, 'rejected': 0}
+
+    def client_config(self):
+        """A botocore config with the timeouts of the policy and without the retries of botocore, so attempts are
+        not retried twice."""
+        return BotoConfig(connect_timeout=self.connect_timeout, read_timeout=self.read_timeout,
+                          retries={'max_attempts': 0})
+
+    def backoff(self, retry: int) -> float:
+        """The delay before a retry, drawn uniformly up to the capped exponential backoff."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+    def hedge_delay(self) -> Optional[float]:
+        """The latency quantile after which a hedged attempt starts, None until enough latencies are recorded."""
+        if len(self.latencies) < self.min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * self.hedge_quantile), len(latencies) - 1)]
+
+    def hedges(self, size: Optional[int]) -> bool:
+        """Check if the call for an object of the given size is hedged."""
+        return bool(self.hedge_size) and size is not None and size <= self.hedge_size
+
+    async def _hedged(self, func: Callable[[], Awaitable]) -> Any:
+        delay = self.hedge_delay()
+        first = asyncio.ensure_future(func())
+        if delay is None:
+            return await first
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                self.counts['hedges'] += 1
+                pending.add(asyncio.ensure_future(func()))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.counts['hedge_wins'] += task is not first
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def run(self, func: Callable[[], Awaitable], *, hedge: bool = False) -> Any:
+        """Call a function until it succeeds, fails with an error that can't be retried, runs out of attempts or
+        reaches the deadline.
+
+        Args:
+            func (Callable[[], Awaitable]): A function without arguments returning a new attempt of the call.
+            hedge (bool): Start a second attempt if the first one is slow. The attempts must be safe to run at once.
+
+        Returns:
+            Any: The result of the call.
+        """
+        self.counts['calls'] += 1
+        start = time.monotonic()
+        error: Optional[BaseException] = None
+        for attempt in range(self.attempts):
+            if not self.breaker.allow():
+                self.counts['rejected'] += 1
+                raise FileStoreError(f'Circuit is open, failing fast{f" after {error}" if error else ""}')
+            remaining = None if self.deadline is None else self.deadline - (time.monotonic() - start)
+            began = time.monotonic()
+            try:
+                result = await asyncio.wait_for(self._hedged(func) if hedge else func(), remaining)
+                self.breaker.success()
+                self.latencies.append(time.monotonic() - began)
+                return result
+            except asyncio.TimeoutError:
+                self.breaker.failure()
+                self.counts['failures'] += 1
+                raise FileStoreError(f'Deadline of {self.deadline}s exceeded after {attempt + 1} attempts')
+            except Exception as err:
+                if not retryable(err):
+                    # an endpoint that answered is healthy even if the call can't succeed, a local error says nothing
+                    # about it and only gives up the probe.
+                    self.breaker.success() if isinstance(err, ClientError) else self.breaker.release()
+                    raise
+                self.breaker.failure()
+                error = err
+            except BaseException:
+                self.breaker.release()
+                raise
+            delay = self.backoff(attempt)
+            if attempt + 1 == self.attempts or (self.deadline is not None
+                                                 and time.monotonic() + delay - start >= self.deadline):
+                break
+            logger.warning(f'Retrying in {delay:.3f}s after attempt {attempt + 1} failed: {error}')
+            self.counts['retries'] += 1
+            await asyncio.sleep(delay)
+        self.counts['failures'] += 1
+        raise FileStoreError(f'Giving up after {attempt + 1} attempts: {error}')
+
+    def stats(self) -> Dict[str, Any]:
+        """The call counts, the state of the circuit and the current hedge delay."""
+        return {**self.counts, 'circuit': self.breaker.state, 'hedge_delay': self.hedge_delay()}
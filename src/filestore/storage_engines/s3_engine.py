@@ -2,51 +2,120 @@
 
 import os
 import asyncio
-from typing import BinaryIO
+import hashlib
+import threading
+from functools import partial
+from typing import Any, BinaryIO, Dict, List, Optional, Sequence
 from urllib.parse import quote as urlencode
 from logging import getLogger
-try:
-    from functools import cache
-except ImportError:
-    from functools import lru_cache
-    cache = lru_cache(maxsize=None)
 
 import boto3
+from botocore.exceptions import ClientError
 
 from ..exceptions import FileStoreError
-from ..structs import FileField, UploadFile, FileData
-from .storage_engine import StorageEngine
+from ..structs import FileField, UploadFile, FileData, BatchResult, Config
+from ..util import to_thread
+from ..forms import spool_settings, SpoolSettings
+from .retry import RetryPolicy
+from .limiter import AdaptiveLimiter
+from .s3_process import S3ProcessPool, MEMORY_SIZE, CHUNK_SIZE
+from .storage_engine import StorageEngine, Pairs
 
 logger = getLogger(__name__)
 
+DELETE_BATCH = 1000
+COPY_PART_SIZE = 512 * 1024 ** 2
+
 
 async def make_async(func, *args, **kwargs):
     return func(*args, **kwargs)
 
 
+class UploadCancelled(Exception):
+    """Raised in the worker thread of a put_object call when its upload was cancelled."""
+
+
+class CancellableBody:
+    """The body of a put_object call that fails its next read once the upload is cancelled, so the worker thread
+    aborts the request instead of sending the rest of the file to S3 for a client that is gone.
+
+    Attributes:
+        file_obj (BinaryIO): The file object of the body.
+        cancelled (threading.Event): Set when the upload is cancelled.
+    """
+
+    def __init__(self, file_obj: BinaryIO, cancelled: threading.Event):
+        self.file_obj = file_obj
+        self.cancelled = cancelled
+
+    def read(self, *args) -> bytes:
+        if self.cancelled.is_set():
+            raise UploadCancelled('The upload was cancelled')
+        return self.file_obj.read(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.file_obj, name)
+
+
+async def cancellable(func, *args, cancelled: threading.Event, **kwargs) -> Any:
+    """Run a blocking call in a worker thread and set the cancelled event if the awaiting task is cancelled."""
+    try:
+        return await to_thread(func, *args, **kwargs)
+    except asyncio.CancelledError:
+        cancelled.set()
+        raise
+
+
 class S3Engine(StorageEngine):
     """Amazon S3 storage for FastAPI.
 
+    Clients are created once per region, credentials and retry policy and shared by all the engines of the process,
+    boto3 clients are thread safe and keep their own connection pool. When an AdaptiveLimiter is set as the limiter
+    class attribute or config key, the foreground and background uploads of the worker go through it. A put_object
+    call whose upload is cancelled, e.g. when the client disconnects, fails at the next read of its body. With the
+    process_pool config key the uploads run in the worker processes of an S3ProcessPool.
+
+    Objects are deleted with DeleteObjects calls of up to 1000 keys and copied server side with CopyObject, or with
+    UploadPartCopy for objects over the 5GB limit of CopyObject, so the data never leaves S3. The calls of a batch run
+    batch_concurrency at a time.
+
     Properties:
         client (boto3.client): The S3 client.
     """
+    _clients: Dict[tuple, Any] = {}
+    _lock = threading.Lock()
+    limiter: Optional[AdaptiveLimiter] = None
 
     @property
-    @cache
     def client(self):
         """
         Get the S3 client. Make sure the AWS credentials are set in the environment variables.
-        This property is cached.
+        The clients are cached at class level by region, credentials and retry policy. The cache holds the policy so
+        a client is never handed to another policy.
 
         Returns:
             boto3.client: The S3 client.
         """
+        return self.get_client(self.config)
+
+    @classmethod
+    def get_client(cls, config: Config):
+        """Get the cached S3 client of a config. See client."""
         key_id = os.environ.get('AWS_ACCESS_KEY_ID')
         access_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
-        region_name = os.environ.get('AWS_DEFAULT_REGION') or self.config.get('region')
-        return boto3.client('s3', region_name=region_name, aws_access_key_id=key_id, aws_secret_access_key=access_key)
+        region_name = os.environ.get('AWS_DEFAULT_REGION') or config.get('region')
+        retry = config.get('retry')
+        key = (region_name, key_id, access_key, retry)
+        if (client := cls._clients.get(key)) is None:
+            with cls._lock:
+                if (client := cls._clients.get(key)) is None:
+                    client = cls._clients[key] = boto3.client(
+                        's3', region_name=region_name, aws_access_key_id=key_id, aws_secret_access_key=access_key,
+                        config=retry.client_config() if retry else None)
+        return client
 
-    async def _upload(self, *, file_obj: BinaryIO, bucket: str, obj_name: str, extra_args: dict) -> dict:
+    async def _upload(self, *, file_obj: BinaryIO, bucket: str, obj_name: str, extra_args: dict,
+                      retry: RetryPolicy = None, size: int = None, limiter: AdaptiveLimiter = None) -> dict:
         """
         Private method to upload the file to the destination. This method is called by the upload method.
 
@@ -55,17 +124,87 @@ class S3Engine(StorageEngine):
             bucket (str): The name of the bucket to upload the file to.
             obj_name (str): The name of the object.
             extra_args (dict): Extra arguments to pass to the put_object method.
+            retry (RetryPolicy): The retry policy of the upload.
+            size (int): The size of the file, small files are hedged by the retry policy.
+            limiter (AdaptiveLimiter): The concurrency limiter of the put_object calls.
 
         Returns:
             None: Nothing is returned.
         """
+        if retry is not None:
+            return await self._retry_upload(file_obj=file_obj, bucket=bucket, obj_name=obj_name,
+                                            extra_args=extra_args, retry=retry, size=size, limiter=limiter)
+        cancelled = threading.Event()
+        put = partial(cancellable, self.client.put_object, Body=CancellableBody(file_obj, cancelled), Bucket=bucket,
+                      Key=obj_name, cancelled=cancelled, **extra_args)
+        return await (limiter.run(put) if limiter is not None else put())
+
+    async def _retry_upload(self, *, file_obj: BinaryIO, bucket: str, obj_name: str, extra_args: dict,
+                            retry: RetryPolicy, size: int = None, limiter: AdaptiveLimiter = None) -> dict:
+        """
+        Private method to upload the file with a retry policy. Every attempt rewinds the file, hedged attempts of
+        small files share the bytes of the file instead.
+
+        Args:
+            file_obj (BinaryIO): The file object to upload.
+            bucket (str): The name of the bucket to upload the file to.
+            obj_name (str): The name of the object.
+            extra_args (dict): Extra arguments to pass to the put_object method.
+            retry (RetryPolicy): The retry policy of the upload.
+            size (int): The size of the file.
+            limiter (AdaptiveLimiter): The concurrency limiter, every attempt takes a slot of its own.
+
+        Returns:
+            dict: The response of put_object.
+        """
+        hedge = retry.hedges(size)
+        start = file_obj.tell()
+        body = file_obj.read() if hedge else None
+        cancelled = threading.Event()
+
+        def put():
+            if body is None:
+                file_obj.seek(start)
+            return self.client.put_object(Body=CancellableBody(file_obj, cancelled) if body is None else body,
+                                          Bucket=bucket, Key=obj_name, **extra_args)
+
+        attempt = partial(cancellable, put, cancelled=cancelled)
+        return await retry.run(partial(limiter.run, attempt) if limiter is not None else attempt, hedge=hedge)
+
+    async def _process_upload(self, *, file_obj: BinaryIO, bucket: str, obj_name: str, extra_args: dict,
+                              pool: S3ProcessPool, retry: RetryPolicy = None, size: int = None,
+                              limiter: AdaptiveLimiter = None, spool: SpoolSettings = (MEMORY_SIZE, None)) -> dict:
+        """
+        Private method to upload the file in a worker process of the pool. The file is passed by path if it is on
+        disk, files without a path are copied to a temporary file first. Attempts are retried by the retry policy but
+        not hedged.
+
+        Args:
+            file_obj (BinaryIO): The file object to upload.
+            bucket (str): The name of the bucket to upload the file to.
+            obj_name (str): The name of the object.
+            extra_args (dict): Extra arguments to pass to the put_object method.
+            pool (S3ProcessPool): The worker processes.
+            retry (RetryPolicy): The retry policy of the upload.
+            size (int): The size of the file.
+            limiter (AdaptiveLimiter): The concurrency limiter of the transfers.
+            spool (tuple[int, str | Path | None]): The spool size and directory of the upload, files in memory under
+                the spool size are sent as bytes.
+
+        Returns:
+            dict: The response metadata of the transfer.
+        """
+        source = await to_thread(S3ProcessPool.source, file_obj, *spool)
         try:
-            return await asyncio.to_thread(self.client.put_object, Body=file_obj, Bucket=bucket, Key=obj_name, **extra_args)
-        except AttributeError:
-            return await make_async(self.client.put_object, Body=file_obj, Bucket=bucket, Key=obj_name, **extra_args)
+            attempt = partial(pool.upload, source, bucket, obj_name, extra_args, size)
+            attempt = partial(limiter.run, attempt) if limiter is not None else attempt
+            return await (retry.run(attempt) if retry is not None else attempt())
+        finally:
+            await to_thread(S3ProcessPool.discard, source, file_obj)
 
     async def _background_upload(self, *, file_obj: BinaryIO, bucket: str, obj_name: str,
-                                 extra_args: dict) -> UploadFile:
+                                 extra_args: dict, retry: RetryPolicy = None,
+                                 limiter: AdaptiveLimiter = None, file_data: FileData = None) -> UploadFile:
         """
         Private method to upload the file to the destination. This method is called by the upload method for background
         tasks. Uses upload_fileobj method to upload the file. This allows the file to be uploaded in chunks.
@@ -75,14 +214,65 @@ class S3Engine(StorageEngine):
             bucket (str): The name of the bucket to upload the file to.
             obj_name (str): The name of the object.
             extra_args (dict): Extra arguments to pass to the put_object method.
+            retry (RetryPolicy): The retry policy of the upload.
+            limiter (AdaptiveLimiter): The concurrency limiter, every attempt takes a slot of its own.
+            file_data (FileData): The result of the upload. A failed upload marks it as failed instead of raising, so
+                the index, which runs after the uploads, leaves it out.
 
         Returns:
             None: Nothing is returned.
         """
         try:
-            return await asyncio.to_thread(self.client.upload_fileobj, file_obj, bucket, obj_name, ExtraArgs=extra_args)
-        except AttributeError:
-            return await make_async(self.client.upload_fileobj, file_obj, bucket, obj_name, ExtraArgs=extra_args)
+            return await self._send_background(file_obj=file_obj, bucket=bucket, obj_name=obj_name,
+                                               extra_args=extra_args, retry=retry, limiter=limiter)
+        except Exception as err:
+            if file_data is None:
+                raise
+            logger.error(f'Error uploading file: {err} in {self.__class__.__name__}')
+            file_data.status, file_data.error = False, str(err)
+            file_data.message = f'Unable to upload {file_data.filename}'
+
+    async def _send_background(self, *, file_obj: BinaryIO, bucket: str, obj_name: str, extra_args: dict,
+                               retry: RetryPolicy = None, limiter: AdaptiveLimiter = None):
+        if retry is not None:
+            start = file_obj.tell()
+
+            def upload():
+                file_obj.seek(start)
+                return self.client.upload_fileobj(file_obj, bucket, obj_name, ExtraArgs=extra_args)
+
+            attempt = partial(to_thread, upload)
+            return await retry.run(partial(limiter.run, attempt) if limiter is not None else attempt)
+
+        async def attempt():
+            try:
+                return await asyncio.to_thread(self.client.upload_fileobj, file_obj, bucket, obj_name,
+                                               ExtraArgs=extra_args)
+            except AttributeError:
+                return await make_async(self.client.upload_fileobj, file_obj, bucket, obj_name, ExtraArgs=extra_args)
+
+        return await (limiter.run(attempt) if limiter is not None else attempt())
+
+    @staticmethod
+    def _checksum(file_obj: BinaryIO, algorithm: str) -> str:
+        """Hash the file from its current position, then rewind it for the upload.
+
+        Args:
+            file_obj (BinaryIO): The file object to upload.
+            algorithm (str): The name of a hashlib algorithm.
+
+        Returns:
+            str: The hex digest of the file.
+        """
+        start, digest = file_obj.tell(), hashlib.new(algorithm)
+        while chunk := file_obj.read(CHUNK_SIZE):
+            digest.update(chunk)
+        file_obj.seek(start)
+        return digest.hexdigest()
+
+    async def _record_checksum(self, file_obj: BinaryIO, algorithm: str, file_data: FileData):
+        """Compute the checksum of a background upload before it is sent and record it on its FileData."""
+        file_data.checksum = await to_thread(self._checksum, file_obj, algorithm)
 
     # noinspection PyTypeChecker
     async def upload(self, *, file_field: FileField = None) -> FileData:
@@ -96,28 +286,116 @@ class S3Engine(StorageEngine):
         """
         try:
             self.file_field = file_field
-            field_name, file = self.file_field['name'], self.file_field['file']
-            dest = self.config.get('destination', '')
-            object_name = dest(self.request, self.form, field_name, file) if callable(dest) else \
-                (f'{dest}/{file.filename}' if dest else file.filename)
-            bucket = self.config.get('bucket') or os.environ.get('AWS_BUCKET_NAME')
-            region = self.config.get('region') or os.environ.get('AWS_DEFAULT_REGION')
-            extra_args = self.config.get('extra_args', {})
-            msg, meta = '', {}
-            if self.config.get('background'):
-                self.background_tasks.add_task(self._background_upload, file_obj=file.file, bucket=bucket,
-                                               obj_name=object_name, extra_args=extra_args)
+            file_field = self.file_field
+            field_name, file, config = file_field['name'], file_field['file'], file_field.get('config', {})
+            dest = config.get('destination', '')
+            object_name = await self.destination(file_field)
+            object_name = (f'{dest}/{file.filename}' if dest else file.filename) if object_name is None \
+                else str(object_name)
+            bucket = config.get('bucket') or os.environ.get('AWS_BUCKET_NAME')
+            region = config.get('region') or os.environ.get('AWS_DEFAULT_REGION')
+            extra_args = config.get('extra_args', {})
+            retry, algorithm = config.get('retry'), config.get('checksum')
+            limiter = config.get('limiter', self.limiter)
+            url = f"https://{bucket}.s3.{region}.amazonaws.com/{urlencode(object_name.encode('utf8'))}"
+            if config.get('background') and self.background_tasks is not None:
                 msg = f'{file.filename} uploading in background'
+                file_data = FileData(filename=file.filename, size=file.size, content_type=file.content_type,
+                                     field_name=field_name, url=url, message=msg)
+                # the checksum task runs before the upload task reads the file.
+                if algorithm:
+                    self.background_tasks.add_task(self._record_checksum, file.file, algorithm, file_data)
+                self.background_tasks.add_task(self._background_upload, file_obj=file.file, bucket=bucket,
+                                               obj_name=object_name, extra_args=extra_args, retry=retry,
+                                               limiter=limiter, file_data=file_data)
+                return file_data
+            checksum = await to_thread(self._checksum, file.file, algorithm) if algorithm else ''
+            upload = self._upload
+            if pool := config.get('process_pool'):
+                upload = partial(self._process_upload, pool=pool, spool=spool_settings(config))
+            res = await upload(file_obj=file.file, bucket=bucket, obj_name=object_name, extra_args=extra_args,
+                               retry=retry, size=file.size, limiter=limiter)
+            if (meta := res.get('ResponseMetadata', {})).get('HTTPStatusCode', 0) == 200:
+                msg = f'{file.filename} successfully uploaded'
             else:
-                res = await self._upload(file_obj=file.file, bucket=bucket, obj_name=object_name,
-                                         extra_args=extra_args)
-                if (meta := res.get('ResponseMetadata', {})).get('HTTPStatusCode', 0) == 200:
-                    msg = f'{file.filename} successfully uploaded'
-                else:
-                    msg = f'Error uploading {file.filename}'
-            url = f"https://{bucket}.s3.{region}.amazonaws.com/{urlencode(object_name.encode('utf8'))}"
+                msg = f'Error uploading {file.filename}'
             return FileData(filename=file.filename, size=file.size, content_type=file.content_type,
-                            field_name=field_name, url=url, message=msg, metadata=meta)
+                            field_name=field_name, url=url, message=msg, metadata=meta, checksum=checksum)
         except Exception as err:
             logger.error(f'Error uploading file: {err} in {self.__class__.__name__}')
-            raise FileStoreError(err)
\ No newline at end of file
+            raise FileStoreError(err)
+
+    def _bucket(self, config: Config) -> str:
+        return config.get('bucket') or os.environ.get('AWS_BUCKET_NAME')
+
+    async def _calls(self, calls: List, config: Config) -> List:
+        """Run blocking calls in worker threads, batch_concurrency at a time, with their errors as results."""
+        semaphore = asyncio.Semaphore(max(1, config.get('batch_concurrency', 16)))
+
+        async def run(call):
+            async with semaphore:
+                return await to_thread(call)
+
+        return await asyncio.gather(*[run(call) for call in calls], return_exceptions=True)
+
+    async def delete(self, keys: Sequence[str], *, config: Config = None) -> BatchResult:
+        """Delete objects with DeleteObjects calls of up to 1000 keys. See StorageEngine.delete."""
+        config = config if config is not None else self.config
+        client, bucket, keys = self.get_client(config), self._bucket(config), [str(key) for key in keys]
+        chunks = [keys[start: start + DELETE_BATCH] for start in range(0, len(keys), DELETE_BATCH)]
+        calls = [partial(client.delete_objects, Bucket=bucket, Delete={'Objects': [{'Key': key} for key in chunk],
+                                                                       'Quiet': True}) for chunk in chunks]
+        succeeded, failed = [], {}
+        for chunk, res in zip(chunks, await self._calls(calls, config)):
+            if isinstance(res, BaseException):
+                logger.error(f'Error deleting objects: {res} in {self.__class__.__name__}')
+                failed.update((key, str(res)) for key in chunk)
+                continue
+            errors = {error['Key']: f"{error.get('Code', '')}: {error.get('Message', '')}"
+                      for error in res.get('Errors', [])}
+            failed.update(errors)
+            succeeded.extend(key for key in chunk if key not in errors)
+        return BatchResult.summary('delete', succeeded, failed)
+
+    @staticmethod
+    def _copy_object(client, bucket: str, source: str, dest: str) -> str:
+        """Copy an object server side, in parts with UploadPartCopy if it is over the limit of CopyObject."""
+        copy_source = {'Bucket': bucket, 'Key': source}
+        try:
+            client.copy_object(Bucket=bucket, Key=dest, CopySource=copy_source)
+            return dest
+        except ClientError as err:
+            if err.response.get('Error', {}).get('Code') != 'InvalidRequest':
+                raise
+        head = client.head_object(Bucket=bucket, Key=source)
+        size = head['ContentLength']
+        content_type = head.get('ContentType', 'binary/octet-stream')
+        upload_id = client.create_multipart_upload(Bucket=bucket, Key=dest, Metadata=head.get('Metadata', {}),
+                                                   ContentType=content_type)['UploadId']
+        try:
+            parts = []
+            for number, start in enumerate(range(0, size, COPY_PART_SIZE), 1):
+                res = client.upload_part_copy(Bucket=bucket, Key=dest, UploadId=upload_id, PartNumber=number,
+                                              CopySource=copy_source,
+                                              CopySourceRange=f'bytes={start}-{min(start + COPY_PART_SIZE, size) - 1}')
+                parts.append({'PartNumber': number, 'ETag': res['CopyPartResult']['ETag']})
+            client.complete_multipart_upload(Bucket=bucket, Key=dest, UploadId=upload_id,
+                                             MultipartUpload={'Parts': parts})
+        except BaseException:
+            client.abort_multipart_upload(Bucket=bucket, Key=dest, UploadId=upload_id)
+            raise
+        return dest
+
+    async def copy(self, pairs: Pairs, *, config: Config = None) -> BatchResult:
+        """Copy objects server side within the bucket. See StorageEngine.copy."""
+        config = config if config is not None else self.config
+        client, bucket, pairs = self.get_client(config), self._bucket(config), self.pairs(pairs)
+        calls = [partial(self._copy_object, client, bucket, source, dest) for source, dest in pairs]
+        succeeded, failed = [], {}
+        for (source, dest), res in zip(pairs, await self._calls(calls, config)):
+            if isinstance(res, BaseException):
+                logger.error(f'Error copying {source} to {dest}: {res} in {self.__class__.__name__}')
+                failed[source] = str(res)
+            else:
+                succeeded.append(dest)
+        return BatchResult.summary('copy', succeeded, failed)
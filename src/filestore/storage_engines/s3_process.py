@@ -0,0 +1,186 @@
+"""
+A pool of worker processes for S3 transfers. Signing, request building and the chunking of multipart uploads run in
+the workers instead of threads of the event loop process, so they don't compete with the request handlers for the GIL.
+"""
+import io
+import os
+import shutil
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from logging import getLogger
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Any, BinaryIO, Dict, Optional, Tuple, Union
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+logger = getLogger(__name__)
+
+# a file on disk as (path, offset), or the bytes of a file in memory.
+Source = Union[Tuple[str, int], bytes]
+
+MEMORY_SIZE = 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+COPY_PREFIX = 's3-transfer-'
+
+_client = None
+_transfer_config: Optional[TransferConfig] = None
+
+
+def _init(region: Optional[str], client_config: Any, multipart_threshold: int, max_concurrency: int):
+    """Create the client of a worker process once, it is reused by every transfer of the worker."""
+    global _client, _transfer_config
+    _client = boto3.client('s3', region_name=region, aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
+                           aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'), config=client_config)
+    _transfer_config = TransferConfig(multipart_threshold=multipart_threshold, max_concurrency=max_concurrency)
+
+
+def _transfer(source: Source, bucket: str, key: str, extra_args: dict, size: Optional[int]) -> dict:
+    """Upload a file in a worker process. Files under the multipart threshold are sent with put_object, larger ones
+    with upload_fileobj in parts.
+
+    Returns:
+        dict: The ResponseMetadata, ETag and VersionId of the response.
+    """
+    if isinstance(source, bytes):
+        response = _client.put_object(Body=source, Bucket=bucket, Key=key, **extra_args)
+    else:
+        path, offset = source
+        with open(path, 'rb') as fh:
+            fh.seek(offset)
+            if size is not None and size < _transfer_config.multipart_threshold:
+                response = _client.put_object(Body=fh, Bucket=bucket, Key=key, **extra_args)
+            else:
+                _client.upload_fileobj(fh, bucket, key, ExtraArgs=extra_args, Config=_transfer_config)
+                response = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+    return {name: response[name] for name in ('ResponseMetadata', 'ETag', 'VersionId') if name in response}
+
+
+class S3ProcessPool:
+    """Worker processes with a persistent S3 client each. Files spooled to disk are passed to the workers by path and
+    read there, only files held in memory under the spool size are sent as bytes, other files are copied to a named
+    temporary file first. Pass a pool as the process_pool config key of the S3Engine, a pool is shared by all the
+    requests of the worker and its processes are started on the first transfer. The workers are spawned, not forked,
+    so they don't inherit the threads and locks of the server, and read the AWS credentials from the environment.
+
+    Attributes:
+        processes (int): The number of worker processes. Defaults to the number of cpus.
+        region (str | None): The region of the clients. Defaults to AWS_DEFAULT_REGION.
+        client_config (botocore.config.Config | None): The config of the clients, e.g. RetryPolicy.client_config().
+        multipart_threshold (int): Files from this size are uploaded in parts. Defaults to 8MB.
+        max_concurrency (int): The threads uploading the parts of a file in a worker.
+    """
+    _pools: Dict[tuple, 'S3ProcessPool'] = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, processes: Optional[int] = None, region: Optional[str] = None, client_config: Any = None,
+                 multipart_threshold: int = 8 * 1024 ** 2, max_concurrency: int = 4, start_method: str = 'spawn'):
+        self.processes = processes or os.cpu_count() or 1
+        self.region = region or os.environ.get('AWS_DEFAULT_REGION')
+        self.client_config = client_config
+        self.multipart_threshold = multipart_threshold
+        self.max_concurrency = max_concurrency
+        self.start_method = start_method
+        self.submitted = 0
+        self.inflight = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, region: Optional[str] = None) -> 'S3ProcessPool':
+        """Get the shared pool of a region, creating it with the default settings if needed."""
+        with cls._pools_lock:
+            if (pool := cls._pools.get((region,))) is None:
+                pool = cls._pools[(region,)] = cls(region=region)
+            return pool
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.processes, mp_context=multiprocessing.get_context(self.start_method),
+                        initializer=_init, initargs=(self.region, self.client_config, self.multipart_threshold,
+                                                     self.max_concurrency))
+        return self._executor
+
+    @staticmethod
+    def source(file_obj: BinaryIO, max_size: int = MEMORY_SIZE, dir: Optional[Union[str, Path]] = None) -> Source:
+        """The path and offset of a file on disk, or the rest of the bytes of a file in memory smaller than max_size.
+        Other files, e.g. the anonymous temporary file of a Starlette upload that rolled over to disk or a large file
+        in memory, are copied to a named temporary file, remove it with discard after the transfer. Blocks while
+        copying.
+
+        Args:
+            file_obj (BinaryIO): A spooled file, or a regular file opened for reading.
+            max_size (int): The size from which files in memory are copied to disk, the spool size of the upload.
+            dir (str | Path | None): The directory of the copies. Defaults to the system temporary directory.
+
+        Returns:
+            tuple[str, int] | bytes: The source of the transfer.
+        """
+        name = getattr(file_obj, 'name', None)
+        rolled = getattr(file_obj, '_rolled', not isinstance(file_obj, io.BytesIO))
+        if rolled and isinstance(name, str) and os.path.isfile(name):
+            file_obj.flush() if hasattr(file_obj, 'flush') else ...
+            return name, file_obj.tell()
+        if not rolled:
+            start = file_obj.tell()
+            end = file_obj.seek(0, os.SEEK_END)
+            file_obj.seek(start)
+            if end - start < max_size:
+                return file_obj.read()
+        copy = NamedTemporaryFile(prefix=COPY_PREFIX, dir=dir, delete=False)
+        try:
+            with copy:
+                shutil.copyfileobj(file_obj, copy, CHUNK_SIZE)
+        except BaseException:
+            os.unlink(copy.name)
+            raise
+        return copy.name, 0
+
+    @staticmethod
+    def discard(source: Source, file_obj: BinaryIO):
+        """Remove the copy made by source for a file, if there is one."""
+        if isinstance(source, tuple) and source[0] != getattr(file_obj, 'name', None):
+            try:
+                os.unlink(source[0])
+            except FileNotFoundError:
+                pass
+
+    async def upload(self, source: Source, bucket: str, key: str, extra_args: dict = None,
+                     size: Optional[int] = None) -> dict:
+        """Upload a file in a worker process. A transfer that is cancelled before a worker picks it up is not run.
+
+        Args:
+            source (tuple[str, int] | bytes): The source of the transfer, see source.
+            bucket (str): The bucket.
+            key (str): The object name.
+            extra_args (dict): Extra arguments of the put_object call.
+            size (int | None): The size of the file.
+
+        Returns:
+            dict: The ResponseMetadata, ETag and VersionId of the response.
+        """
+        self.submitted += 1
+        self.inflight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, partial(_transfer, source, bucket, key, extra_args or {}, size))
+        finally:
+            self.inflight -= 1
+
+    def shutdown(self, wait: bool = True):
+        """Stop the worker processes, a later transfer starts new ones."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        executor.shutdown(wait=wait) if executor is not None else ...
+
+    def stats(self) -> dict:
+        return {'processes': self.processes, 'submitted': self.submitted, 'inflight': self.inflight,
+                'started': self._executor is not None}
@@ -1,14 +1,30 @@
 import asyncio
+from functools import partial
+from typing import Mapping, Sequence, Tuple, Union
 from abc import abstractmethod, ABC
+from logging import getLogger
 
 from fastapi import BackgroundTasks, Request
 
-from ..structs import FileField, Config, FormData, List, UploadFile, FileData
+from ..structs import FileField, Config, FormData, List, UploadFile, FileData, BatchResult
+from ..exceptions import FileStoreError
+from ..callbacks import call
+
+logger = getLogger(__name__)
+
+Pairs = Union[Mapping[str, str], Sequence[Tuple[str, str]]]
 
 
 class StorageEngine(ABC):
+    """The base of the storage engines. The request, form and background tasks are optional so engines can store
+    files outside of a request, e.g. in migrations and bulk imports. Destination functions are then called with None
+    for the request and form, and files are stored in the foreground whatever the background config.
+
+    Engines that keep the files they store also manage them in batches with delete, copy and move. Keys are what the
+    engine returns in the FileData, the path of local files and the object name of S3 objects.
+    """
 
-    def __init__(self, *, request: Request, form: FormData, background_tasks: BackgroundTasks,
+    def __init__(self, *, request: Request = None, form: FormData = None, background_tasks: BackgroundTasks = None,
                  file_field: FileField = None):
         self.form = form
         self.request = request
@@ -28,10 +44,103 @@ class StorageEngine(ABC):
         file_field = file_field or {}
         self._file_field = file_field.copy() or self.file_field
 
+    async def destination(self, file_field: FileField):
+        """Resolve the destination of a file from the destination of the file field set by a batch destination
+        function, or by calling the sync or async destination function of the config.
+
+        Args:
+            file_field (FileField): A file field dict.
+
+        Returns:
+            The resolved destination or None if the destination config is not a function.
+        """
+        if 'destination' in file_field:
+            return file_field['destination']
+        dest = file_field.get('config', {}).get('destination')
+        if callable(dest):
+            return await call(dest, self.request, self.form, file_field['name'], file_field['file'])
+        return None
+
     @abstractmethod
     async def upload(self, *, file_field) -> FileData:
         """"""
 
+    async def upload_many(self, *, file_fields: List[FileField]) -> List[FileData]:
+        """Upload a batch of files with this engine. The files share the engine and whatever it holds, such as
+        clients and created directories. A file that fails is returned as a failed FileData so it doesn't fail the
+        rest of the batch. With the scheduler config the uploads run in the slots of the UploadScheduler.
+
+        Args:
+            file_fields (list[FileField]): The file fields to upload.
+
+        Returns:
+            list[FileData]: The results in the order of the file fields.
+        """
+        if file_fields and (scheduler := file_fields[0].get('config', {}).get('scheduler')):
+            uploads = [(scheduler.size(file_field), partial(self.upload, file_field=file_field))
+                       for file_field in file_fields]
+            results = await scheduler.gather(self.request, uploads, return_exceptions=True)
+        else:
+            results = await asyncio.gather(*[self.upload(file_field=file_field) for file_field in file_fields],
+                                           return_exceptions=True)
+        for index, (file_field, result) in enumerate(zip(file_fields, results)):
+            if isinstance(result, BaseException):
+                if not isinstance(result, Exception):
+                    raise result
+                logger.error(f'Error uploading file: {result} in {self.__class__.__name__}')
+                results[index] = FileData(status=False, error='Something went wrong', field_name=file_field['name'],
+                                          message=f'Unable to upload {file_field["name"]}')
+        return results
+
     async def multi_upload(self, *, file_fields: List[FileField]) -> List[FileData]:
-        """"""
-        return await asyncio.gather(*[self.upload(file_field=file_field) for file_field in file_fields])
\ No newline at end of file
+        """Upload a batch of files. See upload_many."""
+        return await self.upload_many(file_fields=file_fields)
+
+    async def delete(self, keys: Sequence[str], *, config: Config = None) -> BatchResult:
+        """Delete stored files.
+
+        Args:
+            keys (Sequence[str]): The keys of the files.
+            config (Config): The config of the files, e.g. the bucket. Defaults to the config of the engine.
+
+        Returns:
+            BatchResult: The keys deleted and the errors of the keys that failed.
+        """
+        raise FileStoreError(f'{self.__class__.__name__} does not support delete')
+
+    async def copy(self, pairs: Pairs, *, config: Config = None) -> BatchResult:
+        """Copy stored files to new keys.
+
+        Args:
+            pairs (Mapping[str, str] | Sequence[tuple[str, str]]): The source and destination keys.
+            config (Config): The config of the files. Defaults to the config of the engine.
+
+        Returns:
+            BatchResult: The destinations copied to and the errors of the sources that failed.
+        """
+        raise FileStoreError(f'{self.__class__.__name__} does not support copy')
+
+    async def move(self, pairs: Pairs, *, config: Config = None) -> BatchResult:
+        """Move stored files to new keys. Files are copied and the sources that were copied are deleted, engines
+        that can rename files do that instead.
+
+        Args:
+            pairs (Mapping[str, str] | Sequence[tuple[str, str]]): The source and destination keys.
+            config (Config): The config of the files. Defaults to the config of the engine.
+
+        Returns:
+            BatchResult: The destinations moved to and the errors of the sources that failed.
+        """
+        pairs = self.pairs(pairs)
+        copied = await self.copy(pairs, config=config)
+        done = set(copied.succeeded)
+        sources = [source for source, dest in pairs if dest in done]
+        deleted = await self.delete(sources, config=config)
+        failed = {**copied.failed, **deleted.failed}
+        moved = [dest for source, dest in pairs if dest in done and source not in deleted.failed]
+        return BatchResult.summary('move', moved, failed)
+
+    @staticmethod
+    def pairs(pairs: Pairs) -> List[Tuple[str, str]]:
+        """The source and destination pairs of a copy or move as a list."""
+        return [(str(source), str(dest)) for source, dest in (pairs.items() if isinstance(pairs, Mapping) else pairs)]
@@ -0,0 +1,248 @@
+"""
+Tiered storage engine. Files land on local disk and are migrated to a remote engine (S3 by default) in the background.
+"""
+import time
+import asyncio
+from collections import OrderedDict
+from pathlib import Path
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Dict, Optional, Set, Type
+from weakref import WeakKeyDictionary
+
+from fastapi import BackgroundTasks
+
+from ..exceptions import FileStoreError
+from ..structs import FileField, FileData, UploadFile
+from .storage_engine import StorageEngine
+from .local_engine import LocalEngine
+
+logger = getLogger(__name__)
+
+
+@dataclass
+class TierRecord:
+    """The migration state of a file stored by the tiered engine.
+
+    Attributes:
+        path (Path): The path of the local copy.
+        size (int): The size of the file.
+        state (str): pending, migrating, migrated, evicted or failed.
+        created (float): When the file landed on local disk.
+        migrated (float): When the file was migrated to the remote tier.
+        url (str): The url of the remote copy once migrated.
+        error (str): The error of a failed migration.
+    """
+    path: Path
+    size: int
+    state: str = 'pending'
+    created: float = 0
+    migrated: float = 0
+    url: str = ''
+    error: str = ''
+
+
+class Migrator:
+    """Migrates files from the local tier to the remote tier with bounded concurrency and evicts local copies.
+    A migrator is shared by all requests of the process. Local copies that expire are evicted by a sweep scheduled on
+    the event loop for the next expiry, so they are deleted even when no further files are migrated.
+
+    Attributes:
+        concurrency (int): The maximum number of migrations in flight.
+        evict_after (float | None): Seconds after migration when the local copy is deleted. Zero deletes the local
+            copy as soon as it is migrated, None keeps it until max_local_bytes is exceeded.
+        max_local_bytes (int | None): Evict the oldest migrated local copies when the local tier holds more bytes.
+        max_evicted (int): The number of evicted files whose remote url is kept for locate, oldest are forgotten first.
+        records (dict[str, TierRecord]): The state of the files held by the local tier by local path. Records are
+            dropped when their local copy is evicted.
+        evicted (OrderedDict[str, str]): The remote url of the most recently evicted files by local path.
+    """
+
+    def __init__(self, concurrency: int = 4, evict_after: Optional[float] = 0, max_local_bytes: Optional[int] = None,
+                 max_evicted: int = 10000):
+        self.concurrency = concurrency
+        self.evict_after = evict_after
+        self.max_local_bytes = max_local_bytes
+        self.max_evicted = max_evicted
+        self.records: Dict[str, TierRecord] = {}
+        self.evicted: 'OrderedDict[str, str]' = OrderedDict()
+        self._local_bytes = 0
+        self._tasks: Set[asyncio.Task] = set()
+        self._semaphores: 'WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]' = WeakKeyDictionary()
+        self._sweeps: 'WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.TimerHandle]' = WeakKeyDictionary()
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        return semaphore
+
+    @property
+    def local_bytes(self) -> int:
+        """The number of bytes held by the local tier."""
+        return self._local_bytes
+
+    def submit(self, engine: StorageEngine, file_field: FileField, record: TierRecord,
+               background_tasks: BackgroundTasks = None) -> asyncio.Task:
+        """Schedule the migration of a file. If background tasks are given, the request waits for the migration
+        after the response is sent.
+
+        Args:
+            engine (StorageEngine): The remote storage engine.
+            file_field (FileField): The file field for the remote engine.
+            record (TierRecord): The record of the local copy.
+            background_tasks (BackgroundTasks): The background tasks of the request.
+
+        Returns:
+            asyncio.Task: The migration task.
+        """
+        key = str(record.path)
+        previous = self.records.get(key)
+        self._local_bytes += record.size - (previous.size if previous else 0)
+        self.records[key] = record
+        self.evicted.pop(key, None)
+        task = asyncio.get_running_loop().create_task(self.migrate(engine, file_field, record))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if background_tasks is not None:
+            background_tasks.add_task(asyncio.wait, {task})
+        return task
+
+    async def migrate(self, engine: StorageEngine, file_field: FileField, record: TierRecord):
+        """Copy the local file to the remote engine. The local copy is kept if the migration fails.
+
+        Args:
+            engine (StorageEngine): The remote storage engine.
+            file_field (FileField): The file field for the remote engine.
+            record (TierRecord): The record of the local copy.
+        """
+        async with self.semaphore:
+            record.state = 'migrating'
+            file = file_field['file']
+            try:
+                with open(record.path, 'rb') as fh:
+                    upload = UploadFile(file=fh, size=record.size, filename=file.filename, headers=file.headers)
+                    file_data = await engine.upload(file_field={**file_field, 'file': upload})
+                if not file_data.status:
+                    raise FileStoreError(file_data.error)
+                record.url, record.state, record.migrated = file_data.url, 'migrated', time.time()
+            except Exception as err:
+                logger.error(f'Error migrating {record.path}: {err} in {self.__class__.__name__}')
+                record.state, record.error = 'failed', str(err)
+        self.evict()
+
+    def evict(self):
+        """Delete migrated local copies that are older than evict_after or exceed max_local_bytes, oldest first.
+        The records of evicted files are dropped and a sweep is scheduled for the next local copy to expire."""
+        now = time.time()
+        migrated = sorted((record for record in self.records.values() if record.state == 'migrated'),
+                          key=lambda rec: rec.migrated)
+        remaining = []
+        for record in migrated:
+            expired = self.evict_after is not None and now - record.migrated >= self.evict_after
+            over = self.max_local_bytes is not None and self._local_bytes > self.max_local_bytes
+            if not (expired or over):
+                remaining.append(record)
+                continue
+            try:
+                record.path.unlink(missing_ok=True)
+                record.state = 'evicted'
+                self._local_bytes -= record.size
+                self.records.pop(str(record.path), None)
+                self.evicted[str(record.path)] = record.url
+                while len(self.evicted) > self.max_evicted:
+                    self.evicted.popitem(last=False)
+            except OSError as err:
+                logger.error(f'Error evicting {record.path}: {err} in {self.__class__.__name__}')
+        if remaining and self.evict_after is not None:
+            self._schedule_sweep(remaining[0].migrated + self.evict_after - now)
+
+    def _schedule_sweep(self, delay: float):
+        """Run evict on the running event loop after delay seconds unless an earlier sweep is already scheduled.
+
+        Args:
+            delay (float): Seconds until the next local copy expires.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        handle = self._sweeps.get(loop)
+        if handle is not None and not handle.cancelled() and handle.when() <= loop.time() + delay:
+            return
+        if handle is not None:
+            handle.cancel()
+        self._sweeps[loop] = loop.call_later(max(delay, 0), self._sweep, loop)
+
+    def _sweep(self, loop: asyncio.AbstractEventLoop):
+        self._sweeps.pop(loop, None)
+        self.evict()
+
+    def locate(self, path) -> Optional[str]:
+        """Get where a file can be read from. Files are served from local disk until the local copy is evicted.
+
+        Args:
+            path (str | Path): The local path returned by the tiered engine.
+
+        Returns:
+            str | None: The local path if the local copy is held by the local tier, the url of the remote copy if it
+                was evicted, None if the file is unknown or was forgotten after max_evicted more evictions.
+        """
+        key = str(path)
+        if key in self.records:
+            return key
+        return self.evicted.get(key)
+
+
+class TieredEngine(StorageEngine):
+    """Write local then migrate storage engine.
+
+    Uploads are saved with the LocalEngine and returned immediately, the file is then migrated to the remote engine
+    in the background by the migrator. Use TieredEngine.migrator.locate to find where a file can be read from.
+
+    Config:
+        remote (Type[StorageEngine]): The remote storage engine. Defaults to S3Engine.
+        remote_destination (str | Callable): The destination config for the remote engine.
+        migrator (Migrator): The migrator for this field. Defaults to the shared TieredEngine.migrator.
+    """
+    migrator: Migrator = Migrator()
+
+    async def upload(self, *, file_field: FileField = None) -> FileData:
+        """Upload a file to the local tier and schedule its migration.
+
+        Args:
+            file_field (FileField): A file field dict.
+
+        Returns:
+            FileData: The result of the local upload.
+        """
+        try:
+            self.file_field = file_field
+            config = self.config
+            file = self.file_field['file']
+            local_field = {**self.file_field, 'config': {**config, 'background': False}}
+            local = LocalEngine(request=self.request, form=self.form, background_tasks=self.background_tasks,
+                                file_field=local_field)
+            file_data = await local.upload(file_field=local_field)
+            remote_cls: Type[StorageEngine] = config.get('remote')
+            if remote_cls is None:
+                from .s3_engine import S3Engine
+                remote_cls = S3Engine
+            remote_field = {**self.file_field, 'config': {**config, 'background': False,
+                                                          'destination': config.get('remote_destination', '')}}
+            remote_field.pop('destination', None)
+            remote = remote_cls(request=self.request, form=self.form, background_tasks=self.background_tasks,
+                                file_field=remote_field)
+            migrator = config.get('migrator', self.migrator)
+            # the size of the upload may be unknown, the local tier holds the bytes that were written.
+            path = Path(file_data.path)
+            record = TierRecord(path=path, size=path.stat().st_size, created=time.time())
+            migrator.submit(remote, remote_field, record, background_tasks=self.background_tasks)
+            file_data.metadata = {**file_data.metadata, 'tier': 'local'}
+            file_data.message = f'{file.filename} was saved and is migrating to {remote_cls.__name__}'
+            return file_data
+        except Exception as err:
+            logger.error(f'Error uploading file: {err} in {self.__class__.__name__}')
+            raise FileStoreError(err)
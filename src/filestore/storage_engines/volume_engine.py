@@ -0,0 +1,627 @@
+"""
+Multi volume local storage engine. Files are spread over several local volumes, each file is placed on the volume with
+the most free space, the shortest queue or the fastest recent writes, and very large files can be striped across the
+volumes in chunks.
+"""
+import os
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import threading
+from pathlib import Path, PurePosixPath
+from dataclasses import dataclass, field
+from functools import partial
+from logging import getLogger
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from uuid import uuid4
+
+from ..exceptions import FileStoreError
+from ..structs import FileData, UploadFile, BatchResult, Config
+from ..util import to_thread
+from .local_engine import LocalEngine, CHUNK_SIZE, fsync_dir
+
+logger = getLogger(__name__)
+
+MANIFEST_SUFFIX = '.stripes.json'
+STRIPE_DIR = '.stripes'
+
+
+@dataclass(eq=False)
+class Volume:
+    """A local volume the files are spread over.
+
+    Attributes:
+        root (Path): The root directory of the volume.
+        capacity (int | None): A quota for the volume in bytes, None uses the free space of the filesystem.
+        state (str): active, full or draining. Only active volumes take new files.
+        used (int): The bytes stored under the root, tracked only for volumes with a capacity.
+        pending (int): The bytes of the writes in flight.
+        inflight (int): The number of writes in flight.
+        latency (float): The moving average of the write time in seconds per MB.
+        written (int): The bytes written since the volume was added.
+        errors (int): The number of failed writes.
+    """
+    root: Path
+    capacity: Optional[int] = None
+    state: str = 'active'
+    used: int = 0
+    pending: int = 0
+    inflight: int = 0
+    latency: float = 0.0
+    written: int = 0
+    errors: int = 0
+    _usage: Tuple[float, int, int] = field(default=(0.0, 0, 0), repr=False)
+
+    def usage(self) -> Tuple[int, int]:
+        """The total and free bytes of the volume. The free space of the filesystem is cached for a second."""
+        if self.capacity is not None:
+            return self.capacity, self.capacity - self.used
+        checked, total, free = self._usage
+        if time.monotonic() - checked > 1:
+            total, _, free = shutil.disk_usage(self.root)
+            self._usage = (time.monotonic(), total, free)
+        return total, free
+
+    @property
+    def free(self) -> int:
+        """The free bytes less the writes in flight."""
+        return self.usage()[1] - self.pending
+
+    @property
+    def fill(self) -> float:
+        """The share of the volume in use."""
+        total, free = self.usage()
+        return 1 - free / total if total else 1.0
+
+    def files(self) -> Iterator[Path]:
+        """The stored files of the volume, without temporary files, stripes and manifests."""
+        for folder, dirs, names in os.walk(self.root):
+            dirs[:] = [name for name in dirs if name != STRIPE_DIR]
+            for name in names:
+                if not name.startswith('.') and not name.endswith(MANIFEST_SUFFIX):
+                    yield Path(folder) / name
+
+
+class VolumeSet:
+    """The volumes of a VolumeEngine with the placement of new files and the rebalancing of stored ones.
+    A volume set is shared by all the requests of the worker, pass it as the volumes config key.
+
+    The placement policy picks the active volume of a file:
+
+        space: The most free space, less the writes in flight. This is the default.
+        queue: The fewest writes in flight, then the most free space.
+        latency: The fastest recent writes, weighted by the writes in flight.
+
+    A volume becomes full when its free space drops to reserve and takes no more files. Files of at least
+    stripe_threshold bytes are split into stripe_size chunks written to different volumes concurrently, with a json
+    manifest of the chunks at the path of the file. Adding a volume or a volume filling up schedules a rebalance that
+    moves files from the fullest volumes to the emptiest until they are within tolerance of the average fill. Moved
+    files keep their path relative to the volume root, find them with locate. Striped files are not moved, and a file
+    is never moved over a file stored at its destination since the scan.
+
+    Attributes:
+        volumes (list[Volume]): The volumes.
+        placement (str): space, queue or latency.
+        reserve (int): The free bytes kept on every volume.
+        stripe_threshold (int | None): The size from which files are striped, None never stripes.
+        stripe_size (int): The size of the chunks of a striped file.
+        tolerance (float): The fill difference from the average left alone by rebalance.
+        needs_rebalance (bool): If a volume was added or filled up since the last rebalance.
+    """
+    _sets: Dict[Tuple[Path, ...], 'VolumeSet'] = {}
+    _sets_lock = threading.Lock()
+
+    def __init__(self, volumes: Sequence[Union[str, Path, Volume]], placement: str = 'space',
+                 reserve: int = 64 * 1024 ** 2, stripe_threshold: Optional[int] = None,
+                 stripe_size: int = 64 * 1024 ** 2, tolerance: float = 0.05):
+        if placement not in ('space', 'queue', 'latency'):
+            raise ValueError(f'Unknown placement {placement}, expected space, queue or latency')
+        self.placement = placement
+        self.reserve = reserve
+        self.stripe_threshold = stripe_threshold
+        self.stripe_size = stripe_size
+        self.tolerance = tolerance
+        self.volumes: List[Volume] = []
+        self.needs_rebalance = False
+        self.rebalancing = False
+        self._lock = threading.RLock()
+        for volume in volumes:
+            self.add(volume)
+        self.needs_rebalance = False
+
+    @classmethod
+    def shared(cls, roots: Sequence[Union[str, Path]]) -> 'VolumeSet':
+        """Get the shared volume set of a list of roots, creating it with the default settings if needed."""
+        key = tuple(Path(root).absolute() for root in roots)
+        with cls._sets_lock:
+            if (volumes := cls._sets.get(key)) is None:
+                volumes = cls._sets[key] = cls(key)
+            return volumes
+
+    def add(self, volume: Union[str, Path, Volume], capacity: Optional[int] = None) -> Volume:
+        """Add a volume and schedule a rebalance.
+
+        Args:
+            volume (str | Path | Volume): The root of the volume or a volume.
+            capacity (int | None): A quota for a volume given by its root.
+
+        Returns:
+            Volume: The added volume.
+        """
+        volume = volume if isinstance(volume, Volume) else Volume(root=Path(volume), capacity=capacity)
+        volume.root = Path(volume.root).absolute()
+        volume.root.mkdir(parents=True, exist_ok=True)
+        if volume.capacity is not None and not volume.used:
+            volume.used = sum(path.stat().st_size for path in volume.files())
+        with self._lock:
+            if any(other.root == volume.root for other in self.volumes):
+                raise ValueError(f'Volume {volume.root} was already added')
+            self.volumes.append(volume)
+            self.needs_rebalance = True
+        return volume
+
+    def drain(self, root: Union[str, Path]):
+        """Stop placing files on a volume and move its files to the other volumes on the next rebalance."""
+        root = Path(root).absolute()
+        with self._lock:
+            for volume in self.volumes:
+                if volume.root == root:
+                    volume.state = 'draining'
+                    self.needs_rebalance = True
+
+    def remove(self, root: Union[str, Path]):
+        """Remove a volume from the set. Its files are no longer found by locate, drain it first to keep them."""
+        root = Path(root).absolute()
+        with self._lock:
+            self.volumes = [volume for volume in self.volumes if volume.root != root]
+
+    @property
+    def active(self) -> List[Volume]:
+        return [volume for volume in self.volumes if volume.state == 'active']
+
+    def _rank(self, volume: Volume):
+        if self.placement == 'queue':
+            return volume.inflight, -volume.free
+        if self.placement == 'latency':
+            return volume.latency * (volume.inflight + 1), volume.inflight
+        return -volume.free, volume.inflight
+
+    def choose(self, size: int, exclude: Sequence[Volume] = (), prefer: Optional[Volume] = None) -> Volume:
+        """Pick the volume of a write and count it as in flight until it is released.
+
+        Args:
+            size (int): The size of the write.
+            exclude (Sequence[Volume]): Volumes to avoid if another one has space, used to spread stripes.
+            prefer (Volume | None): The volume to write to if it is active and has space, the volume of the file
+                being replaced.
+
+        Returns:
+            Volume: The volume to write to.
+        """
+        with self._lock:
+            for volume in self.active:
+                if volume.free <= self.reserve:
+                    self._full(volume)
+            candidates = [volume for volume in self.active if volume.free - size >= self.reserve]
+            if not candidates:
+                raise FileStoreError(f'No volume has {size} bytes of free space')
+            volume = prefer if prefer in candidates else \
+                min([volume for volume in candidates if volume not in exclude] or candidates, key=self._rank)
+            volume.pending += size
+            volume.inflight += 1
+            return volume
+
+    def release(self, volume: Volume, size: int, elapsed: float, ok: bool = True):
+        """Complete a write picked by choose.
+
+        Args:
+            volume (Volume): The volume written to.
+            size (int): The size of the write.
+            elapsed (float): The time the write took.
+            ok (bool): If the write succeeded.
+        """
+        with self._lock:
+            volume.pending -= size
+            volume.inflight -= 1
+            if not ok:
+                volume.errors += 1
+                return
+            volume.written += size
+            volume.used += size if volume.capacity is not None else 0
+            latency = elapsed / max(size / 1024 ** 2, CHUNK_SIZE / 1024 ** 2)
+            volume.latency = latency if not volume.latency else 0.8 * volume.latency + 0.2 * latency
+            if volume.state == 'active' and volume.free <= self.reserve:
+                self._full(volume)
+
+    def _full(self, volume: Volume):
+        volume.state = 'full'
+        self.needs_rebalance = True
+        logger.warning(f'Volume {volume.root} is full')
+
+    def stripes(self, size: Optional[int]) -> bool:
+        """Check if a file of the given size is striped."""
+        return bool(self.stripe_threshold and size and size >= self.stripe_threshold and len(self.active) > 1)
+
+    def copies(self, relative: Union[str, Path]) -> List[Tuple[Volume, Path]]:
+        """Find every stored copy of a file, or of the manifest of a striped file, by its path relative to the
+        volume roots, newest first.
+
+        Args:
+            relative (str | Path): The path of the file relative to the volume roots.
+
+        Returns:
+            list[tuple[Volume, Path]]: The volume and path of each copy.
+        """
+        found = []
+        for volume in self.volumes:
+            path = volume.root / relative
+            for candidate in (path, path.with_name(path.name + MANIFEST_SUFFIX)):
+                try:
+                    found.append((candidate.stat().st_mtime, volume, candidate))
+                except (FileNotFoundError, NotADirectoryError):
+                    pass
+        return [(volume, path) for _, volume, path in sorted(found, key=lambda copy: -copy[0])]
+
+    def locate(self, relative: Union[str, Path]) -> Optional[Path]:
+        """Find a stored file, or the manifest of a striped file, by its path relative to the volume roots.
+
+        Args:
+            relative (str | Path): The path of the file relative to the volume roots.
+
+        Returns:
+            Path | None: The path of the newest file or manifest, None if no volume has it.
+        """
+        return copies[0][1] if (copies := self.copies(relative)) else None
+
+    @staticmethod
+    def stripe_paths(path: Union[str, Path]) -> List[Path]:
+        """The paths of the stripes listed by a manifest, empty for other files or a missing manifest."""
+        path = Path(path)
+        if not path.name.endswith(MANIFEST_SUFFIX):
+            return []
+        try:
+            return [Path(stripe['path']) for stripe in json.loads(path.read_text())['stripes']]
+        except FileNotFoundError:
+            return []
+
+    def remove_file(self, path: Optional[Union[str, Path]], stripes: Optional[List[Path]] = None):
+        """Delete a stored file, or a manifest and its stripes, and free their space on their volumes.
+
+        Args:
+            path (str | Path): The path of the file or manifest, None to only delete the stripes.
+            stripes (list[Path] | None): The stripes to delete. Defaults to the stripes listed by the manifest.
+        """
+        paths = [*(self.stripe_paths(path) if stripes is None and path is not None else stripes or []),
+                 *([Path(path)] if path is not None else [])]
+        for part in paths:
+            try:
+                size = part.stat().st_size
+                part.unlink()
+            except FileNotFoundError:
+                continue
+            if part.name.endswith(MANIFEST_SUFFIX):
+                continue
+            with self._lock:
+                for volume in self.volumes:
+                    if volume.capacity is not None and volume.root in part.parents:
+                        volume.used -= size
+
+    @staticmethod
+    def iter_file(path: Union[str, Path], chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """Read a stored file in chunks, reassembling striped files from their manifest.
+
+        Args:
+            path (str | Path): The path of a file or manifest returned by the engine or locate.
+            chunk_size (int): The size of the chunks read.
+
+        Yields:
+            bytes: The content of the file in order.
+        """
+        path = Path(path)
+        paths = [Path(stripe['path']) for stripe in json.loads(path.read_text())['stripes']] \
+            if path.name.endswith(MANIFEST_SUFFIX) else [path]
+        for part in paths:
+            with open(part, 'rb') as fh:
+                while chunk := fh.read(chunk_size):
+                    yield chunk
+
+    def rebalance(self, max_bytes: Optional[int] = None) -> List[Tuple[Path, Path]]:
+        """Move files from the volumes filled over the average, and from draining volumes, to the emptiest active
+        volumes. Files are copied next to their destination and renamed into place before the source is deleted, so
+        a file is always found by locate. Runs in a worker thread with rebalance_async.
+
+        Args:
+            max_bytes (int | None): Stop after moving this many bytes.
+
+        Returns:
+            list[tuple[Path, Path]]: The source and destination of the moved files.
+        """
+        if self.rebalancing:
+            return []
+        self.rebalancing, self.needs_rebalance = True, False
+        moves, moved = [], 0
+        try:
+            with self._lock:
+                volumes = [volume for volume in self.volumes if volume.state != 'draining']
+                average = sum(volume.fill for volume in volumes) / len(volumes) if volumes else 0
+                sources = sorted((volume for volume in self.volumes if volume.state == 'draining'
+                                  or volume.fill > average + self.tolerance), key=lambda volume: -volume.fill)
+            for source in sources:
+                for path in list(source.files()):
+                    if source.state != 'draining' and source.fill <= average + self.tolerance / 2:
+                        break
+                    if max_bytes is not None and moved >= max_bytes:
+                        return moves
+                    size = path.stat().st_size
+                    with self._lock:
+                        targets = [volume for volume in self.active if volume is not source and volume.free - size
+                                   >= self.reserve and (source.state == 'draining' or volume.fill < average)]
+                    if not targets:
+                        break
+                    target = min(targets, key=lambda volume: volume.fill)
+                    dest = target.root / path.relative_to(source.root)
+                    if self._move(path, dest, source, target, size):
+                        moves.append((path, dest))
+                        moved += size
+                with self._lock:
+                    if source.state == 'full' and source.free >= self.reserve:
+                        source.state = 'active'
+            logger.info(f'Rebalanced volumes, moved {len(moves)} files and {moved} bytes')
+            return moves
+        finally:
+            self.rebalancing = False
+
+    def _move(self, path: Path, dest: Path, source: Volume, target: Volume, size: int) -> bool:
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f'.{dest.name}.{uuid4().hex[:8]}.tmp')
+        try:
+            copied = path.stat()
+            shutil.copyfile(path, tmp)
+            # a link fails if the destination exists, a file stored there since the scan is never replaced.
+            os.link(tmp, dest)
+        except FileExistsError:
+            logger.warning(f'Not moving {path}, {dest} already exists')
+            return False
+        except FileNotFoundError:
+            return False
+        finally:
+            tmp.unlink(missing_ok=True)
+        # a file uploaded to the source path since the copy replaces or rewrites it, keep it and drop the copy.
+        try:
+            current = path.stat()
+        except FileNotFoundError:
+            current = None
+        if current is None or (current.st_ino, current.st_mtime_ns, current.st_size) != \
+                (copied.st_ino, copied.st_mtime_ns, copied.st_size):
+            logger.warning(f'Not moving {path}, it changed while it was copied')
+            dest.unlink(missing_ok=True)
+            return False
+        path.unlink()
+        with self._lock:
+            source.used -= size if source.capacity is not None else 0
+            target.used += size if target.capacity is not None else 0
+            source._usage = target._usage = (0.0, 0, 0)
+        return True
+
+    async def rebalance_async(self, max_bytes: Optional[int] = None) -> List[Tuple[Path, Path]]:
+        """Rebalance without blocking the event loop. See rebalance."""
+        try:
+            return await to_thread(self.rebalance, max_bytes)
+        except Exception as err:
+            logger.error(f'Error rebalancing volumes: {err} in {self.__class__.__name__}')
+            return []
+
+    def stats(self) -> List[Dict]:
+        """The state, fill, writes in flight, latency and bytes written of every volume."""
+        with self._lock:
+            return [{'root': str(volume.root), 'state': volume.state, 'fill': round(volume.fill, 4),
+                     'free': volume.free, 'inflight': volume.inflight, 'latency': volume.latency,
+                     'written': volume.written, 'errors': volume.errors} for volume in self.volumes]
+
+
+class VolumeEngine(LocalEngine):
+    """Spread files over several local volumes. The volumes config key is a VolumeSet, or a list of volume roots for
+    the VolumeSet shared by the worker, and the destination config key, or the path returned by a destination
+    function, is the path of the file relative to the volume root. The path of the FileData is the resolved path on
+    the chosen volume, or the path of the manifest of a striped file, and the volume is in its metadata. A file stored
+    again at the same relative path goes to the volume of its newest copy if it has space, and the other copies and
+    old stripes are removed once it is written. A rebalance runs in a background task after the response when a
+    volume was added or filled up.
+
+    Stored files and manifests are deleted, copied and moved by path. Deleting a manifest deletes its stripes,
+    copying one copies its stripes next to them, as hard links where possible, and a manifest is copied or moved to a
+    path with the manifest suffix.
+
+    Config:
+        volumes (VolumeSet | list[str | Path]): The volumes to spread the files over.
+    """
+
+    @staticmethod
+    def relative(file: UploadFile, dest, folder) -> Path:
+        """The path of a file relative to the volume roots. Filenames with an anchor and paths with .. components
+        would escape the volume roots and are rejected."""
+        if dest is None:
+            filename = Path(file.filename)
+            if filename.anchor or '..' in filename.parts:
+                raise FileStoreError(f'Filename {file.filename} is outside of the destination')
+            relative = Path(folder if isinstance(folder, (str, Path)) else '') / filename
+        else:
+            relative = Path(dest)
+            if relative.is_absolute():
+                try:
+                    relative = relative.relative_to(Path.cwd())
+                except ValueError:
+                    relative = relative.relative_to(relative.anchor)
+        if '..' in relative.parts:
+            raise FileStoreError(f'Path {relative} is outside of the volume roots')
+        return relative
+
+    async def _write(self, volumes: VolumeSet, relative: Path, file: UploadFile, durability: str,
+                     checksum: str, prefer: Optional[Volume] = None) -> Tuple[Path, str, Volume]:
+        volume = volumes.choose(file.size or 0, prefer=prefer)
+        start, ok, size = time.monotonic(), False, file.size or 0
+        try:
+            dest = volume.root / relative
+            self.makedirs(dest.parent)
+            digest = await self._upload(file, dest, durability, checksum)
+            size, ok = file.size if file.size is not None else dest.stat().st_size, True
+            return dest, digest, volume
+        finally:
+            volumes.release(volume, size, time.monotonic() - start, ok)
+
+    @staticmethod
+    def _write_chunk(path: Path, data: bytes, fsync: bool):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'.{path.name}.{uuid4().hex[:8]}.tmp')
+        try:
+            with open(tmp, 'wb') as fh:
+                fh.write(data)
+                if fsync:
+                    fh.flush()
+                    os.fsync(fh.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+    async def _chunk(self, volumes: VolumeSet, volume: Volume, path: Path, data: bytes, fsync: bool):
+        start, ok = time.monotonic(), False
+        try:
+            await to_thread(self._write_chunk, path, data, fsync)
+            ok = True
+        finally:
+            volumes.release(volume, len(data), time.monotonic() - start, ok)
+
+    async def _stripe(self, volumes: VolumeSet, relative: Path, file: UploadFile, durability: str,
+                      checksum: str, prefer: Optional[Volume] = None) -> Tuple[Path, str, Volume]:
+        """Write the chunks of a file to different volumes, one write per volume in flight, then the manifest on the
+        volume of the first chunk. The chunks of every write have new names, so the chunks of the file being
+        replaced stay readable until the new manifest is in place."""
+        digest = hashlib.new(checksum) if checksum else None
+        fsync = durability != 'none'
+        stripes, writes, used, token = [], set(), [], uuid4().hex[:8]
+        try:
+            while data := await file.read(volumes.stripe_size):
+                digest.update(data) if digest else ...
+                volume = volumes.choose(len(data), exclude=used, prefer=None if stripes else prefer)
+                used = [volume] if len(used) + 1 >= len(volumes.active) else [*used, volume]
+                path = volume.root / relative.parent / STRIPE_DIR / f'{relative.name}.{token}.{len(stripes):05d}'
+                stripes.append({'volume': str(volume.root), 'path': str(path), 'size': len(data)})
+                writes.add(asyncio.ensure_future(self._chunk(volumes, volume, path, data, fsync)))
+                if len(writes) >= len(volumes.active):
+                    done, writes = await asyncio.wait(writes, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        task.result()
+            if writes:
+                await asyncio.gather(*writes)
+            first = next(volume for volume in volumes.volumes if str(volume.root) == stripes[0]['volume'])
+            manifest = first.root / relative.parent / (relative.name + MANIFEST_SUFFIX)
+            body = json.dumps({'filename': file.filename, 'size': sum(stripe['size'] for stripe in stripes),
+                               'stripe_size': volumes.stripe_size, 'stripes': stripes}).encode()
+            await to_thread(self._write_chunk, manifest, body, fsync)
+            await to_thread(fsync_dir, manifest.parent) if fsync else ...
+            return manifest, digest.hexdigest() if digest else '', first
+        except BaseException:
+            for task in writes:
+                task.cancel()
+            for stripe in stripes:
+                Path(stripe['path']).unlink(missing_ok=True)
+            raise
+        finally:
+            await file.close()
+
+    async def upload(self, file_field=None) -> FileData:
+        """Upload a file to one of the volumes, or stripe it across the volumes.
+
+        Args:
+            file_field (FileField): A file field object.
+
+        Returns:
+            FileData: The result of the upload.
+        """
+        try:
+            self.file_field = file_field
+            file_field = self.file_field
+            field_name, file, config = file_field['name'], file_field['file'], file_field.get('config', {})
+            volumes = config.get('volumes')
+            if not volumes:
+                raise FileStoreError('The volumes config key is required by the VolumeEngine')
+            volumes = volumes if isinstance(volumes, VolumeSet) else VolumeSet.shared(volumes)
+            durability = config.get('durability', 'none')
+            if durability not in ('none', 'fsync', 'group'):
+                raise FileStoreError(f'Unknown durability {durability}, expected one of none, fsync or group')
+            relative = self.relative(file, await self.destination(file_field), config.get('destination'))
+            # a file stored again is written to the volume of its newest copy and the other copies are removed.
+            copies = await to_thread(lambda: [(volume, path, path.stat().st_size * (not path.name.endswith(
+                MANIFEST_SUFFIX)), volumes.stripe_paths(path)) for volume, path in volumes.copies(relative)])
+            write = self._stripe if volumes.stripes(file.size) else self._write
+            dest, checksum, volume = await write(volumes, relative, file, durability, config.get('checksum', ''),
+                                                 copies[0][0] if copies else None)
+            for replaced, path, size, stripes in copies:
+                if path == dest:
+                    # overwritten in place, only its space and old stripes are left to free.
+                    replaced.used -= size if replaced.capacity is not None else 0
+                    await to_thread(volumes.remove_file, None, stripes)
+                else:
+                    await to_thread(volumes.remove_file, path, stripes)
+            if volumes.needs_rebalance and not volumes.rebalancing and self.background_tasks is not None:
+                self.background_tasks.add_task(volumes.rebalance_async)
+            striped = dest.name.endswith(MANIFEST_SUFFIX)
+            return FileData(size=file.size, filename=file.filename, content_type=file.content_type,
+                            path=str(dest), field_name=field_name, checksum=checksum,
+                            metadata={'volume': str(volume.root), 'relative': str(PurePosixPath(*relative.parts)),
+                                      'striped': striped},
+                            message=f'{file.filename} was {"striped" if striped else "saved"} successfully')
+        except Exception as err:
+            logger.error(f'Error uploading file: {err} in {self.__class__.__name__}')
+            raise FileStoreError(err)
+
+    @staticmethod
+    def _volumes(config: Config) -> Optional[VolumeSet]:
+        volumes = config.get('volumes')
+        return volumes if isinstance(volumes, VolumeSet) or not volumes else VolumeSet.shared(volumes)
+
+    @staticmethod
+    def _manifest(dest: str) -> str:
+        return dest if dest.endswith(MANIFEST_SUFFIX) else dest + MANIFEST_SUFFIX
+
+    @staticmethod
+    def _remove(volumes: Optional[VolumeSet], key: str) -> str:
+        if volumes is not None:
+            volumes.remove_file(key)
+        else:
+            for stripe in VolumeSet.stripe_paths(key):
+                stripe.unlink(missing_ok=True)
+            Path(key).unlink(missing_ok=True)
+        return key
+
+    def _copy(self, pair: Tuple[str, str]) -> str:
+        source, dest = pair
+        if not source.endswith(MANIFEST_SUFFIX):
+            return super()._copy(pair)
+        # the copy gets stripes of its own, linked to the same data, so deleting either file keeps the other whole.
+        dest, token = Path(self._manifest(dest)), uuid4().hex[:8]
+        manifest = json.loads(Path(source).read_text())
+        name = dest.name[:-len(MANIFEST_SUFFIX)]
+        for index, stripe in enumerate(manifest['stripes']):
+            path = Path(stripe['path'])
+            copy = path.with_name(f'{name}.{token}.{index:05d}')
+            self._place(path, copy, link=True)
+            stripe['path'] = str(copy)
+        manifest['filename'] = name
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        self._write_chunk(dest, json.dumps(manifest).encode(), False)
+        return str(dest)
+
+    def _move(self, pair: Tuple[str, str]) -> str:
+        source, dest = pair
+        # the stripes stay where they are, the manifest lists them by path.
+        return super()._move((source, self._manifest(dest) if source.endswith(MANIFEST_SUFFIX) else dest))
+
+    async def delete(self, keys: Sequence[str], *, config: Config = None) -> BatchResult:
+        """Delete files and manifests by path, with the stripes of the manifests. See StorageEngine.delete."""
+        config = config if config is not None else self.config
+        return await self._batch('delete', partial(self._remove, self._volumes(config)), [str(key) for key in keys],
+                                 config)
@@ -1,21 +1,26 @@
 """
 Single storage class to handle multiple storage option
 """
+import time
 import asyncio
 from typing import Type, List, Dict, Union
 from random import randint
 from logging import getLogger
 
 from starlette.datastructures import FormData
-from fastapi import Request, BackgroundTasks
+from fastapi import Request, BackgroundTasks, HTTPException
 from pydantic import create_model, Field, BaseModel as FormModel
 
 # from .util import FormModel
 from .structs import UploadFile, Config, FileField, cache, FileData
-from .main import _file_filter, file_filter, filename
+from .main import filename, collect_files, store_files, in_background
+from .archive import is_archive
 
-from .storage_engines import MemoryEngine, StorageEngine, LocalEngine
+from .storage_engines import MemoryEngine, StorageEngine, LocalEngine, ReplicatedEngine
 from .exceptions import FileStoreError
+from .forms import parse_form, SpoolStats
+from .plan import StorePlan
+from .cancellation import RequestWatch
 
 logger = getLogger()
 
@@ -28,13 +33,16 @@ class FileStore:
     background_tasks: BackgroundTasks
     file_count: int
 
-    def __init__(self, name: str = '', count: int = 1, required=False, storage: Type[StorageEngine] = LocalEngine,
+    def __init__(self, name: str = '', count: int = 1, required=False,
+                 storage: Union[Type[StorageEngine], List[Type[StorageEngine]]] = LocalEngine,
                  fields: List[FileField] = None, config: Config = None):
         field = {'name': name, 'max_count': count, 'required': required, 'storage': storage} if name else {}
         self.fields = fields or []
         self.fields.append(field) if field else ...
         self.config = {'max_files': 1000, 'max_fields': 1000, 'filename': filename, 'background': False,
                        **(config or {})}
+        self.spool_stats = SpoolStats()
+        self.plan = StorePlan.compile(self.fields, self.config)
 
     @property
     @cache
@@ -56,35 +64,62 @@ class FileStore:
         return model
 
     async def __call__(self, req: Request, bgt: BackgroundTasks) -> Union[FileData, List[FileData]]:
+        start = time.monotonic()
         self.request = req
         self.background_tasks = bgt
+        admission = self.config.get('admission')
+        admitted = admission.admit(req) if admission else False
+        # the budget of background uploads is released when they are done.
+        held = False
         try:
-            max_files, max_fields = self.config['max_files'], self.config['max_fields']
-            form = await req.form(max_files=max_files, max_fields=max_fields)
+            plan = self.plan
+            form = await parse_form(req, max_files=plan.max_files, max_fields=plan.max_fields, spool=plan.spool,
+                                    stats=self.spool_stats)
             self.form = form
-            file_fields: List[Union[FileField, Dict]] = []
-            for field in self.fields:
-                name = field['name']
-                count = field.get('max_count', None)
-                files = form.getlist(name)[: count]
-                field['config'] = {**self.config, **field.get('config', {})}
-                for file in files:
-                    config = field['config']
-                    _filter = config.get('filter', file_filter)
-                    if not (_file_filter(file) and _filter(req, form, name, file)): continue
-                    file_dict = {**field, 'file': config.get('filename', filename)(req, form, name, file)}
-                    file_fields.append(file_dict)
+            file_fields = await collect_files(req, form, plan)
 
             if not file_fields:
                 return FileData(status=False, error='No files uploaded', message='No files uploaded')
 
-            elif len(file_fields) == 1:
-                return await self.upload(file_field=file_fields[0])
-            else:
-                return await self.multi_upload(file_fields=file_fields)
+            async with self.watch(req, form, start):
+                if len(file_fields) == 1 and not is_archive(file_fields[0]):
+                    result = await self.upload(file_field=file_fields[0])
+                    files = [result]
+                else:
+                    files = await store_files(req, form, file_fields, self._upload_many)
+                    result = files[0] if len(files) == 1 else files
+
+            if index := self.config.get('index'):
+                bgt.add_task(index.add, files)
+            if held := admitted and in_background(file_fields):
+                bgt.add_task(admission.release, req.scope)
+            return result
+        except HTTPException:
+            raise
         except Exception as err:
             logger.error(f'Error uploading files: {err} in {self.__class__.__name__}')
             raise FileStoreError(err)
+        finally:
+            admission.release(req.scope) if admitted and not held else ...
+
+    def watch(self, req: Request, form: FormData, start: float) -> RequestWatch:
+        """Watch the storage work of a request for a client disconnect and the deadline config. See FastStore.watch."""
+        return RequestWatch(req, deadline=self.config.get('deadline'), start=start, form=form,
+                            disconnect=self.config.get('cancel_on_disconnect', True))
+
+    def engine(self, storage: Union[Type[StorageEngine], List[Type[StorageEngine]]]) -> StorageEngine:
+        """Create a storage engine for the request.
+
+        Args:
+            storage (Type[StorageEngine] | list[Type[StorageEngine]]): An engine class or the engines to replicate to.
+
+        Returns:
+            StorageEngine: The storage engine.
+        """
+        if isinstance(storage, (list, tuple)):
+            return ReplicatedEngine(request=self.request, form=self.form, background_tasks=self.background_tasks,
+                                    engines=storage)
+        return storage(request=self.request, form=self.form, background_tasks=self.background_tasks)
 
     async def upload(self, *, file_field: FileField) -> FileData:
         """Upload a single file using the specified storage service.
@@ -92,20 +127,38 @@ class FileStore:
         Args:
             file_field (FileField): A FileField dictionary instance.
         """
-        try:
-            storage_cls = file_field.get('storage', MemoryEngine)
-            storage = storage_cls(request=self.request, form=self.form, background_tasks=self.background_tasks,
-                                  file_field=file_field)
-            return await storage.upload()
-        except FileStoreError as err:
-            logger.error(f'Error uploading file: {err} in {self.__class__.__name__}')
-            return FileData(status=False, error='Something went wrong', field_name=file_field['name'],
-                            message=f'Unable to upload {file_field["name"]}')
+        return (await self.multi_upload(file_fields=[file_field]))[0]
 
     async def multi_upload(self, *, file_fields: List[Union[FileField, Dict]]) -> List[FileData]:
-        """Upload multiple files with there respective storage engine
+        """Upload multiple files with there respective storage engine. The files are grouped by storage engine and
+        config, each group is uploaded as a batch by a single engine.
 
         Args:
             file_fields (list[FileField]): A list of FileFields to upload.
+
+        Returns:
+            list[FileData]: The results in the order of the file fields.
         """
-        return await asyncio.gather(*[self.upload(file_field=file_field) for file_field in file_fields])
\ No newline at end of file
+        groups: Dict[tuple, List[int]] = {}
+        storages = {}
+        for index, file_field in enumerate(file_fields):
+            storage = file_field.get('storage', MemoryEngine)
+            storages[id(storage)] = storage
+            groups.setdefault((id(storage), id(file_field.get('config'))), []).append(index)
+        results: List[FileData] = [None] * len(file_fields)
+
+        async def upload_group(storage, indexes: List[int]):
+            try:
+                batch = await self.engine(storage).upload_many(file_fields=[file_fields[index] for index in indexes])
+            except FileStoreError as err:
+                logger.error(f'Error uploading files: {err} in {self.__class__.__name__}')
+                batch = [FileData(status=False, error='Something went wrong', field_name=file_fields[index]['name'],
+                                  message=f'Unable to upload {file_fields[index]["name"]}') for index in indexes]
+            for index, result in zip(indexes, batch):
+                results[index] = result
+
+        await asyncio.gather(*[upload_group(storages[key], indexes) for (key, _), indexes in groups.items()])
+        return results
+
+    async def _upload_many(self, file_fields: List[FileField]) -> List[FileData]:
+        return await self.multi_upload(file_fields=file_fields)
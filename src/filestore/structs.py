@@ -58,6 +58,36 @@ if td:
         bucket: str
         region: str
         storage: StorageEngine
+        durability: str
+        replicas: list
+        quorum: Union[str, int]
+        remote: StorageEngine
+        remote_destination: Union[Callable[[Request, Form, str, UploadFile], str], str]
+        migrator: Any
+        admission: Any
+        spool_max_size: int
+        spool_dir: Union[str, Path]
+        extract: bool
+        extract_max_entries: int
+        extract_max_size: int
+        extract_concurrency: int
+        batch_destination: Callable[[Request, FormData, List['FileField']], List[Union[str, Path]]]
+        checksum: str
+        index: Any
+        retry: Any
+        limiter: Any
+        pack_threshold: int
+        pack_dir: Union[str, Path]
+        segments: Any
+        defer: bool
+        volumes: Any
+        deadline: float
+        cancel_on_disconnect: bool
+        process_pool: Any
+        batch_concurrency: int
+        scheduler: Any
+        chunk_dir: Union[str, Path]
+        chunks: Any
 
 
     class FileField(TypedDict, total=False):
@@ -69,7 +99,8 @@ if td:
         required: bool
         file: UploadFile
         config: Config
-        storage: StorageEngine
+        storage: Union[StorageEngine, List[StorageEngine]]
+        destination: Union[str, Path]
 
 
 Self = TypeVar('Self', bound='FastStore')
@@ -91,6 +122,8 @@ class FileData(BaseModel):
         metadata (dict): Extra metadata of the file.
         error (str): The error message if the file storage operation failed.
         message (str): Success message if the file storage operation was successful.
+        replicas (list[FileData]): The result of each replica for replicated storage.
+        checksum (str): The hex digest of the file when a checksum algorithm is configured.
     """
     path: str = ''
     url: str = ''
@@ -103,6 +136,8 @@ class FileData(BaseModel):
     metadata: dict = {}
     error: str = ''
     message: str = ''
+    replicas: List['FileData'] = []
+    checksum: str = ''
 
 
 class Store(BaseModel):
@@ -129,4 +164,35 @@ class Store(BaseModel):
         total = 0
         for field in self.files.values():
             total += len(field)
-        return total
\ No newline at end of file
+        return total
+
+
+class BatchResult(BaseModel):
+    """
+    The response model of a batch delete, copy or move operation of a storage engine.
+
+    Attributes:
+        operation (str): delete, copy or move.
+        succeeded (List[str]): The keys, or the destinations of copied and moved keys, that succeeded.
+        failed (Dict[str, str]): The error of every key that failed by key.
+        error (str): The error message if some of the keys failed.
+        message (str): Success message of the keys that succeeded.
+        status (bool): False if any key failed.
+    """
+    operation: str = ''
+    succeeded: List[str] = []
+    failed: Dict[str, str] = {}
+    error: str = ''
+    message: str = ''
+    status: bool = True
+
+    @classmethod
+    def summary(cls, operation: str, succeeded: List[str], failed: Dict[str, str]) -> 'BatchResult':
+        """Build the result of an operation with its message and error."""
+        verb = {'delete': 'deleted', 'copy': 'copied', 'move': 'moved'}.get(operation, operation)
+        return cls(operation=operation, succeeded=succeeded, failed=failed, status=not failed,
+                   message=f'{len(succeeded)} file(s) {verb} successfully' if succeeded else '',
+                   error=f'{len(failed)} file(s) not {verb}' if failed else '')
+
+    def __len__(self) -> int:
+        return len(self.succeeded)
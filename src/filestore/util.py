@@ -1,4 +1,6 @@
-from typing import Any, Set, Dict, Type
+import asyncio
+from functools import partial
+from typing import Any, Set, Dict, Type, Callable
 
 from pydantic.json_schema import GenerateJsonSchema, JsonSchemaWarningKind, DEFAULT_REF_TEMPLATE, JsonSchemaMode
 from pydantic import BaseModel, ConfigDict
@@ -21,3 +23,21 @@ class FormModel(BaseModel):
     ) -> Dict[str, Any]:
         return super().model_json_schema(by_alias=by_alias, ref_template=ref_template,
                                          schema_generator=schema_generator, mode=mode)
+
+
+async def to_thread(func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking function in a worker thread without blocking the event loop.
+    Falls back to the default executor on python versions without asyncio.to_thread.
+
+    Args:
+        func (Callable): The blocking function.
+        *args: Positional arguments for the function.
+        **kwargs: Keyword arguments for the function.
+
+    Returns:
+        Any: The return value of the function.
+    """
+    if hasattr(asyncio, 'to_thread'):
+        return await asyncio.to_thread(func, *args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
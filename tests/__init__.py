@@ -10,6 +10,7 @@ from fastapi.testclient import TestClient
 from pytest import fixture
 
 from .app import app
+from .utils import file_index
 
 client = TestClient(app)
 
@@ -23,6 +24,17 @@ def file():
     test_dir = Path.cwd() / 'test_data'
     test_dir.mkdir(parents=True, exist_ok=True) if not test_dir.exists() else ...
 
+
+@fixture
+def index():
+    """
+    The file index of the indexed stores. The database is created in the test data folder on first use.
+    Yields:
+        FileIndex: The index, closed after the test
+    """
+    yield file_index
+    file_index.close()
+
 @fixture
 def book_file():
     """
@@ -9,8 +9,12 @@ import uvicorn
 from fastapi.templating import Jinja2Templates
 from dotenv import load_dotenv
 from base64 import b64encode
-from filestore import FileData, Store
-from .utils import single_local, multiple_local, single_mem, multiple_mem, single_s3, multiple_s3, filestore
+from filestore import FileData, Store, zip_response
+from .utils import single_local, multiple_local, single_mem, multiple_mem, single_s3, multiple_s3, filestore, \
+    durable_local, replicated, tiered, admitted_local, spooled_local, async_local, \
+    extract_local, indexed_local, raw_upload, packed, deferred_local, volumes, \
+    deadline_local, deferred_deadline, deferred_admitted, admission, file_index, batched, \
+    background_indexed
 load_dotenv()
 
 app = FastAPI()
@@ -56,6 +60,54 @@ async def local_multiple(model=Depends(multiple_local.model), loc=Depends(multip
     return loc.store
 
 
+@app.post('/local_durable', name='local_durable')
+async def local_durable(loc=Depends(durable_local)) -> Store:
+    """Local storage endpoint with group committed writes."""
+    return loc.store
+
+
+@app.post('/local_admitted', name='local_admitted')
+async def local_admitted(loc=Depends(admitted_local)) -> Store:
+    """Local storage endpoint with admission control."""
+    return loc.store
+
+
+@app.post('/local_spooled', name='local_spooled')
+async def local_spooled(loc=Depends(spooled_local)) -> Store:
+    """Local storage endpoint with spooling configured by field."""
+    return loc.store
+
+
+@app.post('/local_async', name='local_async')
+async def local_async(loc=Depends(async_local)) -> Store:
+    """Local storage endpoint with async filter and batch destination functions."""
+    return loc.store
+
+
+@app.post('/local_extract', name='local_extract')
+async def local_extract(loc=Depends(extract_local)) -> Store:
+    """Local storage endpoint that extracts uploaded archives."""
+    return loc.store
+
+
+@app.post('/local_indexed', name='local_indexed')
+async def local_indexed(loc=Depends(indexed_local)) -> Store:
+    """Local storage endpoint that records the stored files in an index."""
+    return loc.store
+
+
+@app.post('/background_indexed', name='background_indexed')
+async def background_indexed_store(loc=Depends(background_indexed)) -> Store:
+    """Local storage endpoint that saves the files in the background and records them in an index."""
+    return loc.store
+
+
+@app.post('/local_bundle', name='local_bundle')
+async def local_bundle(loc=Depends(durable_local)):
+    """Store the uploaded files locally and stream them back as a zip archive."""
+    return zip_response([file for files in loc.store.files.values() for file in files], prefetch=2)
+
+
 @app.post('/s3_multiple', name='s3_multiple', openapi_extra={'form': {'multiple': True}})
 async def s3_multiple(model=Depends(multiple_s3.model), s3=Depends(multiple_s3)) -> Store:
     """
@@ -117,5 +169,72 @@ async def filestore(model=Depends(filestore.model), files=Depends(filestore)) ->
     return files
 
 
+@app.post('/batched', name='batched')
+async def batched_store(files=Depends(batched)) -> Union[FileData, List[FileData]]:
+    """Batched uploads endpoint, the files of each field are uploaded by one engine."""
+    return files
+
+
+@app.post('/replicated', name='replicated')
+async def replicated_store(files=Depends(replicated)) -> Union[FileData, List[FileData]]:
+    """Replicated storage endpoint, each file is stored on disk and in memory."""
+    return files
+
+
+@app.post('/tiered', name='tiered')
+async def tiered_store(files=Depends(tiered)) -> Union[FileData, List[FileData]]:
+    """Tiered storage endpoint, files are saved locally and migrated to memory storage."""
+    return files
+
+
+@app.post('/packed', name='packed')
+async def packed_store(files=Depends(packed)) -> Union[FileData, List[FileData]]:
+    """Packed storage endpoint, small files are appended to segment files."""
+    return files
+
+
+@app.post('/local_deferred', name='local_deferred')
+async def local_deferred(loc=Depends(deferred_local)) -> Store:
+    """Local storage endpoint that stores the files as the handler iterates over them."""
+    completed = []
+    async for file_data in loc.iter_uploads():
+        indexed = await file_index.find(path=file_data.path)
+        completed.append(file_data.filename if indexed else f'{file_data.filename} (not indexed)')
+    store = loc.store
+    store.message = f'{store.message} in order {", ".join(completed)}'
+    return store
+
+
+@app.post('/volumes', name='volumes')
+async def volume_store(files=Depends(volumes)) -> Union[FileData, List[FileData]]:
+    """Multi volume storage endpoint, files are spread over the volumes and large files are striped."""
+    return files
+
+
+@app.post('/local_deadline', name='local_deadline')
+async def local_deadline(loc=Depends(deadline_local)) -> Store:
+    """Local storage endpoint with a deadline shorter than its destination function."""
+    return loc.store
+
+
+@app.post('/deferred_admitted', name='deferred_admitted')
+async def deferred_admitted_store(loc=Depends(deferred_admitted)) -> Store:
+    """Deferred local storage endpoint with admission control, reports the bytes held while the files are stored."""
+    held = admission.inflight_bytes
+    [file_data async for file_data in loc.iter_uploads()]
+    store = loc.store
+    store.message = f'{store.message}, {held} bytes held'
+    return store
+
+
+@app.post('/deferred_deadline', name='deferred_deadline')
+async def deferred_deadline_store(loc=Depends(deferred_deadline)) -> Store:
+    """Deferred local storage endpoint with a deadline shorter than its destination function."""
+    [file_data async for file_data in loc.iter_uploads()]
+    return loc.store
+
+
+app.mount('/raw', raw_upload, name='raw')
+
 if __name__ == "__main__":
     uvicorn.run("app:app", port=5000, log_level="info")
\ No newline at end of file
@@ -0,0 +1,296 @@
+"""
+Open loop load generator for the upload endpoints.
+
+Requests arrive as a Poisson process at the given rate whether or not earlier requests have completed, so a saturated
+server shows up as growing latency and errors instead of a slower client. The server is started with uvicorn in a
+separate process unless a url is given.
+
+Examples:
+    python tests/loadgen.py --endpoint /local_multiple --field books --field books --form title=Load --rate 50 \\
+        --duration 30 --sizes lognormal:256KB:1.5 --connections 100
+
+    python tests/loadgen.py --endpoint /local_single --field book --extension pdf --rate 100
+
+    python tests/loadgen.py --url http://localhost:8000 --endpoint /upload --field file --sizes uniform:1KB:8MB \\
+        --form title=Book --rate 200 --json
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import asyncio
+import argparse
+import subprocess
+from bisect import bisect_left
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+UNITS = {'b': 1, 'kb': 1024, 'mb': 1024 ** 2, 'gb': 1024 ** 3}
+BUCKETS = [0.001 * 2 ** (i / 2) for i in range(36)]
+
+
+def parse_size(value: str) -> int:
+    """Parse a size such as 512, 64KB or 1.5MB into bytes."""
+    value = value.strip().lower()
+    for unit in sorted(UNITS, key=len, reverse=True):
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * UNITS[unit])
+    return int(float(value))
+
+
+def size_distribution(spec: str) -> Callable[[random.Random], int]:
+    """Build a file size sampler from a spec.
+
+    Args:
+        spec (str): fixed:SIZE, uniform:MIN:MAX, lognormal:MEDIAN:SIGMA or pareto:MIN:ALPHA. Sizes take B, KB, MB
+            and GB suffixes.
+
+    Returns:
+        Callable[[random.Random], int]: A function drawing a size in bytes.
+    """
+    kind, *args = spec.split(':')
+    if kind == 'fixed':
+        size = parse_size(args[0])
+        return lambda rng: size
+    if kind == 'uniform':
+        low, high = parse_size(args[0]), parse_size(args[1])
+        return lambda rng: rng.randint(low, high)
+    if kind == 'lognormal':
+        median, sigma = parse_size(args[0]), float(args[1])
+        return lambda rng: max(1, int(rng.lognormvariate(math.log(median), sigma)))
+    if kind == 'pareto':
+        low, alpha = parse_size(args[0]), float(args[1])
+        return lambda rng: int(low * rng.paretovariate(alpha))
+    raise argparse.ArgumentTypeError(f'Unknown size distribution {spec}')
+
+
+def stored(body) -> bool:
+    """Check that the json response of an upload stored every file. A Store stored nothing when its files are empty
+    and failed some files when failed isn't, a FileData or a list of them failed when a status is False."""
+    if isinstance(body, list):
+        return all(stored(item) for item in body)
+    if not isinstance(body, dict) or body.get('status') is False:
+        return False
+    if 'files' in body and 'failed' in body:
+        return bool(body['files']) and not body['failed']
+    return True
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+class Results:
+    """The outcome of the requests of a run."""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.sent = 0
+        self.ok = 0
+        self.errors = 0
+        self.dropped = 0
+        self.bytes = 0
+
+    def record(self, status: str, latency: float, size: int, ok: bool):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.latencies.append(latency)
+        if ok:
+            self.ok += 1
+            self.bytes += size
+        else:
+            self.errors += 1
+
+    def summary(self, elapsed: float, rate: float) -> dict:
+        latencies = sorted(self.latencies)
+        done = self.ok + self.errors
+        return {'offered_rate': rate, 'elapsed': round(elapsed, 3), 'sent': self.sent, 'completed': done,
+                'ok': self.ok, 'errors': self.errors, 'dropped': self.dropped,
+                'error_rate': round(self.errors / done, 4) if done else 0.0,
+                'throughput_rps': round(self.ok / elapsed, 2) if elapsed else 0.0,
+                'throughput_mbps': round(self.bytes / elapsed / 1024 ** 2, 2) if elapsed else 0.0,
+                'latency': {**{name: round(percentile(latencies, q), 4) for name, q in
+                               (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999))},
+                            'max': round(latencies[-1], 4) if latencies else 0.0},
+                'statuses': self.statuses}
+
+    def histogram(self, width: int = 50) -> str:
+        """An ascii histogram of the latencies with logarithmic buckets."""
+        counts = [0] * (len(BUCKETS) + 1)
+        for latency in self.latencies:
+            counts[bisect_left(BUCKETS, latency)] += 1
+        used = [index for index, count in enumerate(counts) if count]
+        if not used:
+            return ''
+        peak = max(counts)
+        lines = []
+        for index in range(used[0], used[-1] + 1):
+            bound = f'<= {BUCKETS[index] * 1000:9.1f}ms' if index < len(BUCKETS) else f' > {BUCKETS[-1] * 1000:9.1f}ms'
+            lines.append(f'{bound} {counts[index]:8d} {"#" * math.ceil(counts[index] / peak * width)}')
+        return '\n'.join(lines)
+
+
+class LoadGenerator:
+    """Send multipart uploads to an endpoint at an open loop Poisson arrival rate.
+
+    Attributes:
+        url (str): The url of the endpoint.
+        fields (list[str]): The file field names, a file is sent for each.
+        extension (str): The extension of the file names, the stores filter files by extension.
+        sizes (Callable[[random.Random], int]): The file size sampler.
+        form (dict): Extra form fields.
+        rate (float): The mean arrival rate in requests per second.
+        duration (float): The length of the run in seconds.
+        connections (int): The maximum number of connections.
+        max_inflight (int): Arrivals while this many requests are in flight are dropped and counted.
+        timeout (float): The timeout of a request.
+    """
+
+    def __init__(self, url: str, fields: List[str], sizes: Callable[[random.Random], int], form: Dict[str, str],
+                 rate: float, duration: float, connections: int, max_inflight: int, timeout: float, seed: int = None,
+                 extension: str = 'txt'):
+        self.url = url
+        self.fields = fields
+        self.extension = extension
+        self.sizes = sizes
+        self.form = form
+        self.rate = rate
+        self.duration = duration
+        self.connections = connections
+        self.max_inflight = max_inflight
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.results = Results()
+        self.inflight = 0
+        self.elapsed = 0.0
+        self._data = b''
+
+    def payload(self, size: int) -> bytes:
+        # one random buffer is sliced for every file so generating the payloads doesn't load the client.
+        if len(self._data) < size:
+            self._data = os.urandom(max(size, 2 * len(self._data)))
+        return self._data[:size]
+
+    async def send(self, client: httpx.AsyncClient, index: int):
+        sizes = [self.sizes(self.rng) for _ in self.fields]
+        files = [(field, (f'load{index}-{n}.{self.extension}', self.payload(size), 'application/octet-stream'))
+                 for n, (field, size) in enumerate(zip(self.fields, sizes))]
+        start = time.perf_counter()
+        try:
+            response = await client.post(self.url, files=files, data=self.form)
+            ok = response.is_success
+            if ok and response.headers.get('content-type', '').startswith('application/json'):
+                ok = stored(response.json())
+            status = str(response.status_code) if ok or not response.is_success else f'{response.status_code}:failed'
+        except httpx.HTTPError as err:
+            ok, status = False, type(err).__name__
+        finally:
+            self.inflight -= 1
+        self.results.record(status, time.perf_counter() - start, sum(sizes), ok)
+
+    async def run(self) -> Results:
+        limits = httpx.Limits(max_connections=self.connections, max_keepalive_connections=self.connections)
+        async with httpx.AsyncClient(limits=limits, timeout=self.timeout) as client:
+            tasks = set()
+            start = time.perf_counter()
+            arrival = start
+            while (arrival := arrival + self.rng.expovariate(self.rate)) < start + self.duration:
+                await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+                if self.inflight >= self.max_inflight:
+                    self.results.dropped += 1
+                    continue
+                self.inflight += 1
+                self.results.sent += 1
+                task = asyncio.create_task(self.send(client, self.results.sent))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+            self.elapsed = time.perf_counter() - start
+        return self.results
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(app: str, port: int, workers: int, cwd: Path) -> subprocess.Popen:
+    """Start uvicorn in a separate process and wait until it accepts connections. The app is imported from the
+    parent of the tests folder and runs in the tests folder, where the test app keeps its uploads."""
+    command = [sys.executable, '-m', 'uvicorn', app, '--app-dir', str(cwd.parent), '--port', str(port),
+               '--workers', str(workers), '--log-level', 'warning']
+    server = subprocess.Popen(command, cwd=cwd)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f'uvicorn exited with {server.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise SystemExit('uvicorn did not start in 30 seconds')
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Open loop load generator for FastStore upload endpoints.')
+    parser.add_argument('--app', default='tests.app:app', help='The app started with uvicorn. Default tests.app:app')
+    parser.add_argument('--url', help='The base url of a running server, no server is started if given')
+    parser.add_argument('--workers', type=int, default=1, help='The number of uvicorn workers')
+    parser.add_argument('--endpoint', default='/local_single', help='The path of the upload endpoint')
+    parser.add_argument('--field', action='append', dest='fields',
+                        help='A file field, repeat to send several files. Default book')
+    parser.add_argument('--extension', default='txt', help='The extension of the file names. Default txt')
+    parser.add_argument('--form', action='append', default=[], help='An extra form field as name=value')
+    parser.add_argument('--sizes', type=size_distribution, default='lognormal:128KB:1.0',
+                        help='fixed:SIZE, uniform:MIN:MAX, lognormal:MEDIAN:SIGMA or pareto:MIN:ALPHA')
+    parser.add_argument('--rate', type=float, default=20, help='The mean arrival rate in requests per second')
+    parser.add_argument('--duration', type=float, default=10, help='The length of the run in seconds')
+    parser.add_argument('--connections', type=int, default=64, help='The maximum number of connections')
+    parser.add_argument('--max-inflight', type=int, default=1000, help='Drop arrivals above this many in flight')
+    parser.add_argument('--timeout', type=float, default=60, help='The timeout of a request in seconds')
+    parser.add_argument('--seed', type=int, help='The seed of the arrivals and sizes')
+    parser.add_argument('--json', action='store_true', help='Print the summary as json')
+    args = parser.parse_args(argv)
+
+    server = None
+    base = args.url
+    if base is None:
+        port = free_port()
+        server = start_server(args.app, port, args.workers, Path(__file__).resolve().parent)
+        base = f'http://127.0.0.1:{port}'
+    form = dict(item.split('=', 1) for item in args.form)
+    generator = LoadGenerator(f'{base.rstrip("/")}{args.endpoint}', args.fields or ['book'], args.sizes, form,
+                              args.rate, args.duration, args.connections, args.max_inflight, args.timeout, args.seed,
+                              args.extension)
+    try:
+        results = asyncio.run(generator.run())
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    summary = results.summary(generator.elapsed, args.rate)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    latency = summary['latency']
+    print(f"{summary['sent']} sent, {summary['completed']} completed, {summary['dropped']} dropped in "
+          f"{summary['elapsed']}s at {args.rate}/s offered")
+    print(f"throughput {summary['throughput_rps']} req/s, {summary['throughput_mbps']} MB/s, "
+          f"error rate {summary['error_rate']:.2%}, statuses {summary['statuses']}")
+    print(' '.join(f'{name} {value * 1000:.1f}ms' for name, value in latency.items()))
+    print(results.histogram())
+
+
+if __name__ == '__main__':
+    main()